@@ -1,20 +1,29 @@
+import csv
+import itertools
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import config as cfg
-import laspy
 import numpy as np
-from gftin import GFTIN
+from columnar import cached_columns
+from gftin import DENSIFICATION_MODES, GFTIN
 from lasinfo import las_info
 from matplotlib import pyplot as plt
-from preprocess import clip_pc, preprocess
+from point_store import PointStore
+from preprocess import preprocess
 from ptio import read_laz
+from step3 import add_ground_dim, buffered_extent
+
+# the parameters of a sweep, in the order of the columns of the results table
+SWEEP_PARAMS = ("dist_threshold", "max_angle", "cell_size", "mode")
 
 
 def find_optimistic_params():
     """
-    Finds the optimistic parameters for the benchmark by iterating over different combinations of
-    distance threshold, maximum angle, and cell size. It calls the `benchmark` function with each
-    combination and plots the results using the `plot_benchmarks` function.
+    Finds the optimistic parameters for the benchmark by sweeping over different combinations of
+    distance threshold, maximum angle, and cell size. Every sweep is written to a results table and
+    plotted using the `plot_benchmarks` function.
 
     Returns:
         None
@@ -22,79 +31,182 @@ def find_optimistic_params():
     file_path = preprocess(cfg.INPUT_LAS)
     out_dir = cfg.BENCHMARK_OUT_DIR
 
-    # benchmark distance threshold
-    # input1 = [
-    #     {"dist_threshold": 1, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 3, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 5, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 8, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 10, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 20, "max_angle": 10, "cell_size": 100},
-    # ]
-    # accuracies, f1_scores = [], []
-    # for params in input1:
-    #     accuracy, f1_score = benchmark(
-    #         file_path,
-    #         params["dist_threshold"],
-    #         params["max_angle"],
-    #         params["cell_size"],
-    #     )
-    #     accuracies.append(accuracy)
-    #     f1_scores.append(f1_score)
-    # plot_benchmarks(
-    #     accuracies,
-    #     f1_scores,
-    #     [d["dist_threshold"] for d in input1],
-    #     "Distance threshold",
-    #     out_dir,
-    # )
-    # input2 = [
-    #     {"dist_threshold": 0.5, "max_angle": 10, "cell_size": 100},
-    #     {"dist_threshold": 0.5, "max_angle": 20, "cell_size": 100},
-    #     {"dist_threshold": 0.5, "max_angle": 30, "cell_size": 100},
-    #     {"dist_threshold": 0.5, "max_angle": 40, "cell_size": 100},
-    # ]
-    # accuracies, f1_scores = [], []
-    # for params in input2:
-    #     accuracy, f1_score = benchmark(
-    #         file_path,
-    #         params["dist_threshold"],
-    #         params["max_angle"],
-    #         params["cell_size"],
-    #     )
-    #     accuracies.append(accuracy)
-    #     f1_scores.append(f1_score)
-    # plot_benchmarks(
-    #     accuracies, f1_scores, [d["max_angle"] for d in input2], "Max Angle", out_dir
-    # )
-    # input3 = [
-    #     {"dist_threshold": 5, "max_angle": 30, "cell_size": 5},
-    #     {"dist_threshold": 5, "max_angle": 30, "cell_size": 30},
-    #     {"dist_threshold": 5, "max_angle": 30, "cell_size": 60},
-    #     {"dist_threshold": 5, "max_angle": 30, "cell_size": 90},
-    #     {"dist_threshold": 5, "max_angle": 30, "cell_size": 120},
-    # ]
-    # accuracies, f1_scores = [], []
-    # for params in input3:
-    #     accuracy, f1_score = benchmark(
-    #         file_path,
-    #         params["dist_threshold"],
-    #         params["max_angle"],
-    #         params["cell_size"],
-    #     )
-    #     accuracies.append(accuracy)
-    #     f1_scores.append(f1_score)
-    # plot_benchmarks(
-    #     accuracies, f1_scores, [d["cell_size"] for d in input3], "Cell size", out_dir
-    # )
-
-    benchmark(file_path, 5, 30, 90)
-
-
-def plot_benchmarks(accuracies, f1_scores, param_values, param_name, out_dir):
+    param_grids = {
+        "dist_threshold": {
+            "dist_threshold": [1, 3, 5, 8, 10, 20],
+            "max_angle": [10],
+            "cell_size": [100],
+        },
+        "max_angle": {
+            "dist_threshold": [0.5],
+            "max_angle": [10, 20, 30, 40],
+            "cell_size": [100],
+        },
+        "cell_size": {
+            "dist_threshold": [5],
+            "max_angle": [30],
+            "cell_size": [5, 30, 60, 90, 120],
+        },
+    }
+    # the points are loaded and clipped once for all sweeps, with the buffer of the largest cell size
+    max_cell_size = max(max(grid["cell_size"]) for grid in param_grids.values())
+    store = PointStore.load(
+        cached_columns(file_path), buffered_extent(cfg.EXTENT, max_cell_size * 2)
+    )
+
+    for param_name, param_grid in param_grids.items():
+        results = sweep(store, param_grid, mode=cfg.GFTIN_DENSIFICATION)
+        write_results_table(
+            results, os.path.join(out_dir, f"benchmark_{param_name}.csv")
+        )
+        plot_benchmarks(results, param_name, out_dir)
+
+    # compare the sequential and batched densification modes, one at a time so the runtimes are comparable
+    results = sweep(
+        store,
+        {
+            "dist_threshold": [5],
+            "max_angle": [30],
+            "cell_size": [90],
+            "mode": list(DENSIFICATION_MODES),
+        },
+        workers=1,
+    )
+    write_results_table(results, os.path.join(out_dir, "benchmark_mode.csv"))
+    store.close()
+
+
+def sweep(store, param_grid, mode="sequential", workers=None):
+    """
+    Runs the benchmark for every combination of a parameter grid in a process pool.
+
+    The points are taken from a loaded point store, which is moved to shared memory for the workers. The
+    initial TIN only depends on the cell size, so its seeds are computed once per cell size and shared by all
+    the runs with that cell size. The seeded triangulation itself is not shared: a startinpy DT can neither be
+    copied nor sent to another process, and every run densifies its own, so every run inserts the shared seeds
+    into a new DT. That is one batch insertion, cheap next to extracting the seeds and the densification.
+
+    Args:
+        store (point_store.PointStore): The loaded points, covering the extent buffered by twice the largest
+            cell size.
+        param_grid (dict): The values of every parameter to sweep, e.g. {"dist_threshold": [1, 3],
+            "max_angle": [10], "cell_size": [100]}. The keys are taken from SWEEP_PARAMS; the mode defaults
+            to the mode argument.
+        mode (str, optional): The densification mode if the grid has no "mode". Defaults to "sequential".
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: One row per combination, as dicts with the parameters, accuracy, f1_score and runtime.
+    """
+    unknown = set(param_grid) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"unknown sweep parameters {sorted(unknown)}")
+    param_grid = {"mode": [mode], **param_grid}
+    names = [name for name in SWEEP_PARAMS if name in param_grid]
+    combinations = [
+        dict(zip(names, values))
+        for values in itertools.product(*(param_grid[name] for name in names))
+    ]
+
+    seeds = {}
+    for cell_size in param_grid["cell_size"]:
+        las = store.las(bbox=buffered_extent(cfg.EXTENT, cell_size * 2))
+        seeds[cell_size] = GFTIN(las, cell_size, cfg.EXTENT).seeds
+
+    handle = store.share()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                _benchmark_worker, handle, params, seeds[params["cell_size"]]
+            )
+            for params in combinations
+        ]
+        results = []
+        for params, future in zip(combinations, futures):
+            accuracy, f1_score, runtime = future.result()
+            results.append(
+                {
+                    **params,
+                    "accuracy": accuracy,
+                    "f1_score": f1_score,
+                    "runtime": runtime,
+                }
+            )
+    return results
+
+
+def _benchmark_worker(handle, params, seeds):
+    """
+    Runs the benchmark of one combination of a sweep. This runs in a worker process.
+
+    Args:
+        handle (dict): The handle of the shared point store.
+        params (dict): The parameters of the combination.
+        seeds (numpy.ndarray): The seeds of the initial TIN for the cell size of the combination.
+
+    Returns:
+        tuple: The accuracy, F1 score and runtime of the ground filtering.
+    """
+    store = PointStore.attach(handle)
+    try:
+        return benchmark(
+            None,
+            params["dist_threshold"],
+            params["max_angle"],
+            params["cell_size"],
+            params["mode"],
+            store,
+            seeds,
+        )
+    finally:
+        store.close()
+
+
+def write_results_table(results, file_path):
+    """
+    Writes the results of a sweep to a CSV table.
+
+    Args:
+        results (list): The rows returned by sweep.
+        file_path (str): The path of the CSV file.
+    """
+    with open(file_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def plot_benchmarks(results, param_name, out_dir):
+    """
+    Plots the accuracy and F1 score of a sweep against one of its parameters, with one line for every
+    combination of the other parameters.
+
+    Args:
+        results (list): The rows returned by sweep.
+        param_name (str): The parameter on the x axis.
+        out_dir (str): The directory to save the figure in.
+    """
+    other_params = [
+        name for name in SWEEP_PARAMS if name in results[0] and name != param_name
+    ]
+    lines = {}
+    for row in sorted(results, key=lambda row: row[param_name]):
+        label = ", ".join(f"{name}={row[name]}" for name in other_params)
+        lines.setdefault(label, []).append(row)
+    param_values = sorted({row[param_name] for row in results})
+
     fig, ax = plt.subplots(2, 1, figsize=(10, 8))
-    ax[0].plot(param_values, accuracies, label="Accuracy", color="blue")
-    ax[1].plot(param_values, f1_scores, label="F1 Score", color="red")
+    for label, rows in lines.items():
+        ax[0].plot(
+            [row[param_name] for row in rows],
+            [row["accuracy"] for row in rows],
+            label=f"Accuracy ({label})",
+        )
+        ax[1].plot(
+            [row[param_name] for row in rows],
+            [row["f1_score"] for row in rows],
+            label=f"F1 Score ({label})",
+        )
 
     ax[0].set_title(f"Accuracy vs {param_name}")
     ax[1].set_title(f"F1 Score vs {param_name}")
@@ -112,29 +224,28 @@ def plot_benchmarks(accuracies, f1_scores, param_values, param_name, out_dir):
     fig.savefig(os.path.join(out_dir, f"benchmark_{param_name}.png"))
 
 
-def benchmark(filepath, dist_threshold, max_angle, cell_size):
-    las = read_laz(filepath)
-    las_info(las)
+def benchmark(
+    filepath,
+    dist_threshold,
+    max_angle,
+    cell_size,
+    mode="sequential",
+    store=None,
+    seeds=None,
+):
     extent = cfg.EXTENT
-    buffered_extent = [
-        extent[0] - cell_size * 2,
-        extent[1] - cell_size * 2,
-        extent[2],
-        extent[3] + cell_size * 2,
-        extent[4] + cell_size * 2,
-        extent[5],
-    ]
-    clip_pc(las, buffered_extent)
-    las.add_extra_dim(
-        laspy.ExtraBytesParams(
-            name="is_ground",
-            type=np.uint8,  # 0: not ground, 1: ground
-        )
-    )
-    las.is_ground = np.zeros(len(las.points), dtype=np.uint8)
+    buffered = buffered_extent(extent, cell_size * 2)
+    if store is None:
+        las = read_laz(filepath, bbox=buffered)
+        las_info(las)
+    else:
+        las = store.las(bbox=buffered)
+    add_ground_dim(las)
 
-    gftin = GFTIN(las, cell_size, extent, debug=False)
-    _ = gftin.ground_filtering(dist_threshold, max_angle)
+    start = time.perf_counter()
+    gftin = GFTIN(las, cell_size, extent, debug=False, seeds=seeds)
+    _ = gftin.ground_filtering(dist_threshold, max_angle, mode)
+    runtime = time.perf_counter() - start
 
     x_valid = (extent[0] <= las.points.x) & (extent[3] >= las.points.x)
     y_valid = (extent[1] <= las.points.y) & (extent[4] >= las.points.y)
@@ -157,6 +268,8 @@ def benchmark(filepath, dist_threshold, max_angle, cell_size):
     f1_score = 2 * (precision * recall) / (precision + recall)
 
     print("=============benchmark==============")
+    print("mode", mode)
+    print("runtime", runtime, "s")
     print("true_positives: ", len(true_positives), " / ", len(points))
     print("true_negatives: ", len(true_negatives), " / ", len(points))
     print("false_positives: ", len(false_positives), " / ", len(points))
@@ -167,7 +280,7 @@ def benchmark(filepath, dist_threshold, max_angle, cell_size):
     print("f1_score", f1_score)
     print("====================================")
 
-    return (accuracy, f1_score)
+    return (accuracy, f1_score, runtime)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import math
+
+import numpy as np
+
+
+def grid_shape(bbox, cell_size):
+    """
+    Computes the number of rows and columns needed to cover a bounding box with square cells.
+
+    Args:
+        bbox (list): The bounding box [minx, miny, maxx, maxy].
+        cell_size (float): The size of each cell.
+
+    Returns:
+        tuple: The number of rows and columns (nrows, ncols).
+
+    """
+    ncols = max(int(math.ceil((bbox[2] - bbox[0]) / cell_size)), 0)
+    nrows = max(int(math.ceil((bbox[3] - bbox[1]) / cell_size)), 0)
+    return nrows, ncols
+
+
+def cell_keys(xy, origin, cell_size, shape, closed=False):
+    """
+    Computes the flat cell key (row * ncols + col) of every point in one pass.
+
+    Cells are ordered from the origin (lower left) row by row, which is the same order as the cell loops
+    used throughout the project. Points outside of the grid are dropped.
+
+    Args:
+        xy (numpy.ndarray): The point coordinates, shape (N, 2) or wider (only the first two columns are used).
+        origin (list): The lower left corner of the grid [minx, miny].
+        cell_size (float): The size of each cell.
+        shape (tuple): The number of rows and columns (nrows, ncols).
+        closed (bool, optional): Whether a cell includes its own boundary. When True, a point lying exactly on a
+            shared edge (or corner) is assigned to every cell touching it, like an inclusive bbox test per cell.
+            Defaults to False.
+
+    Returns:
+        tuple: The indices of the points (numpy.ndarray) and their cell keys (numpy.ndarray), both int64.
+
+    """
+    nrows, ncols = shape
+    fx = (xy[:, 0] - origin[0]) / cell_size
+    fy = (xy[:, 1] - origin[1]) / cell_size
+    col = np.floor(fx).astype(np.int64)
+    row = np.floor(fy).astype(np.int64)
+    indices = np.arange(len(xy), dtype=np.int64)
+
+    if closed:
+        # points on a shared edge also belong to the previous cell
+        on_x_edge = (col == fx) & (col > 0)
+        on_y_edge = (row == fy) & (row > 0)
+        on_corner = on_x_edge & on_y_edge
+        indices = np.concatenate(
+            (
+                indices,
+                indices[on_x_edge],
+                indices[on_y_edge],
+                indices[on_corner],
+            )
+        )
+        col = np.concatenate(
+            (col, col[on_x_edge] - 1, col[on_y_edge], col[on_corner] - 1)
+        )
+        row = np.concatenate(
+            (row, row[on_x_edge], row[on_y_edge] - 1, row[on_corner] - 1)
+        )
+
+    valid = (col >= 0) & (col < ncols) & (row >= 0) & (row < nrows)
+    return indices[valid], row[valid] * ncols + col[valid]
+
+
+def lowest_points_per_cell(values, indices, keys, num=1):
+    """
+    Selects the lowest num points of every cell.
+
+    Args:
+        values (numpy.ndarray): The value to rank the points by, e.g. z.
+        indices (numpy.ndarray): The indices of the points, as returned by cell_keys.
+        keys (numpy.ndarray): The cell keys of the points, as returned by cell_keys.
+        num (int, optional): The number of lowest points to keep per cell. Defaults to 1.
+
+    Returns:
+        numpy.ndarray: The indices of the selected points, ordered by cell key and then by ascending value.
+
+    """
+    if len(indices) == 0:
+        return np.empty(0, dtype=np.int64)
+    order = np.lexsort((values[indices], keys))
+    sorted_keys = keys[order]
+    # rank of every point within its own cell
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, len(sorted_keys)]))
+    rank = np.arange(len(sorted_keys)) - group_start
+    return indices[order[rank < num]]
+
+
+def max_per_cell(values, keys, size, fill):
+    """
+    Reduces the values of the points to the maximum of every cell with a single scatter.
+
+    Args:
+        values (numpy.ndarray): The values of the points, e.g. z.
+        keys (numpy.ndarray): The cell keys of the points, as returned by cell_keys.
+        size (int): The number of cells of the grid.
+        fill (float): The value of the cells without any point.
+
+    Returns:
+        numpy.ndarray: The flat grid of maxima as float32.
+
+    """
+    grid = np.full(size, -np.inf, dtype=np.float32)
+    np.maximum.at(grid, keys, values.astype(np.float32, copy=False))
+    grid[np.isneginf(grid)] = fill
+    return grid
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import instrument
+
+
+class StageCache:
+    """
+    Content-addressed cache of stage outputs.
+
+    Every output is keyed on a hash of the content of its input files and of the parameters of the stage, so a
+    changed input or parameter gives a new key and the stale output is never reused. A manifest in the cache
+    directory records what every entry was made from, and the content hashes of the input files so they are
+    only recomputed when a file changes. An output can be a file or a directory.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        max_bytes (int, optional): The maximum total size of the cached outputs. The least recently used entries
+            are evicted when it is exceeded. Defaults to None (no limit).
+
+    Attributes:
+        cache_dir (str): The directory of the cache.
+        max_bytes (int): The maximum total size of the cached outputs.
+        manifest_path (str): The path of the manifest.
+
+    Methods:
+        get_or_create(stage, inputs, params, create, suffix): Returns the cached output of a stage, creating it if needed.
+        lookup(stage, inputs, params): Returns the cached output of a stage if there is one.
+        output_path(stage, inputs, params, suffix): Returns the path the output of a stage is cached at.
+        record(stage, inputs, params, output_path): Records an output created at output_path in the manifest.
+        key(stage, inputs, params): Returns the cache key of a stage.
+        file_hash(file_path): Returns the content hash of a file.
+        evict(keep=()): Evicts the least recently used entries until the cache fits in max_bytes.
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._manifest = self._load_manifest()
+
+    def get_or_create(self, stage, inputs, params, create, suffix=""):
+        """
+        Returns the cached output of a stage, creating it if needed.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): The paths of the input files of the stage.
+            params (dict): The parameters of the stage. They must be JSON serializable.
+            create (callable): Called with an output path to create the output when it is not cached.
+            suffix (str, optional): The file extension of the output, e.g. ".las". Defaults to "".
+
+        Returns:
+            str: The path of the output in the cache.
+
+        """
+        path = self.lookup(stage, inputs, params)
+        if path is not None:
+            return path
+        output_path = self.output_path(stage, inputs, params, suffix)
+        create_atomically(create, output_path)
+        self.record(stage, inputs, params, output_path)
+        return output_path
+
+    def lookup(self, stage, inputs, params):
+        """
+        Returns the cached output of a stage if there is one.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): The paths of the input files of the stage.
+            params (dict): The parameters of the stage.
+
+        Returns:
+            str: The path of the output in the cache, or None if it is not cached.
+
+        """
+        entry = self._manifest["entries"].get(self.key(stage, inputs, params))
+        if entry is None or not os.path.exists(entry["path"]):
+            return None
+        instrument.log(f"==={stage}: reusing {entry['path']}===")
+        entry["last_used"] = time.time()
+        self._save_manifest()
+        return entry["path"]
+
+    def output_path(self, stage, inputs, params, suffix=""):
+        """
+        Returns the path the output of a stage is cached at.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): The paths of the input files of the stage.
+            params (dict): The parameters of the stage.
+            suffix (str, optional): The file extension of the output, e.g. ".las". Defaults to "".
+
+        Returns:
+            str: The path of the output in the cache.
+
+        """
+        key = self.key(stage, inputs, params)
+        return os.path.join(self.cache_dir, f"{stage}_{key[:16]}{suffix}")
+
+    def record(self, stage, inputs, params, output_path):
+        """
+        Records an output created at output_path in the manifest, and evicts old entries if needed.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): The paths of the input files of the stage.
+            params (dict): The parameters of the stage.
+            output_path (str): The path of the output, as returned by output_path.
+
+        """
+        key = self.key(stage, inputs, params)
+        instrument.log(f"==={stage}: created {output_path}===")
+        now = time.time()
+        self._manifest["entries"][key] = {
+            "stage": stage,
+            "inputs": [os.path.abspath(p) for p in inputs],
+            "params": params,
+            "path": output_path,
+            "size": _path_size(output_path),
+            "created": now,
+            "last_used": now,
+        }
+        self.evict(keep=(key,))
+        self._save_manifest()
+
+    def key(self, stage, inputs, params):
+        """
+        Returns the cache key of a stage.
+
+        Args:
+            stage (str): The name of the stage.
+            inputs (list): The paths of the input files of the stage.
+            params (dict): The parameters of the stage.
+
+        Returns:
+            str: The hex digest of the key.
+
+        """
+        description = json.dumps(
+            {
+                "stage": stage,
+                "inputs": [self.file_hash(p) for p in inputs],
+                "params": params,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def file_hash(self, file_path):
+        """
+        Returns the content hash of a file. It is only recomputed when the size or mtime of the file changes.
+
+        Args:
+            file_path (str): The path of the file.
+
+        Returns:
+            str: The hex digest of the SHA-256 of the file.
+
+        """
+        abs_path = os.path.abspath(file_path)
+        stat = os.stat(abs_path)
+        known = self._manifest["file_hashes"].get(abs_path)
+        if (
+            known is not None
+            and known["size"] == stat.st_size
+            and known["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return known["sha256"]
+
+        sha256 = hashlib.sha256()
+        with open(abs_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        self._manifest["file_hashes"][abs_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256.hexdigest(),
+        }
+        self._save_manifest()
+        return sha256.hexdigest()
+
+    def evict(self, keep=()):
+        """
+        Evicts the least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            keep (tuple, optional): The keys of the entries that must not be evicted. Defaults to ().
+
+        """
+        entries = self._manifest["entries"]
+        for key in [k for k, e in entries.items() if not os.path.exists(e["path"])]:
+            del entries[key]
+        if self.max_bytes is None:
+            return
+
+        total = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            entry = entries.pop(key)
+            _remove(entry["path"])
+            total -= entry["size"]
+            instrument.log(f"===evicted {entry['path']}===")
+
+    def _load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return {"entries": {}, "file_hashes": {}}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def create_atomically(create, output_path, *args):
+    """
+    Creates a file or directory under a temporary name and moves it to output_path once it is complete, so an
+    interrupted run never leaves a half written output behind.
+
+    Args:
+        create (callable): Called with the temporary path and args to create the file.
+        output_path (str): The path of the file or directory.
+        *args: The other arguments of create.
+
+    Returns:
+        str: The path of the file.
+
+    """
+    root, ext = os.path.splitext(output_path)
+    tmp_path = f"{root}.tmp{ext}"
+    create(tmp_path, *args)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _path_size(path):
+    """
+    Returns the size of a file, or the total size of the files in a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _remove(path):
+    """
+    Removes a file or a directory.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
@@ -0,0 +1,188 @@
+import json
+import os
+
+import config as cfg
+import laspy
+import numpy as np
+from cache import StageCache
+from ptio import bbox_mask, iter_laz, pack_header, unpack_las
+
+# the dimensions stored as columns of their own, scaled and decoded, next to the raw point records
+COLUMNS = (
+    "x",
+    "y",
+    "z",
+    "classification",
+    "return_number",
+    "number_of_returns",
+    "intensity",
+)
+
+
+def cached_columns(las_file, cache=None):
+    """
+    Returns the columnar copy of a LAS file, converting it on the first call.
+
+    Args:
+        las_file (str): The path of the LAS/LAZ file.
+        cache (StageCache, optional): The cache of the stage outputs. Defaults to the cache configured in config.py.
+
+    Returns:
+        str: The directory of the columns in the cache.
+    """
+    if cache is None:
+        cache = StageCache(cfg.CACHE_DIR, cfg.CACHE_MAX_BYTES)
+    return cache.get_or_create(
+        "columns",
+        [las_file],
+        {"columns": COLUMNS},
+        lambda output_dir: write_columns(las_file, output_dir),
+        ".columns",
+    )
+
+
+def write_columns(las_file, output_dir, chunk_size=1_000_000):
+    """
+    Converts a LAS/LAZ file into one .npy file per dimension.
+
+    The file is decoded once, in chunks. Every field of the point records is written to records/<field>.npy, so
+    the points can be rebuilt exactly, and the dimensions of COLUMNS are written scaled and decoded to
+    <dimension>.npy, e.g. x.npy as float64.
+
+    Args:
+        las_file (str): The path of the LAS/LAZ file.
+        output_dir (str): The directory of the columns.
+        chunk_size (int, optional): The number of points decoded per chunk. Defaults to 1_000_000.
+    """
+    with laspy.open(las_file, "r") as f:
+        header = f.header
+        count = header.point_count
+    record_dtype = header.point_format.dtype()
+    os.makedirs(os.path.join(output_dir, "records"), exist_ok=True)
+
+    records = {
+        name: _open_column(output_dir, f"records/{name}", record_dtype[name], count)
+        for name in record_dtype.names
+    }
+    columns = {}
+    start = 0
+    for chunk in iter_laz(las_file, chunk_size):
+        end = start + len(chunk)
+        for name, column in records.items():
+            column[start:end] = chunk.array[name]
+        for dim in COLUMNS:
+            values = np.asarray(chunk[dim])
+            if dim not in columns:
+                columns[dim] = _open_column(output_dir, dim, values.dtype, count)
+            columns[dim][start:end] = values
+        start = end
+    for column in [*records.values(), *columns.values()]:
+        column.flush()
+
+    meta = {
+        **pack_header(header),
+        "count": count,
+        "record_dtype": record_dtype.descr,
+    }
+    meta["scales"] = list(meta["scales"])
+    meta["offsets"] = list(meta["offsets"])
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def _open_column(output_dir, name, dtype, count):
+    """
+    Creates the .npy file of a column, memory mapped for writing.
+    """
+    return np.lib.format.open_memmap(
+        os.path.join(output_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=(count,)
+    )
+
+
+class Columns:
+    """
+    The columns written by write_columns, memory mapped without reading them.
+
+    Every column is a read-only np.memmap of its .npy file, so opening the columns costs no decoding, only the
+    pages that are used are read, and processes opening the same columns share the pages of the OS cache.
+
+    Args:
+        directory (str): The directory of the columns.
+
+    Attributes:
+        header (laspy.LasHeader): The header of the points.
+        x (numpy.memmap): The scaled x coordinates, like the other dimensions of COLUMNS.
+
+    Methods:
+        bbox_indices(bbox): Returns the indices of the points within a bounding box.
+        xyz(indices=None): Returns the scaled coordinates as an (N, 3) array.
+        las(indices=None): Rebuilds the points, or a part of them, as a LAS.
+
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self._count = meta["count"]
+        self._record_dtype = np.dtype([tuple(field) for field in meta["record_dtype"]])
+        self._records = {
+            name: self._open(directory, f"records/{name}")
+            for name in self._record_dtype.names
+        }
+        for dim in COLUMNS:
+            setattr(self, dim, self._open(directory, dim))
+        self._packed_header = meta
+        self.header = unpack_las(
+            {**meta, "array": np.zeros(0, dtype=self._record_dtype)}
+        ).header
+
+    def __len__(self):
+        return self._count
+
+    def _open(self, directory, name):
+        """
+        Opens the .npy file of a column as a read-only memory map.
+        """
+        return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+    def bbox_indices(self, bbox):
+        """
+        Returns the indices of the points within a bounding box. The bounds are inclusive.
+
+        Args:
+            bbox (list): The bounding box [minx, miny, minz, maxx, maxy, maxz] or [minx, miny, maxx, maxy].
+
+        Returns:
+            numpy.ndarray: The indices of the points, in ascending order.
+        """
+        return np.flatnonzero(bbox_mask(self, bbox))
+
+    def xyz(self, indices=None):
+        """
+        Returns the scaled coordinates, like laspy.LasData.xyz.
+
+        Args:
+            indices (numpy.ndarray, optional): Only return the points at these indices. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The coordinates, shape (N, 3).
+        """
+        if indices is None:
+            return np.column_stack((self.x, self.y, self.z))
+        return np.column_stack((self.x[indices], self.y[indices], self.z[indices]))
+
+    def las(self, indices=None):
+        """
+        Rebuilds the points, or a part of them, as a LAS. The points are copied out of the columns.
+
+        Args:
+            indices (numpy.ndarray, optional): Only return the points at these indices. Defaults to None.
+
+        Returns:
+            laspy.LasData: The points.
+        """
+        count = self._count if indices is None else len(indices)
+        array = np.empty(count, dtype=self._record_dtype)
+        for name, column in self._records.items():
+            array[name] = column if indices is None else column[indices]
+        return unpack_las({**self._packed_header, "array": array})
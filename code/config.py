@@ -15,6 +15,26 @@
 # STEP5_OUTPUT = "./data/chm.tiff"
 # BENCHMARK_OUT_DIR = "./data/figure"
 # DEBUG_DATA_DIR = "./data/debug"
+# GFTIN_DENSIFICATION = "sequential"  # "sequential" or "batched"
+# DTM_TILE_SIZE = 100  # meters, None to process the extent as one piece
+# DTM_TILE_OVERLAP = None  # meters, None for twice the GFTIN cell size
+# DTM_WORKERS = None  # None to use all CPUs
+# DTM_INTERPOLATION = "laplace"  # "laplace", "linear" (faster) or "nearest" (fastest)
+# DBSCAN_ENGINE = "native"  # "native" or "pdal"
+# DBSCAN_TILE_SIZE = 100  # meters, None to cluster the extent as one piece
+# DBSCAN_WORKERS = None  # None to use all CPUs
+# THINNING_PARAMS = {"mode": "nth", "n": 2}  # see preprocess.thinning
+# OUTLIER_PARAMS = {"nb_neighbors": 10, "std_ratio": 2.0}
+# CACHE_DIR = "./data/cache"
+# CACHE_MAX_BYTES = 20 * 1024**3  # None for no limit
+# PERF_SIZES = [50, 100, 250, 500]  # meters, side lengths timed by perf_benchmark.py
+# PERF_BASELINE = "./data/perf_baseline.json"
+# PERF_REGRESSION_THRESHOLD = 0.2  # allowed slowdown compared to the baseline
+# VERBOSITY = 1  # 0: quiet, 1: progress and summaries, 2: debugging details
+# PROGRESS_INTERVAL = 10  # seconds between two progress reports of a loop
+# TRACE_MEMORY = False  # record the peak memory of every stage with tracemalloc (slower)
+# RUN_REPORT = "./data/run_report.json"
+# RASTER_COG = True  # write the rasters as Cloud-Optimized GeoTIFFs
 ######################### for production #########################
 
 ######################### for testing #########################
@@ -37,4 +57,24 @@ STEP4_OUTPUT = "./data/tiny_step4.tiff"
 STEP5_OUTPUT = "./data/tiny_chm.tiff"
 BENCHMARK_OUT_DIR = "./data/figure"
 DEBUG_DATA_DIR = "./data/debug"
+GFTIN_DENSIFICATION = "sequential"  # "sequential" or "batched"
+DTM_TILE_SIZE = None  # meters, None to process the extent as one piece
+DTM_TILE_OVERLAP = None  # meters, None for twice the GFTIN cell size
+DTM_WORKERS = None  # None to use all CPUs
+DTM_INTERPOLATION = "laplace"  # "laplace", "linear" (faster) or "nearest" (fastest)
+DBSCAN_ENGINE = "native"  # "native" or "pdal"
+DBSCAN_TILE_SIZE = None  # meters, None to cluster the extent as one piece
+DBSCAN_WORKERS = None  # None to use all CPUs
+THINNING_PARAMS = {"mode": "nth", "n": 2}  # see preprocess.thinning
+OUTLIER_PARAMS = {"nb_neighbors": 10, "std_ratio": 2.0}
+CACHE_DIR = "./data/cache"
+CACHE_MAX_BYTES = 20 * 1024**3  # None for no limit
+PERF_SIZES = [25, 50, 100]  # meters, side lengths timed by perf_benchmark.py
+PERF_BASELINE = "./data/perf_baseline.json"
+PERF_REGRESSION_THRESHOLD = 0.2  # allowed slowdown compared to the baseline
+VERBOSITY = 1  # 0: quiet, 1: progress and summaries, 2: debugging details
+PROGRESS_INTERVAL = 5  # seconds between two progress reports of a loop
+TRACE_MEMORY = False  # record the peak memory of every stage with tracemalloc (slower)
+RUN_REPORT = "./data/run_report.json"
+RASTER_COG = False  # write the rasters as Cloud-Optimized GeoTIFFs
 ######################### for testing #########################
@@ -0,0 +1,327 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from binning import cell_keys, grid_shape
+from spatial_index import GridIndex, concatenate_ranges
+
+# the number of query points handled at once by the neighbour search, to bound the memory of the candidate pairs
+BATCH_SIZE = 50_000
+
+
+def dbscan(points, eps, min_points, tile_size=None, workers=None):
+    """
+    Clusters points with DBSCAN, with the same semantics as PDAL filters.dbscan.
+
+    A point is a core point when at least min_points points (itself included) lie within eps of it. Core points
+    within eps of each other belong to the same cluster, and a border point (not core, but within eps of a core
+    point) joins the cluster of its core neighbour with the smallest index. The other points are noise.
+
+    The neighbours are found on a uniform grid of eps sized cells, so only the 27 cells around a point are
+    searched. With tile_size, the xy extent is split into tiles clustered in parallel: every tile also gets
+    the points within eps around it (its halo), first to compute exact core flags for its own points, then to
+    link its clusters to the core points of the neighbouring tiles. The clusters of all tiles are merged
+    through these shared core points, so the result does not depend on the tiling.
+
+    Args:
+        points (numpy.ndarray): The point coordinates, shape (N, 3) (or (N, 2) to cluster in 2D).
+        eps (float): The maximum distance between neighbours (inclusive).
+        min_points (int): The minimum number of points in the neighbourhood of a core point.
+        tile_size (float, optional): The size of the tiles in the units of the points. The points are clustered
+            as one piece when None. Defaults to None.
+        workers (int, optional): The number of worker processes for the tiles. Defaults to the number of CPUs.
+
+    Returns:
+        numpy.ndarray: The cluster ID of every point (int64), -1 for noise. The clusters are numbered from 0 in
+        the order of their first core point.
+
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    tiles = _split_into_tiles(points, eps, tile_size)
+    if len(tiles) == 1:
+        owned = tiles[0][0]
+        core = _core_flags(points, owned, eps, min_points)
+        roots, border_core = _tile_components(points, core, owned, eps)
+        return _relabel(n, [(owned, owned, roots, border_core)], core)
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # phase 1: exact core flags of the points owned by every tile
+        core = np.zeros(n, dtype=bool)
+        futures = [
+            (
+                owned,
+                executor.submit(
+                    _core_flags,
+                    points[subset],
+                    np.searchsorted(subset, owned),
+                    eps,
+                    min_points,
+                ),
+            )
+            for owned, subset in tiles
+        ]
+        for owned, future in futures:
+            core[owned] = future.result()
+
+        # phase 2: clusters of every tile, including the core points of its halo
+        futures = [
+            (
+                owned,
+                subset,
+                executor.submit(
+                    _tile_components,
+                    points[subset],
+                    core[subset],
+                    np.searchsorted(subset, owned),
+                    eps,
+                ),
+            )
+            for owned, subset in tiles
+        ]
+        results = [
+            (owned, subset, roots, border_core)
+            for owned, subset, future in futures
+            for roots, border_core in [future.result()]
+        ]
+    return _relabel(n, results, core)
+
+
+def _split_into_tiles(points, eps, tile_size):
+    """
+    Splits the points into square tiles in xy.
+
+    Args:
+        points (numpy.ndarray): The point coordinates.
+        eps (float): The width of the halo around every tile.
+        tile_size (float): The size of the tiles, None for a single tile.
+
+    Returns:
+        list: The indices of the points owned by every tile and of the points of the tile with its halo
+        [(owned, subset), ...], both in ascending order.
+
+    """
+    all_indices = np.arange(len(points))
+    if tile_size is None:
+        return [(all_indices, all_indices)]
+
+    origin = points[:, :2].min(axis=0)
+    maxs = points[:, :2].max(axis=0)
+    shape = grid_shape([*origin, *maxs], tile_size)
+    # the points on the maximum edge fall in one more row or column
+    shape = (shape[0] + 1, shape[1] + 1)
+    indices, keys = cell_keys(points, origin, tile_size, shape)
+    order = np.argsort(keys, kind="stable")
+    starts = np.searchsorted(keys[order], np.arange(shape[0] * shape[1] + 1))
+
+    index = GridIndex(points[:, :2])
+    tiles = []
+    for key in range(shape[0] * shape[1]):
+        owned = np.sort(indices[order[starts[key] : starts[key + 1]]])
+        if len(owned) == 0:
+            continue
+        row, col = divmod(key, shape[1])
+        minx = origin[0] + col * tile_size
+        miny = origin[1] + row * tile_size
+        subset = index.query_bbox(
+            [minx - eps, miny - eps, minx + tile_size + eps, miny + tile_size + eps]
+        )
+        tiles.append((owned, subset))
+    return tiles
+
+
+def _neighbour_pairs(points, eps, query):
+    """
+    Yields the pairs of distinct points within eps of each other, in batches.
+
+    Args:
+        points (numpy.ndarray): The point coordinates.
+        eps (float): The maximum distance between neighbours (inclusive).
+        query (numpy.ndarray): The indices of the points to find the neighbours of.
+
+    Yields:
+        tuple: The indices of the query points (numpy.ndarray) and of their neighbours (numpy.ndarray).
+
+    """
+    # cells are padded by one on every side, so the keys of the neighbouring cells never wrap around
+    cells = np.floor((points - points.min(axis=0)) / eps).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = np.zeros(len(points), dtype=np.int64)
+    for axis in range(points.shape[1]):
+        keys = keys * dims[axis] + cells[:, axis]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_points = points[order]
+
+    offsets = []
+    for offset in itertools.product((-1, 0, 1), repeat=points.shape[1]):
+        key = 0
+        for axis, step in enumerate(offset):
+            key = key * dims[axis] + step
+        offsets.append(key)
+
+    # the query points are visited cell by cell, so every cell is only searched once per batch
+    query = query[np.argsort(keys[query], kind="stable")]
+    eps2 = eps * eps
+    for batch in np.array_split(query, max(len(query) // BATCH_SIZE, 1)):
+        batch_keys = keys[batch]
+        first = np.flatnonzero(np.r_[True, batch_keys[1:] != batch_keys[:-1]])
+        cell_of_point = np.repeat(
+            np.arange(len(first)), np.diff(np.r_[first, len(batch)])
+        )
+        for offset in offsets:
+            neighbour_keys = batch_keys[first] + offset
+            starts = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+            ends = np.searchsorted(sorted_keys, neighbour_keys, side="right")
+            starts, ends = starts[cell_of_point], ends[cell_of_point]
+            i = np.repeat(batch, ends - starts)
+            j = concatenate_ranges(starts, ends)
+            d2 = ((points[i] - sorted_points[j]) ** 2).sum(axis=1)
+            j = order[j]
+            keep = (d2 <= eps2) & (i != j)
+            yield i[keep], j[keep]
+
+
+def _core_flags(points, query, eps, min_points):
+    """
+    Computes whether the query points are core points. This runs in a worker process when tiled.
+
+    Args:
+        points (numpy.ndarray): The point coordinates, including every neighbour of the query points.
+        query (numpy.ndarray): The indices of the points to compute the flag of.
+        eps (float): The maximum distance between neighbours (inclusive).
+        min_points (int): The minimum number of points in the neighbourhood of a core point.
+
+    Returns:
+        numpy.ndarray: Whether every query point is a core point.
+
+    """
+    counts = np.ones(len(points), dtype=np.int64)  # every point is its own neighbour
+    for i, _ in _neighbour_pairs(points, eps, query):
+        counts += np.bincount(i, minlength=len(points))
+    return counts[query] >= min_points
+
+
+def _tile_components(points, core, query, eps):
+    """
+    Finds the connected components of the core points linked to the query points. This runs in a worker
+    process when tiled.
+
+    Args:
+        points (numpy.ndarray): The point coordinates, including every neighbour of the query points.
+        core (numpy.ndarray): Whether every point is a core point.
+        query (numpy.ndarray): The indices of the points owned by the tile.
+        eps (float): The maximum distance between neighbours (inclusive).
+
+    Returns:
+        tuple: The root of the component of every point (numpy.ndarray, the point itself when it is not linked),
+        and the core neighbour with the smallest index of every query point (numpy.ndarray, -1 if none).
+
+    """
+    n = len(points)
+    roots = np.arange(n)
+    nearest_core = np.full(n, n)
+    for i, j in _neighbour_pairs(points, eps, query):
+        linked = core[i] & core[j]
+        roots = _union(roots, i[linked], j[linked])
+        np.minimum.at(nearest_core, i[core[j]], j[core[j]])
+    roots = _compress(roots)
+    border_core = nearest_core[query]
+    border_core[border_core == n] = -1
+    return roots, border_core
+
+
+def _union(roots, a, b):
+    """
+    Merges the components of the pairs (a, b) by propagating the smallest root, without a Python loop per edge.
+
+    Only the paths of the nodes of the pairs are compressed, so a phase calling _union for many batches of pairs
+    compresses the whole array once at its end with _compress.
+
+    Args:
+        roots (numpy.ndarray): The parent of every node, updated in place. Every root points to itself.
+        a (numpy.ndarray): The first node of every edge.
+        b (numpy.ndarray): The second node of every edge.
+
+    Returns:
+        numpy.ndarray: The updated parents. The root of every component is its smallest node.
+
+    """
+    while len(a):
+        root_a, root_b = _find(roots, a), _find(roots, b)
+        roots[a] = root_a
+        roots[b] = root_b
+        differ = root_a != root_b
+        if not differ.any():
+            break
+        a, b, root_a, root_b = a[differ], b[differ], root_a[differ], root_b[differ]
+        # hook the larger root under the smaller one
+        smallest = np.minimum(root_a, root_b)
+        np.minimum.at(roots, root_a, smallest)
+        np.minimum.at(roots, root_b, smallest)
+    return roots
+
+
+def _find(roots, nodes):
+    """
+    Follows the parents of some nodes up to their roots.
+    """
+    found = roots[nodes]
+    while True:
+        parents = roots[found]
+        if np.array_equal(parents, found):
+            return found
+        found = parents
+
+
+def _compress(roots):
+    """
+    Points every node directly to its root.
+
+    Args:
+        roots (numpy.ndarray): The parent of every node, as updated by _union.
+
+    Returns:
+        numpy.ndarray: The root of every node.
+
+    """
+    while True:
+        compressed = roots[roots]
+        if np.array_equal(compressed, roots):
+            return roots
+        roots = compressed
+
+
+def _relabel(n, results, core):
+    """
+    Merges the components of the tiles into clusters and numbers them.
+
+    Args:
+        n (int): The number of points.
+        results (list): The indices of the points owned by every tile, of the points of the tile with its halo,
+            the roots and the border core neighbours returned by _tile_components [(owned, subset, roots,
+            border_core), ...].
+        core (numpy.ndarray): Whether every point is a core point.
+
+    Returns:
+        numpy.ndarray: The cluster ID of every point, -1 for noise.
+
+    """
+    # every core point of a tile, halo included, is linked to the root of its component in that tile,
+    # which joins the components of tiles sharing a core point
+    a = np.concatenate([subset[core[subset]] for _, subset, _, _ in results])
+    b = np.concatenate([subset[roots[core[subset]]] for _, subset, roots, _ in results])
+    roots = _compress(_union(np.arange(n), a, b))
+
+    labels = np.full(n, -1, dtype=np.int64)
+    core_indices = np.flatnonzero(core)
+    # the root is the smallest core point of a cluster, so the order of the roots is the order of the clusters
+    _, labels[core_indices] = np.unique(roots[core_indices], return_inverse=True)
+    for owned, subset, _, border_core in results:
+        border = ~core[owned] & (border_core != -1)
+        labels[owned[border]] = labels[subset[border_core[border]]]
+    return labels
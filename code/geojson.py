@@ -1,44 +1,155 @@
-import json
+import functools
 
 import numpy as np
-from pyproj import Proj, Transformer
-
-
-def write_geojson(filepath, points, src_crs=None, target_crs=None):
-    """
-    points: [[x, y, z], ...]
-    """
-    points = transform_points(points, src_crs, target_crs)
-    geojson = {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {"type": "Point", "coordinates": (point[0], point[1])},
-                "properties": {
-                    "z": point[2] if len(point) == 3 else None,
-                },
-            }
-            for point in points
-        ],
-    }
+from pyproj import Transformer
+
+# the number of features formatted and written at a time
+CHUNK_SIZE = 100_000
+
+
+def write_geojson(
+    filepath, points, src_crs=None, target_crs=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Writes points as a GeoJSON FeatureCollection of Point features, with z as a property.
+
+    The points are transformed and formatted chunk by chunk and the features are streamed to the file, so the
+    whole collection is never built in memory.
+
+    Args:
+        filepath (str): The path of the GeoJSON file.
+        points (numpy.ndarray): The points [[x, y, z], ...] or [[x, y], ...].
+        src_crs (str, optional): The CRS of the points, e.g. "epsg:28992". Defaults to None.
+        target_crs (str, optional): The CRS of the file, e.g. "epsg:4326". Defaults to None, which writes the
+            points untransformed.
+        chunk_size (int, optional): The number of features formatted at a time. Defaults to CHUNK_SIZE.
+    """
+    points = np.asarray(points, dtype=np.float64)
+
+    def chunks():
+        for start in range(0, len(points), chunk_size):
+            coords = _format(
+                transform_points(
+                    points[start : start + chunk_size], src_crs, target_crs
+                )
+            )
+            zs = coords[:, 2] if coords.shape[1] > 2 else np.full(len(coords), "null")
+            yield [
+                '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%s, %s]}, '
+                '"properties": {"z": %s}}' % (x, y, z)
+                for x, y, z in zip(coords[:, 0], coords[:, 1], zs)
+            ]
+
+    _write_features(filepath, chunks())
+
+
+def write_triangles_geojson(
+    filepath, vertices, triangles, src_crs=None, target_crs=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Writes triangles as a GeoJSON FeatureCollection of Polygon features, e.g. the triangles of a TIN.
+
+    The vertices are transformed once, and the triangles are formatted chunk by chunk and streamed to the file.
+    The polygons have the z of the vertices as third coordinate, and the index of the triangle as property.
+
+    Args:
+        filepath (str): The path of the GeoJSON file.
+        vertices (numpy.ndarray): The vertices, shape (N, 3) or (N, 2).
+        triangles (numpy.ndarray): The vertex indices of the triangles, shape (M, 3).
+        src_crs (str, optional): The CRS of the vertices, e.g. "epsg:28992". Defaults to None.
+        target_crs (str, optional): The CRS of the file, e.g. "epsg:4326". Defaults to None, which writes the
+            vertices untransformed.
+        chunk_size (int, optional): The number of features formatted at a time. Defaults to CHUNK_SIZE.
+    """
+    positions = _format(transform_points(vertices, src_crs, target_crs))
+    positions = np.array(["[" + ", ".join(p) + "]" for p in positions], dtype=object)
+    triangles = np.asarray(triangles)
+
+    def chunks():
+        for start in range(0, len(triangles), chunk_size):
+            rings = positions[triangles[start : start + chunk_size]]
+            yield [
+                '{"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[%s, %s, %s, %s]]}, '
+                '"properties": {"id": %d}}' % (a, b, c, a, i)
+                for i, (a, b, c) in enumerate(rings, start)
+            ]
+
+    _write_features(filepath, chunks())
+
+
+def _write_features(filepath, chunks):
+    """
+    Writes a FeatureCollection from chunks of features, each feature already formatted as a JSON string.
+    """
     with open(filepath, "w") as f:
-        json.dump(geojson, f)
+        f.write('{"type": "FeatureCollection", "features": [')
+        separator = ""
+        for features in chunks:
+            if features:
+                f.write(separator)
+                f.write(", ".join(features))
+                separator = ", "
+        f.write("]}")
+
+
+def _format(points):
+    """
+    Formats coordinates as JSON numbers, all at once. Coordinates that are not finite are written as null.
+    """
+    formatted = points.astype(str).astype(object)
+    formatted[~np.isfinite(points)] = "null"
+    return formatted
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_crs, target_crs):
+    """
+    Returns the transformer between two CRS. The transformers are cached, so they are only created once.
+
+    Args:
+        src_crs (str): The source CRS, e.g. "epsg:28992".
+        target_crs (str): The target CRS, e.g. "epsg:4326".
+
+    Returns:
+        pyproj.Transformer: The transformer, taking and returning x (or longitude) first.
+    """
+    return Transformer.from_crs(src_crs, target_crs, always_xy=True)
 
 
 def transform_points(points, src_crs=None, target_crs=None):
-    if src_crs is None or target_crs is None:
-        return []
-    source_crs = Proj(init=src_crs)
-    destination_crs = Proj(init=target_crs)
-    transformer = Transformer.from_proj(source_crs, destination_crs)
-    pts = np.array(list(transformer.itransform(points)), dtype=np.float64)
-    return pts
+    """
+    Transforms points between two CRS, all at once.
+
+    Args:
+        points (numpy.ndarray): The points, shape (N, 3) or (N, 2).
+        src_crs (str, optional): The source CRS. Defaults to None.
+        target_crs (str, optional): The target CRS. Defaults to None, which returns the points untransformed.
+
+    Returns:
+        numpy.ndarray: The transformed points, float64 with the shape of points.
+    """
+    points = np.array(points, dtype=np.float64)
+    if src_crs is None or target_crs is None or len(points) == 0:
+        return points
+    transformed = get_transformer(src_crs, target_crs).transform(*points.T[:3])
+    points[:, : len(transformed)] = np.column_stack(transformed)
+    return points
 
 
 def transform_triangles(triangles, src_crs=None, target_crs=None):
-    if src_crs is not None and target_crs is not None:
-        source_crs = Proj(init=src_crs)
-        destination_crs = Proj(init=target_crs)
-        transformer = Transformer.from_proj(source_crs, destination_crs)
-        triangles = np.array(list(transformer.itransform(triangles)), dtype=np.float64)
+    """
+    Transforms the vertices of triangles between two CRS, all at once.
+
+    Args:
+        triangles (numpy.ndarray): The vertices of the triangles, shape (M, 3, 3) or (M, 3, 2).
+        src_crs (str, optional): The source CRS. Defaults to None.
+        target_crs (str, optional): The target CRS. Defaults to None, which returns the triangles untransformed.
+
+    Returns:
+        numpy.ndarray: The transformed triangles, float64 with the shape of triangles.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    vertices = transform_points(
+        triangles.reshape(-1, triangles.shape[-1]), src_crs, target_crs
+    )
+    return vertices.reshape(triangles.shape)
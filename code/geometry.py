@@ -0,0 +1,91 @@
+import numpy as np
+
+
+def triangle_tests(tris, ps, dtype=np.float64):
+    """
+    Projects points on the planes of their triangles and measures them against the triangles, in one call.
+
+    This is the geometry of the GFTIN ground test: the vertical projection of every point on the plane of its
+    triangle, the distance between the point and that plane, the angle at every vertex between the point and
+    the plane, and the residual of the point in the plane equation, which tells the points on the plane apart.
+    The distances and angles are measured along the normal of the plane, like the ground test always has,
+    because they describe how far the point is from the surface whatever its slope; the vertical projection is
+    the point of the surface at the same x and y, e.g. to compare heights.
+
+    Args:
+        tris (numpy.ndarray): The vertices of the triangles, shape (N, 3, 3).
+        ps (numpy.ndarray): The points, shape (N, 3).
+        dtype (numpy.dtype, optional): The precision of the computation, np.float64 or np.float32. The
+            coordinates are taken relative to the first vertex of every triangle in float64 first, so float32
+            stays accurate on large projected coordinates. Defaults to np.float64.
+
+    Returns:
+        tuple: The vertical projections (numpy.ndarray (N, 3), float64), the distances to the planes
+        (numpy.ndarray (N,)), the angles in degrees at the three vertices (numpy.ndarray (N, 3)) and the
+        residuals n · (p - a) (numpy.ndarray (N,)), with a the first vertex and n the cross product of the edges
+        from a, 0 on the plane. The results are NaN for degenerate triangles, and the vertical projections for
+        vertical planes.
+
+    """
+    a, edges, rel = _to_local(tris, ps, dtype)
+    n, residuals, t, projections = _project(edges, rel)
+    distances = np.abs(t) * np.sqrt(np.einsum("ij,ij->i", n, n))
+    angles = _vertex_angles(edges, projections, rel)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = -(n[:, 0] * rel[:, 0] + n[:, 1] * rel[:, 1]) / n[:, 2]
+    return a + np.column_stack((rel[:, 0], rel[:, 1], z)), distances, angles, residuals
+
+
+def _to_local(tris, ps, dtype):
+    """
+    Moves the triangles and points to the first vertex of every triangle, and converts them to dtype.
+
+    Returns:
+        tuple: The first vertices (float64, (N, 3)), the two edges from the first vertex ((N, 2, 3)) and the
+        points relative to the first vertex ((N, 3)).
+
+    """
+    tris = np.asarray(tris, dtype=np.float64)
+    a = tris[:, 0]
+    edges = (tris[:, 1:] - a[:, None]).astype(dtype, copy=False)
+    rel = (np.asarray(ps, dtype=np.float64) - a).astype(dtype, copy=False)
+    return a, edges, rel
+
+
+def _project(edges, rel):
+    """
+    Projects local points on the planes through the origin spanned by the edges.
+
+    Returns:
+        tuple: The normals, the residuals n · rel, the signed distances along the normals in units of the normal
+        length, and the projections.
+
+    """
+    n = np.cross(edges[:, 0], edges[:, 1])
+    residuals = np.einsum("ij,ij->i", n, rel)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = -residuals / np.einsum("ij,ij->i", n, n)
+    return n, residuals, t, rel + t[:, None] * n
+
+
+def _vertex_angles(edges, projections, rel):
+    """
+    Computes the angle at every vertex between its vector to the projection and its vector to the point.
+
+    The projection and the point form a right angle with the plane, so the angle at a vertex v is
+    acos(|v - projection| / |v - point|).
+
+    Returns:
+        numpy.ndarray: The angles in degrees, shape (N, 3). 0 where the vertex is on the projection or the point.
+
+    """
+    zeros = np.zeros_like(rel)
+    angles = np.empty((len(rel), 3), dtype=rel.dtype)
+    for k, v in enumerate((zeros, edges[:, 0], edges[:, 1])):
+        to_projection = np.sqrt(np.einsum("ij,ij->i", v - projections, v - projections))
+        to_point = np.sqrt(np.einsum("ij,ij->i", v - rel, v - rel))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos_a = np.clip(to_projection / to_point, -1, 1)
+        angles[:, k] = np.degrees(np.arccos(cos_a))
+        angles[(to_projection == 0) | (to_point == 0), k] = 0
+    return angles
@@ -1,11 +1,18 @@
-import math
 import os
 
 import config as cfg
+import instrument
 import numpy as np
-from geojson import write_geojson
+from binning import cell_keys, grid_shape, lowest_points_per_cell
+from geojson import write_geojson, write_triangles_geojson
+from geometry import triangle_tests
+from spatial_index import GridIndex, TriangleIndex
 from startinpy import DT
 
+DENSIFICATION_MODES = ("sequential", "batched")
+# the residual in the plane equation of a triangle below which a point lies on the triangle and is not accepted
+ON_PLANE_TOLERANCE = 1e-6
+
 
 class GFTIN:
     """
@@ -21,22 +28,25 @@ class GFTIN:
         bbox (list): The bounding box of the area of interest. [minx, miny, minz, maxx, maxy, maxz]
         dt (DT): The Delaunay Triangulation object.
         debug (bool): Flag indicating whether to enable debug mode.
+        seeds (numpy.ndarray): The points of the initial TIN.
 
     Methods:
-        ground_filtering(dist_threshold=5, max_angle=30): Performs ground filtering on the LAS points.
-        _angle_between_two_vectors(a, b, c): Calculates the angle between two vectors.
-        _intersection_point_of_triangle(tri, p): Calculates the intersection point of a triangle and a vertical line.
+        ground_filtering(dist_threshold=5, max_angle=30, mode="sequential", dtype=np.float64): Performs ground filtering on the LAS points.
+        _sequential_densification(points, xyz_points, dist_threshold, max_angle, dtype): Tests and inserts the points one by one.
+        _batched_densification(points, xyz_points, dist_threshold, max_angle, dtype): Progressive densification in rounds.
+        _locate_triangles(xy): Locates the triangles containing the given points.
         _construct_initial_tin(): Constructs the initial TIN using the lowest points in each cell.
-        _extract_lowest_points(): Extracts the lowest points in each cell.
-        _find_lowest_point_in_a_cell(cell, num=1): Finds the lowest point(s) in a cell.
+        _extract_lowest_points(num=1): Extracts the lowest points in each cell.
+        _grid_bbox(): Returns the extent covered by the cells.
         _divide_extent_by_cell_size(): Divides the extent of the bounding box into cells.
         point_indices_in_bbox(): Returns the indices of the points within the bounding box.
+        _spatial_index(): Returns the spatial index over the LAS points.
         triangle_convex_hull_points(): Returns the points forming the convex hull of the TIN.
-        write_tin_geojson(file_path): Writes the TIN to a GeoJSON file.
+        write_tin_geojson(file_path, triangles=False): Writes the vertices or triangles of the TIN to a GeoJSON file.
 
     """
 
-    def __init__(self, las, cell_size, bbox, debug=False):
+    def __init__(self, las, cell_size, bbox, debug=False, seeds=None):
         """
         Initializes a GFTIN object.
 
@@ -45,6 +55,8 @@ class GFTIN:
             cell_size (float): The size of each cell in the grid.
             bbox (list): The bounding box of the area of interest. [minx, miny, minz, maxx, maxy, maxz]
             debug (bool, optional): Flag indicating whether to enable debug mode. Defaults to False.
+            seeds (numpy.ndarray, optional): The points of the initial TIN, e.g. the seeds of another GFTIN with
+                the same points, cell size and bbox. Defaults to None (the lowest points of every cell).
 
         Raises:
             ValueError: If las is None, cell_size is not positive, or bbox does not have 6 elements.
@@ -61,25 +73,82 @@ class GFTIN:
         self.bbox = bbox  # [minx, miny, minz, maxx, maxy, maxz]
         self.dt = DT()
         self.debug = debug
-        self._construct_initial_tin()
+        self._index = None
+        self.seeds = seeds
+        with instrument.stage("gftin_seeding"):
+            self._construct_initial_tin()
         if self.debug is True:
             self.write_tin_geojson(os.path.join(cfg.DEBUG_DATA_DIR, "startin.geojson"))
 
-    def ground_filtering(self, dist_threshold=5, max_angle=30):
+    def ground_filtering(
+        self, dist_threshold=5, max_angle=30, mode="sequential", dtype=np.float64
+    ):
         """
         Performs ground filtering on the LAS points.
 
         Args:
             dist_threshold (float, optional): The distance threshold for classifying points as ground. Defaults to 5.
             max_angle (float, optional): The maximum angle (in degrees) between the normal vector of a triangle and the vertical direction for classifying points as ground. Defaults to 30.
+            mode (str, optional): The densification mode, "sequential" (one point at a time) or "batched" (in rounds). Defaults to "sequential".
+            dtype (numpy.dtype, optional): The precision of the geometric tests, np.float64 or np.float32. Defaults to np.float64.
+
+        Raises:
+            ValueError: If mode is not one of DENSIFICATION_MODES.
 
         Returns:
             numpy.ndarray: The ground points.
 
         """
-        points = self.las.points[self.point_indices_in_bbox()]
-        xyz_points = self.las.xyz[self.point_indices_in_bbox()]
+        if mode not in DENSIFICATION_MODES:
+            raise ValueError(f"mode must be one of {DENSIFICATION_MODES}")
+        indices = self.point_indices_in_bbox()
+        points = self.las.points[indices]
+        xyz_points = self._spatial_index().points[indices]
+        with instrument.stage("ground_filtering"):
+            if mode == "batched":
+                self._batched_densification(
+                    points, xyz_points, dist_threshold, max_angle, dtype
+                )
+            else:
+                self._sequential_densification(
+                    points, xyz_points, dist_threshold, max_angle, dtype
+                )
+
+        ground_points_indices = np.where(points.is_ground == 1)[0]
+        ground_points = xyz_points[ground_points_indices]
+        self.las.points = points
+        self._index = None
+        ground_points = np.vstack((ground_points, self.triangle_convex_hull_points()))
+        return ground_points
+
+    def _sequential_densification(
+        self, points, xyz_points, dist_threshold, max_angle, dtype
+    ):
+        """
+        Tests the points one by one against the current TIN and inserts every accepted point immediately.
+
+        Args:
+            points (laspy.ScaleAwarePointRecord): The points to classify. Their is_ground flags are updated in place.
+            xyz_points (numpy.ndarray): The coordinates of the points.
+            dist_threshold (float): The distance threshold for classifying points as ground.
+            max_angle (float): The maximum angle (in degrees) for classifying points as ground.
+            dtype (numpy.dtype): The precision of the geometric tests.
+
+        """
+        progress = instrument.Progress("ground filtering", len(xyz_points))
+        # counted locally and added to the run report once, to keep the loop cheap
+        counts = dict.fromkeys(
+            (
+                "located",
+                "outside_tin",
+                "rejected_distance",
+                "rejected_angle",
+                "accepted",
+            ),
+            0,
+        )
         for i, p in enumerate(xyz_points):
+            progress.update()
             try:
                 tri = self.dt.locate(p[0], p[1])
             except Exception:
@@ -87,116 +156,160 @@ class GFTIN:
                     nearest_point = self.dt.closest_point([p[0], p[1]])
                     tri = self.dt.incident_triangles_to_vertex(nearest_point)[0]
                 except Exception:
-                    print("Warning: there is a point that is not inside of a triangle")
-
+                    counts["outside_tin"] += 1
                     points.is_ground[i] = 0
                     continue
-                print("Warning: there is a point that is not inside of a triangle")
+                counts["outside_tin"] += 1
                 points.is_ground[i] = 0
                 continue
+            counts["located"] += 1
 
-            # d is the intersection point of the triangle and the vertical line from p
-            tri_vetecies = [self.dt.points[i] for i in tri]  # [[x, y, z]]
-            d = self._intersection_point_of_triangle(tri_vetecies, [p[0], p[1], p[2]])
-
-            dist = np.linalg.norm([p[0], p[1], p[2]] - d)
-            if dist > dist_threshold:
+            # only the three vertices are fetched, dt.points would copy the whole TIN for every point
+            tri_vertices = [[self.dt.get_point(v) for v in tri]]
+            _, dists, angles, residuals = triangle_tests(
+                tri_vertices, xyz_points[i : i + 1], dtype
+            )
+            # a point on the plane of its triangle, e.g. a vertex of the TIN, is not accepted
+            if abs(residuals[0]) < ON_PLANE_TOLERANCE or not dists[0] <= dist_threshold:
+                counts["rejected_distance"] += 1
                 points.is_ground[i] = 0
                 continue
-            a, b, c = tri_vetecies
-
-            angle_a_p = self._angle_between_two_vectors(a, d, [p[0], p[1], p[2]])
-            angle_b_p = self._angle_between_two_vectors(b, d, [p[0], p[1], p[2]])
-            angle_c_p = self._angle_between_two_vectors(c, d, [p[0], p[1], p[2]])
-
-            if angle_a_p > max_angle or angle_b_p > max_angle or angle_c_p > max_angle:
+            if np.any(angles[0] > max_angle):
+                counts["rejected_angle"] += 1
                 points.is_ground[i] = 0
                 continue
-            print(i * 100 / len(xyz_points), "% done")
+            counts["accepted"] += 1
             self.dt.insert_one_pt(p[0], p[1], p[2])
             points.is_ground[i] = 1
 
-        ground_points_indices = np.where(points.is_ground == 1)[0]
-        ground_points = xyz_points[ground_points_indices]
-        self.las.points = points
-        ground_points = np.vstack((ground_points, self.triangle_convex_hull_points()))
-        return ground_points
+        for name, n in counts.items():
+            instrument.count(f"gftin.{name}", n)
+        if counts["outside_tin"]:
+            instrument.log(
+                f"Warning: {counts['outside_tin']} points are not inside of a triangle"
+            )
 
-    def _angle_between_two_vectors(self, a, b, c):
+    def _batched_densification(
+        self, points, xyz_points, dist_threshold, max_angle, dtype
+    ):
         """
-        Calculates the angle between two vectors.
+        Progressive TIN densification in rounds.
 
-        Args:
-            a (numpy.ndarray): The first vector.
-            b (numpy.ndarray): The second vector.
-            c (numpy.ndarray): The third vector.
+        In every round all remaining candidates are located and tested against the current TIN at once, and
+        only the accepted candidate closest to its triangle is inserted for each triangle. Rejected candidates
+        are tested again in the next round against the densified TIN, until a round accepts no point.
 
-        Returns:
-            float: The angle between the two vectors in degrees.
+        Args:
+            points (laspy.ScaleAwarePointRecord): The points to classify. Their is_ground flags are updated in place.
+            xyz_points (numpy.ndarray): The coordinates of the points.
+            dist_threshold (float): The distance threshold for classifying points as ground.
+            max_angle (float): The maximum angle (in degrees) for classifying points as ground.
+            dtype (numpy.dtype): The precision of the geometric tests.
 
         """
-        ab = math.dist(a, b)
-        ac = math.dist(a, c)
-        if ab == 0 or ac == 0:
-            return 0
-        cos_a = ab / ac
-
-        # To prevent math domain error. This is because of the floating point error.
-        if 1 < cos_a < 1 + 1e-6:
-            cos_a = 1
-        elif -1 - 1e-6 < cos_a < -1:
-            cos_a = -1
-        a_rad = math.acos(cos_a)
-        return math.degrees(a_rad)
-
-    def _intersection_point_of_triangle(self, tri, p):
+        is_ground = np.zeros(len(xyz_points), dtype=np.uint8)
+        candidates = np.arange(len(xyz_points))
+        rounds = 0
+        while len(candidates) > 0:
+            candidate_points = xyz_points[candidates]
+            triangles = self._locate_triangles(candidate_points)
+
+            # the hull of the TIN never grows, so points outside of it can never be accepted and every point is
+            # counted in the first round only
+            inside = triangles >= 0
+            if rounds == 0:
+                if not np.all(inside):
+                    instrument.log(
+                        f"Warning: {np.count_nonzero(~inside)} points are not inside of a triangle"
+                    )
+                instrument.count("gftin.outside_tin", np.count_nonzero(~inside))
+                instrument.count("gftin.located", np.count_nonzero(inside))
+            candidates = candidates[inside]
+            candidate_points = candidate_points[inside]
+            triangles = triangles[inside]
+            if len(candidates) == 0:
+                break
+
+            tri_vertices = self.dt.points[self.dt.triangles[triangles]]  # (M, 3, 3)
+            _, dists, angles, residuals = triangle_tests(
+                tri_vertices, candidate_points, dtype
+            )
+            # like in the sequential mode, a point on the plane of its triangle, e.g. a vertex of the TIN, is not
+            # accepted, so it cannot take the place of a real candidate of its triangle
+            close = (np.abs(residuals) >= ON_PLANE_TOLERANCE) & (
+                dists <= dist_threshold
+            )
+            accepted = close & np.all(angles <= max_angle, axis=1)
+            # the rejected candidates are tested again in the next round, and counted again
+            instrument.count("gftin.rejected_distance", np.count_nonzero(~close))
+            instrument.count(
+                "gftin.rejected_angle", np.count_nonzero(~accepted & close)
+            )
+            if not np.any(accepted):
+                break
+
+            # keep the accepted candidate closest to the surface of every triangle
+            accepted_indices = np.flatnonzero(accepted)
+            order = accepted_indices[
+                np.lexsort((dists[accepted_indices], triangles[accepted_indices]))
+            ]
+            sorted_triangles = triangles[order]
+            first = np.r_[True, sorted_triangles[1:] != sorted_triangles[:-1]]
+            best = order[first]
+
+            self.dt.insert(candidate_points[best])
+            is_ground[candidates[best]] = 1
+            instrument.count("gftin.accepted", len(best))
+            remaining = np.ones(len(candidates), dtype=bool)
+            remaining[best] = False
+            candidates = candidates[remaining]
+            rounds += 1
+            instrument.count("gftin.rounds")
+            instrument.log(f"round {rounds}: {len(best)} points inserted", level=2)
+
+        points.is_ground = is_ground
+
+    def _locate_triangles(self, xy):
         """
-        Calculates the intersection point of a triangle and a vertical line.
+        Locates the triangles of the current TIN containing the given points.
 
         Args:
-            tri (list): The vertices of the triangle.
-            p (list): The point on the vertical line.
+            xy (numpy.ndarray): The point coordinates, shape (N, 2) or wider.
 
         Returns:
-            numpy.ndarray: The intersection point.
+            numpy.ndarray: The indices into dt.triangles of the containing triangles, -1 for points outside of the TIN.
 
         """
-        a, b, c = tri
-        ab = b - a
-        ac = c - a
-        n = np.cross(ab, ac)
-        coefficient = -np.dot(n, a)  # plane equation coefficients
-
-        if (
-            abs(np.dot(n, p) + coefficient) < 1e-6
-        ):  # TODO: check what epsion value is appropriate
-            return n
-
-        t = -(np.dot(n, p) + coefficient) / np.dot(n, n)
-        d = p + t * n
-        # TODO: check if d is inside of triangle
-        return d
+        if len(self.dt.triangles) == 0:
+            return np.full(len(xy), -1)
+        return TriangleIndex(self.dt.points, self.dt.triangles).locate(xy)[0]
 
     def _construct_initial_tin(self):
         """
-        Constructs the initial TIN using the lowest points in each cell.
+        Constructs the initial TIN using the lowest points in each cell, unless the seeds were given.
 
         """
-        points_for_tin = self._extract_lowest_points()
-        self.dt.insert(points_for_tin)
+        if self.seeds is None:
+            self.seeds = self._extract_lowest_points()
+        self.dt.insert(self.seeds)
 
-    def _extract_lowest_points(self):
+    def _extract_lowest_points(self, num=1):
         """
         Extracts the lowest points in each cell.
 
+        The cell keys of all points are computed once and reduced to the lowest points per cell in a single
+        sort, instead of scanning every point for every cell.
+
+        Args:
+            num (int, optional): The number of lowest points to extract per cell. Defaults to 1.
+
         Returns:
-            numpy.ndarray: The lowest points.
+            numpy.ndarray: The lowest points, ordered cell by cell like _divide_extent_by_cell_size.
 
         """
-        cells = self._divide_extent_by_cell_size()
-        reshaped_cell = np.array(cells).reshape(-1, 2)
-
         if self.debug is True:
+            cells = self._divide_extent_by_cell_size()
+            reshaped_cell = np.array(cells).reshape(-1, 2)
             write_geojson(
                 os.path.join(cfg.DEBUG_DATA_DIR, "cells.geojson"),
                 reshaped_cell,
@@ -204,40 +317,29 @@ class GFTIN:
                 "epsg:4326",
             )
 
-        points = np.empty((0, 3))
-        for row in cells:
-            for cell in row:
-                lowest_point = self._find_lowest_point_in_a_cell(cell, 1)
-                points = np.vstack((points, lowest_point))
-        return points
+        grid_bbox = self._grid_bbox()
+        shape = grid_shape(grid_bbox, self.cell_size)
+        points = self.las.xyz
+        indices, keys = cell_keys(
+            points, grid_bbox[:2], self.cell_size, shape, closed=True
+        )
+        lowest_indices = lowest_points_per_cell(points[:, 2], indices, keys, num)
+        return points[lowest_indices]
 
-    def _find_lowest_point_in_a_cell(self, cell, num=1):
+    def _grid_bbox(self):
         """
-        Finds the lowest point(s) in a cell.
-
-        Args:
-            cell (list): The cell coordinates.
-            num (int, optional): The number of lowest points to find. Defaults to 1.
+        Returns the extent covered by the cells, including the buffer around the bounding box.
 
         Returns:
-            numpy.ndarray: The lowest point(s).
+            list: The extent [minx, miny, maxx, maxy].
 
         """
-        cell_bbox = [
-            cell[0] - (self.cell_size / 2),
-            cell[1] - (self.cell_size / 2),
-            cell[0] + (self.cell_size / 2),
-            cell[1] + (self.cell_size / 2),
-        ]  # [minx, miny, maxx, maxy]
-        points = self.las.xyz
-        x_valid = (cell_bbox[0] <= points[:, 0]) & (cell_bbox[2] >= points[:, 0])
-        y_valid = (cell_bbox[1] <= points[:, 1]) & (cell_bbox[3] >= points[:, 1])
-
-        valid_indices = np.where(x_valid & y_valid)[0]
-        points_in_cell = points[valid_indices]
-        sorted_array = points_in_cell[points_in_cell[:, 2].argsort()]
-        z_min_points = sorted_array[:num]
-        return z_min_points
+        return [
+            self.bbox[0] - self.cell_size * 2,
+            self.bbox[1] - self.cell_size * 2,
+            self.bbox[3] + self.cell_size * 2,
+            self.bbox[4] + self.cell_size * 2,
+        ]
 
     def _divide_extent_by_cell_size(self):
         """
@@ -269,12 +371,19 @@ class GFTIN:
             numpy.ndarray: The indices of the points.
 
         """
-        points = self.las.points
-        x_valid = (self.bbox[0] <= points.x) & (self.bbox[3] >= points.x)
-        y_valid = (self.bbox[1] <= points.y) & (self.bbox[4] >= points.y)
-        z_valid = (self.bbox[2] <= points.z) & (self.bbox[5] >= points.z)
-        valid_indices = np.where(x_valid & y_valid & z_valid)[0]
-        return valid_indices
+        return self._spatial_index().query_bbox(self.bbox)
+
+    def _spatial_index(self):
+        """
+        Returns the spatial index over the LAS points, building it on first use.
+
+        Returns:
+            GridIndex: The spatial index.
+
+        """
+        if self._index is None:
+            self._index = GridIndex(self.las.xyz)
+        return self._index
 
     def triangle_convex_hull_points(self):
         """
@@ -288,17 +397,24 @@ class GFTIN:
         conv_points = np.array([self.dt.points[i] for i in convex_hull])
         return conv_points
 
-    def write_tin_geojson(self, file_path):
+    def write_tin_geojson(self, file_path, triangles=False):
         """
-        Writes the TIN to a GeoJSON file.
+        Writes the vertices of the TIN, or its triangles as polygons, to a GeoJSON file.
 
         Args:
             file_path (str): The file path to write the GeoJSON file.
+            triangles (bool, optional): Whether to write the triangles instead of the vertices. Defaults to False.
 
         """
-        write_geojson(
-            file_path,
-            self.dt.points,
-            "epsg:28992",
-            "epsg:4326",
-        )
+        # vertex 0 of startinpy is the infinite vertex
+        vertices = self.dt.points[1:]
+        if triangles:
+            write_triangles_geojson(
+                file_path,
+                vertices,
+                self.dt.triangles.astype(np.int64) - 1,
+                "epsg:28992",
+                "epsg:4326",
+            )
+        else:
+            write_geojson(file_path, vertices, "epsg:28992", "epsg:4326")
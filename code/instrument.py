@@ -0,0 +1,155 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import config as cfg
+
+# the report of the current run, see report()
+_report = {"stages": {}, "counters": {}}
+# the stages currently running, innermost last, as [name, peak memory of the finished inner stages]
+_stack = []
+
+
+def log(*message, level=1):
+    """
+    Prints a message if the verbosity of config.py is at least level.
+
+    Args:
+        *message: The message, printed like print does.
+        level (int, optional): 1 for progress and summaries, 2 for debugging details. Defaults to 1.
+    """
+    if cfg.VERBOSITY >= level:
+        print(*message)
+
+
+def count(name, n=1):
+    """
+    Adds n to a counter of the run report.
+
+    Args:
+        name (str): The name of the counter, e.g. "gftin.accepted".
+        n (int, optional): The amount to add. Defaults to 1.
+    """
+    counters = _report["counters"]
+    counters[name] = counters.get(name, 0) + int(n)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the run. Stages can be nested, and a stage run several times adds up.
+
+    With cfg.TRACE_MEMORY, the peak of the memory traced by tracemalloc during the stage is recorded too.
+
+    Args:
+        name (str): The name of the stage.
+    """
+    if cfg.TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracing = tracemalloc.is_tracing()
+    if tracing and _stack:
+        # the peak is reset for this stage, so keep the peak of the outer stage so far
+        _stack[-1][1] = max(_stack[-1][1], tracemalloc.get_traced_memory()[1])
+    if tracing:
+        tracemalloc.reset_peak()
+    _stack.append([name, 0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _, inner_peak = _stack.pop()
+        stats = _report["stages"].setdefault(name, {"calls": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        if tracing:
+            peak = max(inner_peak, tracemalloc.get_traced_memory()[1])
+            stats["peak_mb"] = max(stats.get("peak_mb", 0.0), peak / 1024**2)
+            if _stack:
+                _stack[-1][1] = max(_stack[-1][1], peak)
+        log(f"==={name}: {seconds:.2f} s===", level=2)
+
+
+class Progress:
+    """
+    Rate-limited progress reporting for long loops.
+
+    The progress is printed at most once every cfg.PROGRESS_INTERVAL seconds, so a loop can report every
+    iteration without paying for a console write each time.
+
+    Args:
+        name (str): The name of the loop.
+        total (int): The number of iterations.
+
+    Methods:
+        update(n=1): Advances the progress by n iterations.
+
+    """
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self._last = time.perf_counter()
+
+    def update(self, n=1):
+        """
+        Advances the progress by n iterations, and prints it if the last print is long enough ago.
+
+        Args:
+            n (int, optional): The number of iterations done. Defaults to 1.
+        """
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= cfg.PROGRESS_INTERVAL:
+            self._last = now
+            log(f"{self.name}: {self.done * 100 / max(self.total, 1):.1f} % done")
+
+
+def report():
+    """
+    Returns the report of the run: the calls, seconds (and peak_mb with cfg.TRACE_MEMORY) of every stage, and
+    the counters.
+
+    Returns:
+        dict: The report {"stages": {...}, "counters": {...}}.
+    """
+    return json.loads(json.dumps(_report))
+
+
+def merge(other):
+    """
+    Adds the report of another run, e.g. of a worker process, to the report of this run.
+
+    Args:
+        other (dict): The report returned by report().
+    """
+    for name, stats in other["stages"].items():
+        own = _report["stages"].setdefault(name, {"calls": 0, "seconds": 0.0})
+        own["calls"] += stats["calls"]
+        own["seconds"] += stats["seconds"]
+        if "peak_mb" in stats:
+            own["peak_mb"] = max(own.get("peak_mb", 0.0), stats["peak_mb"])
+    for name, value in other["counters"].items():
+        count(name, value)
+
+
+def reset():
+    """
+    Clears the report of the run.
+    """
+    _report["stages"].clear()
+    _report["counters"].clear()
+
+
+def write_report(file_path):
+    """
+    Writes the report of the run to a JSON file.
+
+    Args:
+        file_path (str): The path of the JSON file.
+    """
+    with open(file_path, "w") as f:
+        json.dump(_report, f, indent=2)
+    log(f"run report written to {file_path}")
@@ -1,12 +1,15 @@
+import instrument
+
+
 def las_info(las):
-    print("=========LAS Info=========")
-    print("las metadata:")
-    print(las.header)
+    instrument.log("=========LAS Info=========")
+    instrument.log("las metadata:", level=2)
+    instrument.log(las.header, level=2)
 
-    print("las dims:")
+    instrument.log("las dims:", level=2)
     for i, dim in enumerate(las.point_format):
-        print(i, ": ", dim.name)
+        instrument.log(i, ": ", dim.name, level=2)
 
-    print("las points:")
-    print(len(las.points), "points")
-    print("==========================")
+    instrument.log("las points:")
+    instrument.log(len(las.points), "points")
+    instrument.log("==========================")
@@ -1,24 +1,191 @@
-import os
+import functools
+import shutil
 
 import config as cfg
+import instrument
 import step3
 import step4
 import step5
+from cache import StageCache, create_atomically
+from columnar import cached_columns
+from point_store import PointStore
 from preprocess import preprocess
+from scheduler import Scheduler
 
 
 def main():
-    processed_file = preprocess(cfg.INPUT_LAS)
-    if not os.path.isfile(cfg.STEP3_OUTPUT):
-        step3.create_dtm(processed_file, cfg.STEP3_OUTPUT)
-    if not os.path.isfile(cfg.STEP4_OUTPUT):
-        step4.extract_vegetation(processed_file, cfg.STEP4_OUTPUT)
+    cache = StageCache(cfg.CACHE_DIR, cfg.CACHE_MAX_BYTES)
+    processed_file = preprocess(cfg.INPUT_LAS, cache)
+    inputs = [processed_file]
+    ground_params = {
+        "extent": cfg.EXTENT,
+        "cell_size": cfg.GFTIN_CELL_SIZE,
+        "densification": cfg.GFTIN_DENSIFICATION,
+    }
+    params = {
+        "ground_tin": ground_params,
+        "dtm": {
+            **ground_params,
+            "tile_size": cfg.DTM_TILE_SIZE,
+            "tile_overlap": cfg.DTM_TILE_OVERLAP,
+            "interpolation": cfg.DTM_INTERPOLATION,
+            "cog": cfg.RASTER_COG,
+        },
+        "vegetation": {
+            "extent": cfg.EXTENT,
+            "dbscan_engine": cfg.DBSCAN_ENGINE,
+            "cog": cfg.RASTER_COG,
+        },
+    }
+    suffixes = {"ground_tin": ".npz", "dtm": ".tiff", "vegetation": ".tiff"}
+    # the stages reading the points. Untiled, the ground TIN is cached as a stage of its own, so changing a raster
+    # parameter only rasterizes the TIN again instead of running ground filtering
+    stage_funcs = {"vegetation": extract_vegetation}
+    if cfg.DTM_TILE_SIZE is None:
+        stage_funcs["ground_tin"] = create_ground_tin
+    else:
+        stage_funcs["dtm"] = create_dtm
 
+    # the dtm and vegetation branches are independent, so they run concurrently and only step 5 waits for both
+    scheduler = Scheduler()
+    outputs = {}
+    store = None
+    cached_dtm = cache.lookup("dtm", inputs, params["dtm"])
+    if cached_dtm is not None:
+        scheduler.provide("dtm", cached_dtm)
+        stage_funcs.pop("ground_tin", None)
+        stage_funcs.pop("dtm", None)
+    elif cfg.DTM_TILE_SIZE is None:
+        outputs["dtm"] = cache.output_path("dtm", inputs, params["dtm"], ".tiff")
+        scheduler.add(
+            "dtm", create_dtm_from_tin, outputs["dtm"], inputs=("ground_tin",)
+        )
+    for stage, func in stage_funcs.items():
+        cached = cache.lookup(stage, inputs, params[stage])
+        if cached is not None:
+            scheduler.provide(stage, cached)
+            continue
+        if store is None:
+            # the processed points are read once, from their memory mapped columns, and the stages attach to them
+            # in shared memory
+            store = PointStore.load(
+                cached_columns(processed_file, cache),
+                step3.buffered_extent(cfg.EXTENT, cfg.GFTIN_CELL_SIZE * 2),
+            )
+            handle = store.share()
+        outputs[stage] = cache.output_path(
+            stage, inputs, params[stage], suffixes[stage]
+        )
+        scheduler.add(stage, create_atomically, func, outputs[stage], handle)
+    scheduler.add("chm", create_chm, inputs=("dtm", "vegetation"))
+
+    try:
+        with instrument.stage("main"):
+            scheduler.run()
+    finally:
+        if store is not None:
+            store.close()
+        for stage, output_path in outputs.items():
+            if stage in scheduler.timings:
+                cache.record(stage, inputs, params[stage], output_path)
+        instrument.write_report(cfg.RUN_REPORT)
+
+
+def create_dtm(output_path, handle):
+    """
+    Creates the DTM from the shared point store. This runs in a worker process.
+
+    Args:
+        output_path (str): The path of the DTM raster.
+        handle (dict): The handle of the shared point store.
+    """
+    store = PointStore.attach(handle)
+    try:
+        step3.create_dtm(
+            None,
+            output_path,
+            cfg.DTM_TILE_SIZE,
+            cfg.DTM_TILE_OVERLAP,
+            cfg.DTM_WORKERS,
+            store,
+        )
+    finally:
+        store.close()
+
+
+def create_ground_tin(output_path, handle):
+    """
+    Runs ground filtering on the shared point store and saves the ground TIN. This runs in a worker process.
+
+    Args:
+        output_path (str): The path of the TIN file.
+        handle (dict): The handle of the shared point store.
+    """
+    store = PointStore.attach(handle)
+    try:
+        step3.create_ground_tin(None, output_path, store)
+    finally:
+        store.close()
+
+
+def create_dtm_from_tin(tin_file, output_path):
+    """
+    Rasterizes the ground TIN into the DTM. This runs in a worker process.
+
+    Args:
+        tin_file (str): The path of the TIN file.
+        output_path (str): The path of the DTM raster.
+
+    Returns:
+        str: The path of the DTM raster.
+    """
+    return create_atomically(
+        functools.partial(step3.create_dtm_from_tin, tin_file), output_path
+    )
+
+
+def extract_vegetation(output_path, handle):
+    """
+    Extracts the vegetation from the shared point store. This runs in a worker process.
+
+    Args:
+        output_path (str): The path of the vegetation raster.
+        handle (dict): The handle of the shared point store.
+    """
+    store = PointStore.attach(handle)
+    try:
+        step4.extract_vegetation(
+            None,
+            output_path,
+            cfg.DBSCAN_ENGINE,
+            cfg.DBSCAN_TILE_SIZE,
+            cfg.DBSCAN_WORKERS,
+            store,
+        )
+    finally:
+        store.close()
+
+
+def create_chm(dtm_file, vegetation_file):
+    """
+    Copies the outputs of step 3 and 4 out of the cache and creates the CHM. This runs in a worker process.
+
+    Args:
+        dtm_file (str): The path of the DTM raster.
+        vegetation_file (str): The path of the vegetation raster.
+
+    Returns:
+        str: The path of the CHM raster.
+    """
+    shutil.copyfile(dtm_file, cfg.STEP3_OUTPUT)
+    shutil.copyfile(vegetation_file, cfg.STEP4_OUTPUT)
     step5.create_chm(
         cfg.STEP3_OUTPUT,
         cfg.STEP4_OUTPUT,
         cfg.STEP5_OUTPUT,
+        cog=cfg.RASTER_COG,
     )
+    return cfg.STEP5_OUTPUT
 
 
 if __name__ == "__main__":
@@ -0,0 +1,323 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import config as cfg
+import instrument
+import laspy
+from gftin import GFTIN
+from preprocess import nth_thinning, remove_outliers
+from ptio import read_laz
+from step3 import add_ground_dim, buffered_extent
+from step4 import cluster_vegetation
+from step5 import create_chm
+from tin import TIN
+from vegetation_ext import VegetationExtractor
+
+
+def run_benchmarks(sizes, resolution=0.5, trace_memory=False):
+    """
+    Times every stage of the pipeline on square extents of several sizes.
+
+    Every size is a square of that side length at the center of cfg.EXTENT, cut from cfg.INPUT_LAS, and runs
+    through all stages from thinning to the CHM. The stages are timed with tracemalloc off, because tracing
+    slows the Python-heavy stages down several times. With trace_memory, every size runs a second time with
+    tracing on, only to measure the peak memory: the peak of the allocations traced by tracemalloc during the
+    stage, which includes the numpy arrays.
+
+    Args:
+        sizes (list): The side lengths of the extents in meters.
+        resolution (float, optional): The size of the pixels of the rasters in meters. Defaults to 0.5.
+        trace_memory (bool, optional): Whether to also measure the peak memory of every stage. Defaults to False.
+
+    Returns:
+        dict: The measurements of every stage and size, {stage: {size: {"count", "unit", "seconds", "rate"}}},
+        where the rate is the count (points or pixels) per second, with "peak_mb" too if trace_memory is True.
+    """
+    # the stages must not start tracing through instrument.stage while they are timed
+    config_trace_memory = cfg.TRACE_MEMORY
+    cfg.TRACE_MEMORY = False
+    try:
+        results = {}
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                measurements = _run_size(size, resolution, tmp_dir)
+            if trace_memory:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    traced = _run_size(size, resolution, tmp_dir, trace_memory=True)
+                for stage, measurement in measurements.items():
+                    measurement["peak_mb"] = traced[stage]["peak_mb"]
+            for stage, measurement in measurements.items():
+                results.setdefault(stage, {})[str(size)] = measurement
+    finally:
+        cfg.TRACE_MEMORY = config_trace_memory
+    return results
+
+
+def _run_size(size, resolution, tmp_dir, trace_memory=False):
+    """
+    Runs all stages on one extent.
+
+    Args:
+        size (float): The side length of the extent in meters.
+        resolution (float): The size of the pixels of the rasters in meters.
+        tmp_dir (str): The directory of the intermediate files.
+        trace_memory (bool, optional): Whether to measure the peak memory instead of the runtime, see _measure.
+            Defaults to False.
+
+    Returns:
+        dict: The measurements of every stage.
+    """
+    measure = functools.partial(_measure, trace_memory=trace_memory)
+    center_x = (cfg.EXTENT[0] + cfg.EXTENT[3]) / 2
+    center_y = (cfg.EXTENT[1] + cfg.EXTENT[4]) / 2
+    extent = [
+        center_x - size / 2,
+        center_y - size / 2,
+        cfg.EXTENT[2],
+        center_x + size / 2,
+        center_y + size / 2,
+        cfg.EXTENT[5],
+    ]
+    # the cell size of the configuration may not fit in the smaller extents
+    cell_size = min(cfg.GFTIN_CELL_SIZE, size / 2)
+    buffered = buffered_extent(extent, cell_size * 2)
+    raster_bbox = [extent[0], extent[1], extent[3], extent[4]]
+    pixels = round(size / resolution) ** 2
+    paths = {
+        name: os.path.join(tmp_dir, name)
+        for name in (
+            "input.las",
+            "thinned.las",
+            "no_outliers.las",
+            "dtm.tiff",
+            "vegetation.tiff",
+            "chm.tiff",
+        )
+    }
+
+    input_las = read_laz(cfg.INPUT_LAS, bbox=buffered)
+    input_las.write(paths["input.las"])
+    n_input = len(input_las.points)
+    measurements = {}
+
+    measurements["nth_thinning"] = measure(
+        "nth_thinning",
+        n_input,
+        "points",
+        nth_thinning,
+        paths["input.las"],
+        2,
+        paths["thinned.las"],
+    )
+    with laspy.open(paths["thinned.las"]) as f:
+        n_thinned = f.header.point_count
+    measurements["remove_outliers"] = measure(
+        "remove_outliers",
+        n_thinned,
+        "points",
+        remove_outliers,
+        paths["thinned.las"],
+        paths["no_outliers.las"],
+        **cfg.OUTLIER_PARAMS,
+    )
+
+    las = read_laz(paths["no_outliers.las"], bbox=buffered)
+    add_ground_dim(las)
+    n_points = len(las.points)
+    measurements["gftin_seeding"], gftin = measure(
+        "gftin_seeding",
+        n_points,
+        "points",
+        GFTIN,
+        las,
+        cell_size,
+        extent,
+        return_result=True,
+    )
+    measurements["ground_filtering"], ground_points = measure(
+        "ground_filtering",
+        n_points,
+        "points",
+        gftin.ground_filtering,
+        mode=cfg.GFTIN_DENSIFICATION,
+        return_result=True,
+    )
+    measurements["write_dtm"] = measure(
+        "write_dtm",
+        pixels,
+        "pixels",
+        TIN(ground_points).write_dtm,
+        paths["dtm.tiff"],
+        raster_bbox,
+        resolution,
+        method=cfg.DTM_INTERPOLATION,
+    )
+
+    vegetation = read_laz(paths["no_outliers.las"], bbox=extent)
+    measurements["dbscan"], vegetation = measure(
+        "dbscan",
+        len(vegetation.points),
+        "points",
+        cluster_vegetation,
+        vegetation,
+        cfg.DBSCAN_ENGINE,
+        return_result=True,
+    )
+    veg_extractor = VegetationExtractor(vegetation)
+    veg_extractor.find_first_return_of_trees(3)
+    measurements["rasterize"] = measure(
+        "rasterize",
+        pixels,
+        "pixels",
+        veg_extractor.rasterize,
+        paths["vegetation.tiff"],
+        raster_bbox,
+        resolution,
+    )
+    measurements["create_chm"] = measure(
+        "create_chm",
+        pixels,
+        "pixels",
+        create_chm,
+        paths["dtm.tiff"],
+        paths["vegetation.tiff"],
+        paths["chm.tiff"],
+        resolution,
+    )
+    return measurements
+
+
+def _measure(
+    stage, count, unit, func, *args, return_result=False, trace_memory=False, **kwargs
+):
+    """
+    Runs a stage and measures its runtime, or its peak memory.
+
+    Args:
+        stage (str): The name of the stage.
+        count (int): The number of points or pixels processed by the stage.
+        unit (str): "points" or "pixels".
+        func (callable): The stage.
+        *args: The arguments of func.
+        return_result (bool, optional): Whether to also return the result of func. Defaults to False.
+        trace_memory (bool, optional): Whether to trace the memory with tracemalloc. The runtime of a traced
+            stage is not representative, so only the peak memory should be used. Defaults to False.
+        **kwargs: The keyword arguments of func.
+
+    Returns:
+        dict: The measurement {"count", "unit", "seconds", "rate"}, with "peak_mb" if trace_memory is True, and
+        the result of func if return_result is True.
+    """
+    if trace_memory:
+        # the stage runs as an instrument stage, so the stages nested in it keep the peak up to date
+        instrument.reset()
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with instrument.stage("perf_benchmark"):
+            result = func(*args, **kwargs)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    seconds = time.perf_counter() - start
+
+    measurement = {
+        "count": count,
+        "unit": unit,
+        "seconds": seconds,
+        "rate": count / seconds if seconds > 0 else float("inf"),
+    }
+    if trace_memory:
+        measurement["peak_mb"] = instrument.report()["stages"]["perf_benchmark"][
+            "peak_mb"
+        ]
+        print(f"{stage}: peak {measurement['peak_mb']:.1f} MB")
+    else:
+        print(
+            f"{stage}: {count} {unit} in {seconds:.3f} s "
+            f"({measurement['rate']:.0f} {unit}/s)"
+        )
+    if return_result:
+        return measurement, result
+    return measurement
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compares the runtimes of a run with a baseline.
+
+    Args:
+        results (dict): The measurements of the run, as returned by run_benchmarks.
+        baseline (dict): The measurements of the baseline.
+        threshold (float): The allowed slowdown, e.g. 0.2 for 20% slower than the baseline.
+
+    Returns:
+        list: The regressions, as (stage, size, baseline seconds, seconds) tuples.
+    """
+    regressions = []
+    for stage, sizes in baseline.items():
+        for size, reference in sizes.items():
+            current = results.get(stage, {}).get(size)
+            if current is None:
+                continue
+            if current["seconds"] > reference["seconds"] * (1 + threshold):
+                regressions.append(
+                    (stage, size, reference["seconds"], current["seconds"])
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the stages of the pipeline and compares them with a baseline."
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing with it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=cfg.PERF_REGRESSION_THRESHOLD,
+        help="the allowed slowdown compared to the baseline, e.g. 0.2 for 20%%",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        default=cfg.TRACE_MEMORY,
+        help="also measure the peak memory of every stage, in a second, traced run",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(cfg.PERF_SIZES, trace_memory=args.memory)
+    if args.update_baseline or not os.path.isfile(cfg.PERF_BASELINE):
+        with open(cfg.PERF_BASELINE, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline written to {cfg.PERF_BASELINE}")
+        return
+
+    with open(cfg.PERF_BASELINE) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.threshold)
+    if not regressions:
+        print("no regressions")
+        return
+    print("=========Regressions=========")
+    for stage, size, reference, current in regressions:
+        print(
+            f"{stage} at {size} m: {reference:.3f} s -> {current:.3f} s "
+            f"(+{(current / reference - 1) * 100:.0f}%)"
+        )
+    print("=============================")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
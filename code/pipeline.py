@@ -1,51 +1,90 @@
 import json
+from collections import namedtuple
 
+import instrument
 import pdal
 
+# the number of points per chunk in streaming mode
+STREAM_CHUNK_SIZE = 100_000
+
+# the result of Pipeline.execute: the mode used ("stream" or "standard"), the point count and the output arrays
+PipelineResult = namedtuple("PipelineResult", ["mode", "count", "arrays"])
+
 
 class Pipeline:
     """
     A class representing a data processing pipeline.
 
     Args:
-        input_path (str): The path to the input data.
-        output_path (str): The path to save the output data.
+        input_data (str or numpy.ndarray): The path to the input data, or the points as a numpy structured array
+            with PDAL dimension names (see ptio.las_to_pdal_array).
+        output_path (str, optional): The path to save the output data. No writer is added when None, and the
+            points are only returned by execute. Defaults to None.
         output_extra_dims (list, optional): A list of extra dimensions to include in the output data. Defaults to [].
+        verbose (bool, optional): Whether to print the pipeline JSON before executing it, whatever the verbosity
+            of config.py. Defaults to False.
 
     Attributes:
         pipeline_setting (list): The configuration settings for the pipeline.
+        arrays (list): The output arrays of the last execution, or a generator of chunks in streaming mode.
+        verbose (bool): Whether to print the pipeline JSON before executing it.
 
     """
 
-    def __init__(self, input_path, output_path, output_extra_dims=[]):
+    def __init__(
+        self, input_data, output_path=None, output_extra_dims=[], verbose=False
+    ):
+        self.verbose = verbose
+        self._input_arrays = [] if isinstance(input_data, str) else [input_data]
+        self._has_writer = output_path is not None
         self.pipeline_setting = self._init_pipeline(
-            input_path, output_path, output_extra_dims
+            input_data, output_path, output_extra_dims
         )
+        self.arrays = None
 
-    def _init_pipeline(self, input_path, output_path, output_extra_dims=[]):
+    def _init_pipeline(self, input_data, output_path=None, output_extra_dims=[]):
         """
         Initialize the pipeline with the input and output settings.
 
         Args:
-            input_path (str): The path to the input data.
-            output_path (str): The path to save the output data.
+            input_data (str or numpy.ndarray): The path to the input data, or the points as a numpy structured array.
+            output_path (str, optional): The path to save the output data. Defaults to None.
             output_extra_dims (list, optional): A list of extra dimensions to include in the output data. Defaults to [].
 
         Returns:
             list: The initialized pipeline configuration.
 
         """
-        extra_dims = ",".join(output_extra_dims)
-        init_pipeline = [
-            input_path,
-            {
-                "type": "writers.las",
-                "filename": output_path,
-                "extra_dims": extra_dims,
-            },
-        ]
+        init_pipeline = []
+        # arrays are handed to PDAL directly, so they need no reader
+        if isinstance(input_data, str):
+            init_pipeline.append(input_data)
+        if output_path is not None:
+            extra_dims = ",".join(output_extra_dims)
+            init_pipeline.append(
+                {
+                    "type": "writers.las",
+                    "filename": output_path,
+                    "extra_dims": extra_dims,
+                }
+            )
         return init_pipeline
 
+    def _add_stages(self, stages):
+        """
+        Add stages to the pipeline, before the writer if there is one.
+
+        Args:
+            stages (list): The stages to add.
+
+        """
+        if self._has_writer:
+            self.pipeline_setting = (
+                self.pipeline_setting[:-1] + stages + self.pipeline_setting[-1:]
+            )
+        else:
+            self.pipeline_setting = self.pipeline_setting + stages
+
     def range(self, unclassified_code=1):
         """
         Apply a range filter to the pipeline.
@@ -63,10 +102,7 @@ class Pipeline:
                 "limits": f"Classification[{unclassified_code}:{unclassified_code}]",
             },
         ]
-        # append range_pipe to pipeline_setting as -2 index. This is because the last index is the writer
-        self.pipeline_setting = (
-            self.pipeline_setting[:-1] + range_pipe + self.pipeline_setting[-1:]
-        )
+        self._add_stages(range_pipe)
         return self
 
     def dbscan(self, min_points=6, eps=3):
@@ -93,31 +129,75 @@ class Pipeline:
                 "expression": "ClusterID != -1",
             },
         ]
-        # append dbscan_pipe to pipeline_setting as -2 index. This is because the last index is the writer
-        self.pipeline_setting = (
-            self.pipeline_setting[:-1] + dbscan_pipe + self.pipeline_setting[-1:]
-        )
+        self._add_stages(dbscan_pipe)
+        return self
+
+    def outlier(self, mean_k=10, multiplier=2.0):
+        """
+        Apply a statistical outlier filter to the pipeline. The outliers are classified as noise (7).
+
+        Args:
+            mean_k (int, optional): The number of neighbors to consider for outlier detection. Defaults to 10.
+            multiplier (float, optional): The standard deviation ratio for outlier detection. Defaults to 2.0.
+
+        Returns:
+            Pipeline: The updated pipeline object.
+
+        """
+        outlier_pipe = [
+            {
+                "type": "filters.outlier",
+                "method": "statistical",
+                "mean_k": mean_k,
+                "multiplier": multiplier,
+            }
+        ]
+        self._add_stages(outlier_pipe)
         return self
 
-    def execute(self):
+    def execute(self, stream=False, chunk_size=STREAM_CHUNK_SIZE):
         """
         Execute the pipeline.
 
+        In streaming mode PDAL processes the points in chunks of chunk_size, so the memory use does not grow with
+        the size of the input. It is only possible when every stage is streamable (readers, writers, range and
+        expression filters are; dbscan and outlier are not), otherwise the pipeline falls back to standard mode.
+
+        Args:
+            stream (bool, optional): Whether to run in streaming mode if possible. Defaults to False.
+            chunk_size (int, optional): The number of points per chunk in streaming mode. Defaults to
+                STREAM_CHUNK_SIZE.
+
         Returns:
-            int: The number of points processed by the pipeline.
+            PipelineResult: The mode used, the point count and the output arrays. In streaming mode without a
+            writer, the arrays are a generator of chunks and the count is None, as the points have not been
+            processed yet. In streaming mode with a writer, the arrays are empty.
 
         """
-        print("Executing pipeline...")
-        print("Pipeline: ", self.pipeline_setting)
         pipeline_json = json.dumps(self.pipeline_setting)
-        print("Pipeline json: ", pipeline_json)
-        pipeline = pdal.Pipeline(pipeline_json)
-        count = pipeline.execute()
-        arrays = pipeline.arrays
-        metadata = pipeline.metadata
-        log = pipeline.log
-
-        print("Pipeline executed successfully")
-        print("Point count: ", count)
-        # print("Arrays: ", arrays)
-        # print("Metadata: ", metadata)
+        instrument.log("Pipeline json: ", pipeline_json, level=1 if self.verbose else 2)
+        pipeline = pdal.Pipeline(pipeline_json, arrays=self._input_arrays)
+
+        if stream and not pipeline.streamable:
+            instrument.log("Pipeline is not streamable, falling back to standard mode")
+        if stream and pipeline.streamable:
+            instrument.log(
+                f"Executing pipeline in streaming mode ({chunk_size} points per chunk)..."
+            )
+            if self._has_writer:
+                with instrument.stage("pdal_pipeline"):
+                    count = pipeline.execute_streaming(chunk_size=chunk_size)
+                self.arrays = []
+                instrument.log("Point count: ", count)
+                return PipelineResult("stream", count, self.arrays)
+            self.arrays = pipeline.iterator(chunk_size=chunk_size)
+            return PipelineResult("stream", None, self.arrays)
+
+        instrument.log("Executing pipeline...")
+        with instrument.stage("pdal_pipeline"):
+            count = pipeline.execute()
+        self.arrays = pipeline.arrays
+
+        instrument.log("Pipeline executed successfully")
+        instrument.log("Point count: ", count)
+        return PipelineResult("standard", count, self.arrays)
@@ -0,0 +1,163 @@
+import copy
+import os
+from multiprocessing import shared_memory
+
+import laspy
+import numpy as np
+from columnar import Columns
+from lasinfo import las_info
+from ptio import pack_header, read_laz, unpack_las
+from spatial_index import GridIndex
+
+
+class PointStore:
+    """
+    Points loaded once and shared by the steps of the pipeline.
+
+    The processed file is decoded and clipped a single time, and every step takes the points it needs from the
+    store instead of reading the file again. The store can be copied into shared memory, so worker processes
+    attach to the same buffer instead of receiving a pickled copy of their points.
+
+    Args:
+        las (laspy.LasData): The points of the store.
+
+    Attributes:
+        header (laspy.LasHeader): The header of the points.
+        array (numpy.ndarray): The raw point records.
+
+    Methods:
+        load(file_path, bbox): Reads a LAS/LAZ file or its columns into a store.
+        attach(handle): Attaches to a store shared by another process.
+        las(bbox, indices): Returns the points, or a part of them, as a LAS.
+        share(): Moves the points to shared memory and returns the handle to attach to them.
+        close(): Releases the shared memory of the store.
+
+    """
+
+    def __init__(self, las):
+        self.header = las.header
+        self.array = las.points.array
+        self._index = None
+        self._shm = None
+        self._owner = False
+
+    def __len__(self):
+        return len(self.array)
+
+    @classmethod
+    def load(cls, file_path, bbox=None):
+        """
+        Reads a LAS/LAZ file into a store.
+
+        file_path can also be the directory of the columns of the file written by columnar.write_columns. The
+        bbox is then selected on the memory mapped coordinates and only those points are copied, without
+        decoding the file.
+
+        Args:
+            file_path (str): The path of the LAS/LAZ file, or the directory of its columns.
+            bbox (list, optional): Only keep the points within [minx, miny, minz, maxx, maxy, maxz] or
+                [minx, miny, maxx, maxy]. Defaults to None (all points).
+
+        Returns:
+            PointStore: The store.
+
+        """
+        if os.path.isdir(file_path):
+            columns = Columns(file_path)
+            las = columns.las(None if bbox is None else columns.bbox_indices(bbox))
+        else:
+            las = read_laz(file_path, bbox=bbox)
+        las_info(las)
+        return cls(las)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attaches to a store shared by another process.
+
+        Args:
+            handle (dict): The handle returned by share.
+
+        Returns:
+            PointStore: The store, backed by the shared memory of the other process.
+
+        """
+        shm = shared_memory.SharedMemory(name=handle["name"])
+        array = np.ndarray(handle["shape"], dtype=handle["dtype"], buffer=shm.buf)
+        store = cls(unpack_las({**handle, "array": array}))
+        store._shm = shm
+        return store
+
+    @property
+    def index(self):
+        """
+        spatial_index.GridIndex: The spatial index of the points, built on first use.
+        """
+        if self._index is None:
+            self._index = GridIndex(self.las().xyz)
+        return self._index
+
+    def las(self, bbox=None, indices=None):
+        """
+        Returns the points, or a part of them, as a LAS.
+
+        The header is copied, so the LAS can get extra dimensions without changing the store. Without bbox and
+        indices the points are a view of the store rather than a copy.
+
+        Args:
+            bbox (list, optional): Only return the points within [minx, miny, minz, maxx, maxy, maxz] or
+                [minx, miny, maxx, maxy]. The bounds are inclusive. Defaults to None.
+            indices (numpy.ndarray, optional): Only return the points at these indices. Defaults to None.
+
+        Returns:
+            laspy.LasData: The points.
+
+        """
+        array = self.array
+        if bbox is not None:
+            indices = self.index.query_bbox(bbox)
+        if indices is not None:
+            array = array[indices]
+        header = copy.deepcopy(self.header)
+        points = laspy.ScaleAwarePointRecord(
+            array, header.point_format, header.scales, header.offsets
+        )
+        return laspy.LasData(header, points)
+
+    def share(self):
+        """
+        Moves the points to shared memory and returns the handle to attach to them.
+
+        Returns:
+            dict: The handle, to be passed to PointStore.attach in a worker process.
+
+        """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(self.array.nbytes, 1)
+            )
+            self._owner = True
+            shared = np.ndarray(
+                self.array.shape, dtype=self.array.dtype, buffer=self._shm.buf
+            )
+            shared[:] = self.array
+            self.array = shared
+        return {
+            "name": self._shm.name,
+            "shape": self.array.shape,
+            "dtype": self.array.dtype,
+            **pack_header(self.header),
+        }
+
+    def close(self):
+        """
+        Releases the shared memory of the store. The store can not be used afterwards if it was shared.
+        """
+        if self._shm is None:
+            return
+        self.array = None
+        self._index = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
@@ -1,8 +1,13 @@
-import os
+import copy
 
+import config as cfg
+import laspy
 import numpy as np
-import pdal
-from ptio import read_laz
+from cache import StageCache
+from pipeline import Pipeline
+from ptio import iter_laz
+
+THINNING_MODES = ("nth", "random", "grid")
 
 
 def remove_outliers(input_path, output_path, nb_neighbors=10, std_ratio=2.0):
@@ -15,50 +20,141 @@ def remove_outliers(input_path, output_path, nb_neighbors=10, std_ratio=2.0):
         nb_neighbors (int, optional): Number of neighbors to consider for outlier detection. Defaults to 10.
         std_ratio (float, optional): Standard deviation ratio for outlier detection. Defaults to 2.0.
     """
-    pipeline_setting = """
-    [
-        "{input}",
-        {{
-            "type": "filters.outlier",
-            "method": "statistical",
-            "mean_k": {nb_neighbors},
-            "multiplier": {std_ratio}
-        }},
-        "{output}"
-    ]
-    """.format(
-        input=input_path,
-        output=output_path,
-        nb_neighbors=nb_neighbors,
-        std_ratio=std_ratio,
-    )
-    pipeline = pdal.Pipeline(pipeline_setting)
-    pipeline.execute()
+    pipeline = Pipeline(input_path, output_path)
+    pipeline.outlier(nb_neighbors, std_ratio).execute()
 
 
-def clip_pc(las, bbox):  # bbox = [minx, miny, minz, maxx, maxy, maxz]
-    x_invalid = (bbox[0] <= las.points.x) & (bbox[3] >= las.points.x)
-    y_invalid = (bbox[1] <= las.points.y) & (bbox[4] >= las.points.y)
-    z_invalid = (bbox[2] <= las.points.z) & (bbox[5] >= las.points.z)
-    good_indices = np.where(x_invalid & y_invalid & z_invalid)[0]
-    las.points = las.points[good_indices]
+def nth_thinning(input_path, n, output_path):
+    thinning(input_path, output_path, "nth", n=n)
 
 
-def nth_thinning(input_path, n, output_path):
-    las = read_laz(input_path)
-    valid_indices = np.array([i for i in range(len(las.points)) if i % n == 0])
-    las.points = las.points[valid_indices]
-    las.write(output_path)
-
-
-def preprocess(original_filename):
-    thinned_filename = f"{os.path.splitext(original_filename)[0]}_thinned.las"
-    no_outlier_filename = f"{os.path.splitext(thinned_filename)[0]}_no_outliers.las"
-
-    if not os.path.isfile(thinned_filename):
-        nth_thinning(original_filename, 2, thinned_filename)
-        print("===thinned file created===")
-    if not os.path.isfile(no_outlier_filename):
-        remove_outliers(thinned_filename, no_outlier_filename)
-        print("===no outlier file created===")
+def thinning(
+    input_path,
+    output_path,
+    mode="nth",
+    n=2,
+    seed=0,
+    voxel_size=1.0,
+    keep="lowest",
+    chunk_size=1_000_000,
+):
+    """
+    Thin a point cloud while streaming it chunk by chunk, so memory stays bounded by the chunk size.
+
+    Args:
+        input_path (str): Path to the input point cloud file.
+        output_path (str): Path to save the output point cloud file.
+        mode (str, optional): One of THINNING_MODES. "nth" keeps every nth point, "random" keeps each point with
+            a probability of 1 / n, and "grid" keeps the lowest or highest point of every voxel. Defaults to "nth".
+        n (int, optional): The thinning factor of the "nth" and "random" modes. Defaults to 2.
+        seed (int, optional): The seed of the "random" mode. Defaults to 0.
+        voxel_size (float, optional): The size of the voxels of the "grid" mode. Defaults to 1.0.
+        keep (str, optional): "lowest" or "highest", the point kept per voxel in the "grid" mode. Defaults to "lowest".
+        chunk_size (int, optional): The number of points per chunk. Defaults to 1_000_000.
+    """
+    if mode not in THINNING_MODES:
+        raise ValueError(f"mode must be one of {THINNING_MODES}")
+    if keep not in ("lowest", "highest"):
+        raise ValueError('keep must be "lowest" or "highest"')
+
+    if mode == "grid":
+        kept = _lowest_or_highest_per_voxel(input_path, voxel_size, keep, chunk_size)
+    else:
+        rng = np.random.default_rng(seed)
+
+    with laspy.open(input_path, "r") as reader:
+        header = copy.deepcopy(reader.header)
+    with laspy.open(output_path, mode="w", header=header) as writer:
+        offset = 0
+        for chunk in iter_laz(input_path, chunk_size):
+            if mode == "nth":
+                mask = (offset + np.arange(len(chunk))) % n == 0
+            elif mode == "random":
+                mask = rng.random(len(chunk)) < 1 / n
+            else:
+                start, stop = np.searchsorted(kept, [offset, offset + len(chunk)])
+                mask = np.zeros(len(chunk), dtype=bool)
+                mask[kept[start:stop] - offset] = True
+            writer.write_points(chunk[mask])
+            offset += len(chunk)
+
+
+def _lowest_or_highest_per_voxel(input_path, voxel_size, keep, chunk_size):
+    """
+    Find the lowest or highest point of every voxel of a point cloud, streaming it chunk by chunk.
+
+    Every chunk is reduced to one point per voxel and merged with the points kept so far, so the memory is bounded
+    by the number of occupied voxels instead of the number of points.
+
+    Args:
+        input_path (str): Path to the input point cloud file.
+        voxel_size (float): The size of the voxels.
+        keep (str): "lowest" or "highest".
+        chunk_size (int): The number of points per chunk.
+
+    Returns:
+        numpy.ndarray: The sorted indices of the kept points in the file.
+    """
+    with laspy.open(input_path, "r") as reader:
+        mins = reader.header.mins
+        shape = np.floor((reader.header.maxs - mins) / voxel_size).astype(np.int64) + 1
+
+    kept_keys = np.empty(0, dtype=np.int64)
+    kept_z = np.empty(0)
+    kept_indices = np.empty(0, dtype=np.int64)
+    offset = 0
+    for chunk in iter_laz(input_path, chunk_size):
+        xyz = np.column_stack((chunk.x, chunk.y, chunk.z))
+        voxel = np.clip(
+            np.floor((xyz - mins) / voxel_size).astype(np.int64), 0, shape - 1
+        )
+        keys = (voxel[:, 0] * shape[1] + voxel[:, 1]) * shape[2] + voxel[:, 2]
+
+        keys = np.concatenate((kept_keys, keys))
+        z = np.concatenate((kept_z, xyz[:, 2]))
+        indices = np.concatenate(
+            (kept_indices, offset + np.arange(len(xyz), dtype=np.int64))
+        )
+        order = np.lexsort((z if keep == "lowest" else -z, keys))
+        first = np.r_[True, keys[order][1:] != keys[order][:-1]]
+        kept_keys, kept_z, kept_indices = (
+            keys[order][first],
+            z[order][first],
+            indices[order][first],
+        )
+        offset += len(xyz)
+    return np.sort(kept_indices)
+
+
+def preprocess(original_filename, cache=None):
+    """
+    Thin the point cloud and remove its outliers, reusing the cached outputs of earlier runs.
+
+    Args:
+        original_filename (str): Path to the original point cloud file.
+        cache (StageCache, optional): The cache of the stage outputs. Defaults to the cache configured in config.py.
+
+    Returns:
+        str: Path to the preprocessed point cloud file.
+    """
+    if cache is None:
+        cache = StageCache(cfg.CACHE_DIR, cfg.CACHE_MAX_BYTES)
+    thinned_filename = cache.get_or_create(
+        "thinned",
+        [original_filename],
+        cfg.THINNING_PARAMS,
+        lambda output_path: thinning(
+            original_filename, output_path, **cfg.THINNING_PARAMS
+        ),
+        ".las",
+    )
+    no_outlier_filename = cache.get_or_create(
+        "no_outliers",
+        [thinned_filename],
+        cfg.OUTLIER_PARAMS,
+        lambda output_path: remove_outliers(
+            thinned_filename, output_path, **cfg.OUTLIER_PARAMS
+        ),
+        ".las",
+    )
     return no_outlier_filename
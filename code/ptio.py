@@ -1,13 +1,435 @@
+import math
+import os
+
 import laspy
+import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# laspy dimension names and their PDAL names
+PDAL_DIMENSIONS = {
+    "x": "X",
+    "y": "Y",
+    "z": "Z",
+    "intensity": "Intensity",
+    "return_number": "ReturnNumber",
+    "number_of_returns": "NumberOfReturns",
+    "scan_direction_flag": "ScanDirectionFlag",
+    "edge_of_flight_line": "EdgeOfFlightLine",
+    "classification": "Classification",
+    "scan_angle_rank": "ScanAngleRank",
+    "user_data": "UserData",
+    "point_source_id": "PointSourceId",
+    "gps_time": "GpsTime",
+    "red": "Red",
+    "green": "Green",
+    "blue": "Blue",
+    "nir": "Infrared",
+}
+
+# the size of the internal tiles of the rasters written by RasterWriter, a multiple of 16
+RASTER_BLOCK_SIZE = 256
+
+
+def read_laz(file_path, bbox=None, chunk_size=1_000_000):
+    """
+    Reads a LAS/LAZ file.
+
+    Args:
+        file_path (str): The path of the LAS/LAZ file.
+        bbox (list, optional): Only keep the points within [minx, miny, minz, maxx, maxy, maxz] or
+            [minx, miny, maxx, maxy]. The file is streamed in chunks and filtered while reading, so the points
+            outside of the bbox are never held in memory all at once. Defaults to None (all points).
+        chunk_size (int, optional): The number of points per chunk when bbox is given. Defaults to 1_000_000.
+
+    Returns:
+        laspy.LasData: The points.
+    """
+    if bbox is None:
+        with laspy.open(file_path, "r") as f:
+            las = f.read()
+            return las
 
+    with laspy.open(file_path, "r") as f:
+        header = f.header
+    chunks = [chunk.array for chunk in iter_laz(file_path, chunk_size, bbox)]
+    array = (
+        np.concatenate(chunks)
+        if chunks
+        else np.zeros(0, dtype=header.point_format.dtype())
+    )
+    points = laspy.ScaleAwarePointRecord(
+        array, header.point_format, header.scales, header.offsets
+    )
+    return laspy.LasData(header, points)
+
+
+def iter_laz(file_path, chunk_size=1_000_000, bbox=None, dims=None):
+    """
+    Streams the points of a LAS/LAZ file in chunks.
+
+    Args:
+        file_path (str): The path of the LAS/LAZ file.
+        chunk_size (int, optional): The number of points decoded per chunk. Defaults to 1_000_000.
+        bbox (list, optional): Only yield the points within [minx, miny, minz, maxx, maxy, maxz] or
+            [minx, miny, maxx, maxy]. Defaults to None (all points).
+        dims (list, optional): Only yield these dimensions, e.g. ["x", "y", "z", "classification"], as a numpy
+            structured array. x, y and z are scaled. Defaults to None (laspy point records with all dimensions).
 
-def read_laz(file_path):
+    Yields:
+        laspy.ScaleAwarePointRecord or numpy.ndarray: The points of a chunk, skipping chunks without any point.
+    """
     with laspy.open(file_path, "r") as f:
-        las = f.read()
-        return las
+        if bbox is not None and not _bbox_intersects_header(f.header, bbox):
+            return
+        for chunk in f.chunk_iterator(chunk_size):
+            if bbox is not None:
+                chunk = chunk[bbox_mask(chunk, bbox)]
+            if len(chunk) == 0:
+                continue
+            if dims is None:
+                yield chunk
+                continue
+            columns = [np.asarray(chunk[dim]) for dim in dims]
+            array = np.empty(
+                len(chunk),
+                dtype=[(dim, column.dtype) for dim, column in zip(dims, columns)],
+            )
+            for dim, column in zip(dims, columns):
+                array[dim] = column
+            yield array
+
+
+def bbox_mask(points, bbox):
+    """
+    Returns the mask of the points within a bounding box. The bounds are inclusive.
+
+    Args:
+        points (laspy.ScaleAwarePointRecord): The points.
+        bbox (list): The bounding box [minx, miny, minz, maxx, maxy, maxz] or [minx, miny, maxx, maxy].
+
+    Returns:
+        numpy.ndarray: The boolean mask.
+    """
+    x, y = np.asarray(points.x), np.asarray(points.y)
+    if len(bbox) == 4:
+        return (bbox[0] <= x) & (bbox[2] >= x) & (bbox[1] <= y) & (bbox[3] >= y)
+    z = np.asarray(points.z)
+    return (
+        (bbox[0] <= x)
+        & (bbox[3] >= x)
+        & (bbox[1] <= y)
+        & (bbox[4] >= y)
+        & (bbox[2] <= z)
+        & (bbox[5] >= z)
+    )
+
+
+def _bbox_intersects_header(header, bbox):
+    """
+    Checks whether a bounding box intersects the bounds recorded in a LAS header.
+
+    Args:
+        header (laspy.LasHeader): The header.
+        bbox (list): The bounding box [minx, miny, minz, maxx, maxy, maxz] or [minx, miny, maxx, maxy].
+
+    Returns:
+        bool: False if no point of the file can be within the bounding box.
+    """
+    dims = 2 if len(bbox) == 4 else 3
+    bbox_mins, bbox_maxs = bbox[:dims], bbox[dims:]
+    return all(
+        bbox_mins[i] <= header.maxs[i] and bbox_maxs[i] >= header.mins[i]
+        for i in range(dims)
+    )
+
+
+def pack_las(las, indices=None):
+    """
+    Packs the points of a LAS into plain numpy arrays and values, e.g. to send them to a worker process.
+
+    Args:
+        las (laspy.LasData): The LAS to pack.
+        indices (numpy.ndarray, optional): The indices of the points to pack. Defaults to all points.
+
+    Returns:
+        dict: The packed points, to be restored with unpack_las.
+    """
+    array = las.points.array if indices is None else las.points.array[indices]
+    return {"array": array, **pack_header(las.header)}
+
+
+def pack_header(header):
+    """
+    Packs the point format, scales and offsets of a LAS header into plain values.
+
+    Args:
+        header (laspy.LasHeader): The header to pack.
+
+    Returns:
+        dict: The packed header, the same as the output of pack_las without the array.
+    """
+    point_format = header.point_format
+    return {
+        "point_format": point_format.id,
+        "version": str(header.version),
+        "scales": header.scales,
+        "offsets": header.offsets,
+        "extra_dims": [
+            (dim.name, dim.dtype.str) for dim in point_format.extra_dimensions
+        ],
+    }
+
+
+def unpack_las(packed):
+    """
+    Restores a LAS from the output of pack_las.
+
+    Args:
+        packed (dict): The packed points.
+
+    Returns:
+        laspy.LasData: The restored LAS.
+    """
+    header = laspy.LasHeader(
+        point_format=packed["point_format"], version=packed["version"]
+    )
+    for name, dtype in packed["extra_dims"]:
+        header.add_extra_dims([laspy.ExtraBytesParams(name=name, type=dtype)])
+    header.scales = packed["scales"]
+    header.offsets = packed["offsets"]
+    points = laspy.ScaleAwarePointRecord(
+        packed["array"], header.point_format, header.scales, header.offsets
+    )
+    return laspy.LasData(header, points)
+
+
+def las_to_pdal_array(las, dims=PDAL_DIMENSIONS):
+    """
+    Converts the points of a LAS into a numpy structured array that PDAL can read directly.
+
+    Args:
+        las (laspy.LasData): The LAS to convert.
+        dims (dict, optional): The laspy dimension names mapped to their PDAL names. Dimensions missing from the
+            LAS are skipped. Defaults to PDAL_DIMENSIONS.
+
+    Returns:
+        numpy.ndarray: The points with PDAL dimension names.
+    """
+    # the scaled x, y and z are not listed in the dimension names
+    names = set(las.point_format.dimension_names) | {"x", "y", "z"}
+    columns = {
+        pdal_name: np.asarray(las[name])
+        for name, pdal_name in dims.items()
+        if name in names
+    }
+    array = np.empty(
+        len(las.points),
+        dtype=[(pdal_name, column.dtype) for pdal_name, column in columns.items()],
+    )
+    for pdal_name, column in columns.items():
+        array[pdal_name] = column
+    return array
+
+
+def pdal_array_to_las(array, header, extra_dims=()):
+    """
+    Converts a numpy structured array returned by PDAL into a LAS.
+
+    Args:
+        array (numpy.ndarray): The points with PDAL dimension names.
+        header (laspy.LasHeader): The header to take the point format, scales and offsets from.
+        extra_dims (tuple, optional): The PDAL dimensions without LAS equivalent to add as extra dimensions,
+            e.g. ("ClusterID",). Defaults to ().
+
+    Returns:
+        laspy.LasData: The points as a LAS.
+    """
+    new_header = laspy.LasHeader(
+        point_format=header.point_format.id, version=str(header.version)
+    )
+    new_header.scales = header.scales
+    new_header.offsets = header.offsets
+    las = laspy.LasData(new_header)
+    las.points = laspy.ScaleAwarePointRecord.zeros(len(array), header=new_header)
+    # the scaled x, y and z are not listed in the dimension names
+    names = set(las.point_format.dimension_names) | {"x", "y", "z"}
+    for name, pdal_name in PDAL_DIMENSIONS.items():
+        if name in names and pdal_name in array.dtype.names:
+            las[name] = array[pdal_name]
+    for pdal_name in extra_dims:
+        las.add_extra_dim(
+            laspy.ExtraBytesParams(name=pdal_name, type=array.dtype[pdal_name])
+        )
+        las[pdal_name] = array[pdal_name]
+    return las
+
+
+def write_ras(file_path, profile, data, cog=False):
+    """
+    Writes a single band raster at once, as a tiled and compressed GeoTIFF.
+
+    Args:
+        file_path (str): The path of the raster.
+        profile (dict): The rasterio profile, with at least dtype, nodata, width, height, crs and transform.
+        data (numpy.ndarray): The values, shape (height, width).
+        cog (bool, optional): Whether to write a Cloud-Optimized GeoTIFF. Defaults to False.
+    """
+    with RasterWriter(file_path, profile, cog=cog) as writer:
+        writer.write(data)
+
+
+class RasterWriter:
+    """
+    Writes a single band raster block by block, as an internally tiled, deflate-compressed GeoTIFF or COG.
+
+    Blocks can be written in any order and size. They are split along the internal tiles, and the parts that
+    only contain nodata are not written at all: the GeoTIFF is sparse, and reading a missing tile returns
+    nodata. Overviews are built when the writer is closed. A COG is first written as a GeoTIFF next to
+    file_path and then copied into the COG layout.
+
+    Use it as a context manager, or call close().
+
+    Args:
+        file_path (str): The path of the raster.
+        profile (dict): The rasterio profile, with at least dtype, nodata, width, height, crs and transform.
+            The driver and the tiling and compression options are set by the writer.
+        block_size (int, optional): The size of the internal tiles in pixels, a multiple of 16.
+            Defaults to RASTER_BLOCK_SIZE.
+        cog (bool, optional): Whether to write a Cloud-Optimized GeoTIFF. Defaults to False.
+        overviews (bool, optional): Whether to build overviews, halving the resolution until the raster fits in
+            one tile. Defaults to True.
+
+    Methods:
+        write(data, row_off=0, col_off=0): Writes a block of values.
+        close(): Builds the overviews and finishes the raster.
+
+    """
+
+    def __init__(
+        self,
+        file_path,
+        profile,
+        block_size=RASTER_BLOCK_SIZE,
+        cog=False,
+        overviews=True,
+    ):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.cog = cog
+        self.overviews = overviews
+        self.nodata = profile.get("nodata")
+        dtype = np.dtype(profile["dtype"])
+        self._predictor = 3 if dtype.kind == "f" else 2
+        self.profile = {
+            **profile,
+            "driver": "GTiff",
+            "count": 1,
+            "tiled": True,
+            "blockxsize": block_size,
+            "blockysize": block_size,
+            "compress": "deflate",
+            "predictor": self._predictor,
+            "sparse_ok": True,
+            "bigtiff": "IF_SAFER",
+        }
+        if cog:
+            root, ext = os.path.splitext(file_path)
+            self._gtiff_path = f"{root}.gtiff{ext}"
+        else:
+            self._gtiff_path = file_path
+        self._dst = rasterio.open(self._gtiff_path, "w", **self.profile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # do not leave a half written raster behind
+        self._dst.close()
+        for path in {self._gtiff_path, self.file_path}:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def write(self, data, row_off=0, col_off=0):
+        """
+        Writes a block of values. The parts of the block that only contain nodata are skipped.
+
+        Args:
+            data (numpy.ndarray): The values, shape (rows, cols).
+            row_off (int, optional): The row of the raster of the first row of data. Defaults to 0.
+            col_off (int, optional): The column of the raster of the first column of data. Defaults to 0.
+        """
+        data = np.asarray(data, dtype=self.profile["dtype"])
+        size = self.block_size
+        row_end, col_end = row_off + data.shape[0], col_off + data.shape[1]
+        # split the block along the internal tiles of the raster
+        for row in range(row_off - row_off % size, row_end, size):
+            rows = slice(
+                max(row, row_off) - row_off, min(row + size, row_end) - row_off
+            )
+            for col in range(col_off - col_off % size, col_end, size):
+                cols = slice(
+                    max(col, col_off) - col_off, min(col + size, col_end) - col_off
+                )
+                part = data[rows, cols]
+                if self._is_nodata(part):
+                    continue
+                window = Window(
+                    col_off + cols.start,
+                    row_off + rows.start,
+                    part.shape[1],
+                    part.shape[0],
+                )
+                self._dst.write(part, 1, window=window)
+
+    def close(self):
+        """
+        Builds the overviews and finishes the raster, and copies it into the COG layout if cog is set.
+        """
+        if self._dst.closed:
+            return
+        if self.overviews:
+            factors = self._overview_factors()
+            if factors:
+                self._dst.build_overviews(factors, Resampling.average)
+                self._dst.update_tags(ns="rio_overview", resampling="average")
+        self._dst.close()
+        if self.cog:
+            rasterio.shutil.copy(
+                self._gtiff_path,
+                self.file_path,
+                driver="COG",
+                blocksize=self.block_size,
+                compress="deflate",
+                predictor="YES",
+                overviews="FORCE_USE_EXISTING" if self.overviews else "NONE",
+                sparse_ok=True,
+                bigtiff="IF_SAFER",
+            )
+            os.remove(self._gtiff_path)
 
+    def _is_nodata(self, data):
+        """
+        Checks whether a part of a block only contains nodata.
+        """
+        if self.nodata is None:
+            return False
+        if np.isnan(self.nodata):
+            return bool(np.all(np.isnan(data)))
+        return bool(np.all(data == self.nodata))
 
-def write_ras(file_path, profile, data):
-    with rasterio.open(file_path, "w", **profile) as dst:
-        dst.write(data, 1)
+    def _overview_factors(self):
+        """
+        Returns the overview factors, halving the resolution until the raster fits in one tile.
+        """
+        factors = []
+        size = max(self.profile["width"], self.profile["height"])
+        while size > self.block_size:
+            size = math.ceil(size / 2)
+            factors.append(2 ** (len(factors) + 1))
+        return factors
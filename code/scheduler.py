@@ -0,0 +1,140 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import instrument
+
+
+class Scheduler:
+    """
+    Runs the stages of a pipeline as a DAG in a process pool.
+
+    Every stage declares the stages whose outputs it takes as inputs. A stage is started as soon as all of its
+    inputs are available, so stages without a dependency between them run concurrently, and a dependent stage
+    waits until its inputs are done. The stage functions and their arguments are sent to worker processes, so
+    they must be picklable (module level functions, plain values).
+
+    Args:
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Attributes:
+        timings (dict): The wall time of every stage run, in seconds. The time spent within the stages, and
+            their counters, are added to the run report of instrument.py.
+
+    Methods:
+        add(name, func, *args, inputs): Adds a stage.
+        provide(name, result): Provides the output of a stage that does not have to run, e.g. a cached one.
+        run(): Runs the stages and returns their outputs.
+
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.timings = {}
+        self._stages = {}
+        self._results = {}
+
+    def add(self, name, func, *args, inputs=()):
+        """
+        Adds a stage. It is run as func(*outputs of the inputs, *args), and its output is the return value.
+
+        Args:
+            name (str): The name of the stage.
+            func (callable): The function of the stage.
+            *args: The other arguments of func.
+            inputs (tuple, optional): The names of the stages whose outputs are passed to func. Defaults to ().
+
+        """
+        self._check_new(name)
+        self._stages[name] = (func, args, tuple(inputs))
+
+    def provide(self, name, result):
+        """
+        Provides the output of a stage that does not have to run, e.g. a cached one.
+
+        Args:
+            name (str): The name of the stage.
+            result: The output of the stage.
+
+        """
+        self._check_new(name)
+        self._results[name] = result
+
+    def run(self):
+        """
+        Runs the stages and returns their outputs. The wall time of every stage is printed and kept in timings.
+
+        Returns:
+            dict: The output of every stage, including the provided ones.
+
+        """
+        for name, (_, _, inputs) in self._stages.items():
+            unknown = [
+                i for i in inputs if i not in self._stages and i not in self._results
+            ]
+            if unknown:
+                raise ValueError(f"stage {name!r} has unknown inputs {unknown}")
+
+        pending = dict(self._stages)
+        running = {}
+        start = time.perf_counter()
+        with ProcessPoolExecutor(
+            max_workers=self.workers or os.cpu_count()
+        ) as executor:
+            while pending or running:
+                ready = [
+                    name
+                    for name, (_, _, inputs) in pending.items()
+                    if all(i in self._results for i in inputs)
+                ]
+                for name in ready:
+                    func, args, inputs = pending.pop(name)
+                    instrument.log(f"==={name}: started===")
+                    future = executor.submit(
+                        _run_stage,
+                        name,
+                        func,
+                        *[self._results[i] for i in inputs],
+                        *args,
+                    )
+                    running[future] = (name, time.perf_counter())
+                if not running:
+                    raise ValueError(f"stages {sorted(pending)} have cyclic inputs")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, started = running.pop(future)
+                    self._results[name], report = future.result()
+                    instrument.merge(report)
+                    self.timings[name] = time.perf_counter() - started
+                    instrument.log(f"==={name}: done in {self.timings[name]:.2f} s===")
+
+        instrument.log("=========Stage timings=========")
+        for name, seconds in self.timings.items():
+            instrument.log(f"{name}: {seconds:.2f} s")
+        instrument.log(f"total: {time.perf_counter() - start:.2f} s")
+        instrument.log("===============================")
+        return dict(self._results)
+
+    def _check_new(self, name):
+        if name in self._stages or name in self._results:
+            raise ValueError(f"stage {name!r} is already defined")
+
+
+def _run_stage(name, func, *args):
+    """
+    Runs a stage in a worker process, and collects the instrumentation of the worker for the run report.
+
+    Args:
+        name (str): The name of the stage.
+        func (callable): The function of the stage.
+        *args: The arguments of func.
+
+    Returns:
+        tuple: The output of the stage and the report of the worker (see instrument.report).
+    """
+    # a worker may have run other stages before, or inherited the report of the parent when forked
+    instrument.reset()
+    with instrument.stage(name):
+        result = func(*args)
+    return result, instrument.report()
@@ -0,0 +1,279 @@
+import math
+
+import numpy as np
+from binning import cell_keys
+
+
+class GridIndex:
+    """
+    Spatial index over a point array based on a sorted uniform grid.
+
+    The points are bucketed into square cells once, and sorted by cell so that every cell is a contiguous
+    range of the sorted array. A bounding box query then only visits the cells overlapping the box, so it
+    costs time proportional to the number of points returned instead of a full scan over all points.
+
+    Args:
+        points (numpy.ndarray): The point coordinates, shape (N, 2) or (N, 3).
+        cell_size (float, optional): The size of each cell. Defaults to a size giving about points_per_cell
+            points per cell.
+        points_per_cell (int, optional): The average number of points per cell used to derive the default
+            cell size. Defaults to 16.
+
+    Attributes:
+        points (numpy.ndarray): The indexed points, in their original order.
+        cell_size (float): The size of each cell.
+        origin (numpy.ndarray): The lower left corner of the grid [minx, miny].
+        shape (tuple): The number of rows and columns of the grid (nrows, ncols).
+
+    Methods:
+        query_bbox(bbox): Returns the indices of the points within a bounding box.
+
+    """
+
+    def __init__(self, points, cell_size=None, points_per_cell=16):
+        points = np.asarray(points)
+        if points.ndim != 2 or points.shape[1] < 2:
+            raise ValueError("points must have shape (N, 2) or (N, 3)")
+        self.points = points
+        self._has_z = points.shape[1] >= 3
+        self.origin = points[:, :2].min(axis=0) if len(points) else np.zeros(2)
+        extent = points[:, :2].max(axis=0) - self.origin if len(points) else np.ones(2)
+        if cell_size is None:
+            area = max(extent[0], 1.0) * max(extent[1], 1.0)
+            cell_size = math.sqrt(area * points_per_cell / max(len(points), 1))
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        self.cell_size = cell_size
+        self.shape = (
+            math.floor(extent[1] / cell_size) + 1,
+            math.floor(extent[0] / cell_size) + 1,
+        )
+
+        _, keys = cell_keys(points, self.origin, cell_size, self.shape)
+        self._order = np.argsort(keys, kind="stable")
+        self._points = points[self._order]
+        self._cell_starts = np.searchsorted(
+            keys[self._order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+
+    def __len__(self):
+        return len(self._order)
+
+    def query_bbox(self, bbox):
+        """
+        Returns the indices of the points within a bounding box. The bounds are inclusive.
+
+        Args:
+            bbox (list): The bounding box [minx, miny, maxx, maxy], or [minx, miny, minz, maxx, maxy, maxz] to
+                also filter on z.
+
+        Returns:
+            numpy.ndarray: The indices of the points, in ascending order.
+
+        """
+        if len(bbox) == 6:
+            minx, miny, minz, maxx, maxy, maxz = bbox
+            if not self._has_z:
+                raise ValueError("a 6 element bbox needs an index built on xyz points")
+        elif len(bbox) == 4:
+            minx, miny, maxx, maxy = bbox
+        else:
+            raise ValueError("bbox must have 4 or 6 elements")
+
+        nrows, ncols = self.shape
+        col_min = max(math.floor((minx - self.origin[0]) / self.cell_size), 0)
+        col_max = min(math.floor((maxx - self.origin[0]) / self.cell_size), ncols - 1)
+        row_min = max(math.floor((miny - self.origin[1]) / self.cell_size), 0)
+        row_max = min(math.floor((maxy - self.origin[1]) / self.cell_size), nrows - 1)
+        if col_min > col_max or row_min > row_max or len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # every row of the query is one contiguous range of the sorted points
+        rows = np.arange(row_min, row_max + 1)
+        starts = self._cell_starts[rows * ncols + col_min]
+        ends = self._cell_starts[rows * ncols + col_max + 1]
+        candidates = concatenate_ranges(starts, ends)
+
+        points = self._points[candidates]
+        valid = (
+            (minx <= points[:, 0])
+            & (maxx >= points[:, 0])
+            & (miny <= points[:, 1])
+            & (maxy >= points[:, 1])
+        )
+        if len(bbox) == 6:
+            valid &= (minz <= points[:, 2]) & (maxz >= points[:, 2])
+        return np.sort(self._order[candidates[valid]])
+
+
+class TriangleIndex:
+    """
+    Locates many points in a triangulation at once.
+
+    Every triangle is registered in the cells of a uniform grid overlapping its bounding box, sorted by cell
+    like the points of GridIndex. A point is then only tested against the triangles of its own cell, with
+    barycentric weights computed for all points and candidate triangles in a few numpy operations.
+
+    Args:
+        vertices (numpy.ndarray): The vertex coordinates, shape (N, 2) or (N, 3).
+        triangles (numpy.ndarray): The vertex indices of the triangles, shape (M, 3).
+        cell_size (float, optional): The size of each cell. Defaults to a size giving about triangles_per_cell
+            triangles per cell.
+        triangles_per_cell (int, optional): The average number of triangles per cell used to derive the default
+            cell size. Defaults to 4.
+
+    Attributes:
+        cell_size (float): The size of each cell.
+        origin (numpy.ndarray): The lower left corner of the grid [minx, miny].
+        shape (tuple): The number of rows and columns of the grid (nrows, ncols).
+
+    Methods:
+        locate(xy): Returns the triangles containing the points and the barycentric weights of the points.
+
+    """
+
+    # the number of points located at once, to bound the memory of the candidate pairs
+    BATCH_SIZE = 65_536
+
+    def __init__(self, vertices, triangles, cell_size=None, triangles_per_cell=4):
+        triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        corners = np.asarray(vertices, dtype=np.float64)[triangles][:, :, :2]
+        self._affine = _barycentric_transforms(corners)
+        lower = np.minimum(np.minimum(corners[:, 0], corners[:, 1]), corners[:, 2])
+        upper = np.maximum(np.maximum(corners[:, 0], corners[:, 1]), corners[:, 2])
+        self.origin = lower.min(axis=0) if len(corners) else np.zeros(2)
+        extent = upper.max(axis=0) - self.origin if len(corners) else np.ones(2)
+        if cell_size is None:
+            area = max(extent[0], 1.0) * max(extent[1], 1.0)
+            cell_size = math.sqrt(area * triangles_per_cell / max(len(triangles), 1))
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        self.cell_size = cell_size
+        self.shape = (
+            math.floor(extent[1] / cell_size) + 1,
+            math.floor(extent[0] / cell_size) + 1,
+        )
+
+        # one entry per triangle and cell overlapping its bounding box
+        first = np.floor((lower - self.origin) / cell_size).astype(np.int64)
+        last = np.floor((upper - self.origin) / cell_size).astype(np.int64)
+        last = np.minimum(last, [self.shape[1] - 1, self.shape[0] - 1])
+        widths = last[:, 0] - first[:, 0] + 1
+        counts = widths * (last[:, 1] - first[:, 1] + 1)
+        entries = concatenate_ranges(np.zeros_like(counts), counts)
+        triangle_ids = np.repeat(np.arange(len(counts)), counts)
+        cols = first[triangle_ids, 0] + entries % widths[triangle_ids]
+        rows = first[triangle_ids, 1] + entries // widths[triangle_ids]
+        keys = rows * self.shape[1] + cols
+        order = np.argsort(keys, kind="stable")
+        self._cell_triangles = triangle_ids[order]
+        self._cell_starts = np.searchsorted(
+            keys[order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+
+    def locate(self, xy):
+        """
+        Returns the triangles containing the points and the barycentric weights of the points in them.
+
+        A point on an edge shared by two triangles gets one of them.
+
+        Args:
+            xy (numpy.ndarray): The point coordinates, shape (N, 2) or wider.
+
+        Returns:
+            tuple: The indices of the triangles (numpy.ndarray, -1 for points outside of the triangulation) and
+            the weights of their three vertices (numpy.ndarray (N, 3), NaN for points outside).
+
+        """
+        xy = np.asarray(xy, dtype=np.float64)[:, :2]
+        triangles = np.full(len(xy), -1, dtype=np.int64)
+        weights = np.full((len(xy), 3), np.nan)
+        if len(self._affine) == 0:
+            return triangles, weights
+        for start in range(0, len(xy), self.BATCH_SIZE):
+            batch = slice(start, start + self.BATCH_SIZE)
+            triangles[batch], weights[batch] = self._locate_batch(xy[batch])
+        return triangles, weights
+
+    def _locate_batch(self, xy):
+        """
+        Locates one batch of points, see locate.
+        """
+        triangles = np.full(len(xy), -1, dtype=np.int64)
+        weights = np.full((len(xy), 3), np.nan)
+        nrows, ncols = self.shape
+        cells = np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+        in_grid = np.flatnonzero(
+            (cells[:, 0] >= 0)
+            & (cells[:, 0] < ncols)
+            & (cells[:, 1] >= 0)
+            & (cells[:, 1] < nrows)
+        )
+        keys = cells[in_grid, 1] * ncols + cells[in_grid, 0]
+        starts = self._cell_starts[keys]
+        ends = self._cell_starts[keys + 1]
+        # every point paired with every triangle of its cell
+        points = np.repeat(in_grid, ends - starts)
+        candidates = self._cell_triangles[concatenate_ranges(starts, ends)]
+        affine = self._affine[candidates]
+        dx = xy[points, 0] - affine[:, 0]
+        dy = xy[points, 1] - affine[:, 1]
+        w1 = affine[:, 2] * dx + affine[:, 3] * dy
+        w2 = affine[:, 4] * dx + affine[:, 5] * dy
+        w0 = 1 - w1 - w2
+        inside = np.flatnonzero((w0 >= -1e-9) & (w1 >= -1e-9) & (w2 >= -1e-9))
+        if len(inside) == 0:
+            return triangles, weights
+        # the pairs are ordered by point, so the first inside pair of every point is where the point changes
+        first = inside[np.r_[True, points[inside][1:] != points[inside][:-1]]]
+        triangles[points[first]] = candidates[first]
+        weights[points[first]] = np.column_stack((w0[first], w1[first], w2[first]))
+        return triangles, weights
+
+
+def _barycentric_transforms(corners):
+    """
+    Precomputes the affine transforms from xy to the barycentric weights of the second and third vertices.
+
+    Args:
+        corners (numpy.ndarray): The xy coordinates of the vertices of the triangles, shape (M, 3, 2).
+
+    Returns:
+        numpy.ndarray: Per triangle [x0, y0, a, b, c, d], with w1 = a * (x - x0) + b * (y - y0) and
+        w2 = c * (x - x0) + d * (y - y0). The weights are NaN for degenerate triangles.
+
+    """
+    origin = corners[:, 0]
+    e1 = corners[:, 1] - origin
+    e2 = corners[:, 2] - origin
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]
+        return np.column_stack(
+            (
+                origin,
+                e2[:, 1] / det,
+                -e2[:, 0] / det,
+                -e1[:, 1] / det,
+                e1[:, 0] / det,
+            )
+        )
+
+
+def concatenate_ranges(starts, ends):
+    """
+    Concatenates the integer ranges [start, end) into one array without a Python loop.
+
+    Args:
+        starts (numpy.ndarray): The start of every range.
+        ends (numpy.ndarray): The end of every range.
+
+    Returns:
+        numpy.ndarray: The concatenated ranges.
+
+    """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(total)
@@ -1,31 +1,256 @@
+import contextlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import config as cfg
+import instrument
 import laspy
 import numpy as np
 from gftin import GFTIN
 from lasinfo import las_info
-from preprocess import clip_pc, preprocess
-from ptio import read_laz
-from tin import TIN
+from point_store import PointStore
+from preprocess import preprocess
+from ptio import RasterWriter, read_laz
+from spatial_index import GridIndex
+from tin import TIN, grid_coordinates, raster_profile
 
 
 def create_dtm(
     input_file,
     output_file,
+    tile_size=None,
+    overlap=None,
+    workers=None,
+    store=None,
 ):
+    """
+    Creates the DTM of cfg.EXTENT from a processed LAS file.
+
+    Args:
+        input_file (str): The path of the processed LAS file.
+        output_file (str): The path of the DTM raster.
+        tile_size (float, optional): The size of the tiles in meters. The extent is processed as one piece when
+            None. Defaults to None.
+        overlap (float, optional): The buffer around every tile in meters. Defaults to twice the GFTIN cell size.
+        workers (int, optional): The number of worker processes for the tiles. Defaults to the number of CPUs.
+        store (point_store.PointStore, optional): The loaded points to take the points from, instead of reading
+            input_file. Defaults to None.
+    """
     extent = cfg.EXTENT
     cell_size = cfg.GFTIN_CELL_SIZE
-    buffered_extent = [
-        extent[0] - cell_size * 2,
-        extent[1] - cell_size * 2,
+    las = _load_points(input_file, store)
+
+    raster_bbox = [extent[0], extent[1], extent[3], extent[4]]
+    if tile_size is not None:
+        if overlap is None:
+            overlap = cell_size * 2
+        _create_dtm_tiled(
+            las, output_file, raster_bbox, 0.5, tile_size, overlap, workers
+        )
+        return
+
+    tin = _ground_tin(las)
+    _write_dtm(tin, output_file)
+
+
+def create_ground_tin(input_file, output_file, store=None):
+    """
+    Runs ground filtering on cfg.EXTENT and saves the ground TIN, so the DTM can be rasterized again later
+    without ground filtering, see create_dtm_from_tin. The triangles are only saved for linear interpolation:
+    Laplace and nearest interpolation triangulate the loaded TIN anyway, so triangulating it here as well would
+    be done twice.
+
+    Args:
+        input_file (str): The path of the processed LAS file.
+        output_file (str): The path of the TIN file.
+        store (point_store.PointStore, optional): The loaded points to take the points from, instead of reading
+            input_file. Defaults to None.
+    """
+    tin = _ground_tin(_load_points(input_file, store))
+    tin.save(
+        output_file,
+        {
+            "extent": cfg.EXTENT,
+            "cell_size": cfg.GFTIN_CELL_SIZE,
+            "densification": cfg.GFTIN_DENSIFICATION,
+        },
+        triangles=cfg.DTM_INTERPOLATION == "linear",
+    )
+
+
+def create_dtm_from_tin(tin_file, output_file):
+    """
+    Creates the DTM of cfg.EXTENT from a ground TIN saved by create_ground_tin.
+
+    Args:
+        tin_file (str): The path of the TIN file.
+        output_file (str): The path of the DTM raster.
+    """
+    _write_dtm(TIN.load(tin_file), output_file)
+
+
+def _load_points(input_file, store=None):
+    """
+    Loads the points of cfg.EXTENT with a buffer of two GFTIN cells, and adds the is_ground dimension.
+
+    Args:
+        input_file (str): The path of the processed LAS file.
+        store (point_store.PointStore, optional): The loaded points to take the points from, instead of reading
+            input_file. Defaults to None.
+
+    Returns:
+        laspy.LasData: The points.
+    """
+    buffered = buffered_extent(cfg.EXTENT, cfg.GFTIN_CELL_SIZE * 2)
+    if store is None:
+        las = read_laz(input_file, bbox=buffered)
+        las_info(las)
+    else:
+        las = store.las(bbox=buffered)
+    add_ground_dim(las)
+    return las
+
+
+def _ground_tin(las):
+    """
+    Runs ground filtering on cfg.EXTENT and returns the TIN of the ground points.
+
+    Args:
+        las (laspy.LasData): The points, with the is_ground dimension.
+
+    Returns:
+        TIN: The ground TIN.
+    """
+    gftin = GFTIN(las, cfg.GFTIN_CELL_SIZE, cfg.EXTENT)
+    ground_points = gftin.ground_filtering(mode=cfg.GFTIN_DENSIFICATION)
+    return TIN(ground_points)
+
+
+def _write_dtm(tin, output_file):
+    """
+    Rasterizes a ground TIN over cfg.EXTENT.
+
+    Args:
+        tin (TIN): The ground TIN.
+        output_file (str): The path of the DTM raster.
+    """
+    extent = cfg.EXTENT
+    tin.write_dtm(
+        output_file,
+        [extent[0], extent[1], extent[3], extent[4]],
+        0.5,
+        cog=cfg.RASTER_COG,
+        method=cfg.DTM_INTERPOLATION,
+    )
+
+
+def _create_dtm_tiled(
+    las, output_file, raster_bbox, resolution, tile_size, overlap, workers=None
+):
+    """
+    Creates the DTM tile by tile in a process pool and assembles the tiles into one raster.
+
+    The tiles are aligned to the pixels of the output raster. Every tile runs ground filtering and interpolation
+    on its points plus an overlap buffer, and only keeps the pixels of its own tile, so the tiles fit together
+    without seams. Every tile is written to the raster as soon as it is done.
+
+    Args:
+        las (laspy.LASData): The LAS clipped to the buffered extent, with the is_ground dimension.
+        output_file (str): The path of the DTM raster.
+        raster_bbox (list): The bounding box of the raster [minx, miny, maxx, maxy].
+        resolution (float): The size of the pixels in meters.
+        tile_size (float): The size of the tiles in meters.
+        overlap (float): The buffer around every tile in meters.
+        workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+    """
+    extent = cfg.EXTENT
+    cell_size = cfg.GFTIN_CELL_SIZE
+    xs, ys = grid_coordinates(raster_bbox, resolution)
+    profile = raster_profile(
+        xs[0] + (resolution / 2),
+        ys[0] + (resolution / 2),
+        (len(ys), len(xs)),
+        resolution,
+    )
+    index = GridIndex(las.xyz)
+    # the workers attach to the points in shared memory instead of receiving a copy of their tile
+    store = PointStore(las)
+    handle = store.share()
+
+    with ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count()
+    ) as executor, contextlib.closing(store), RasterWriter(
+        output_file, profile, cog=cfg.RASTER_COG
+    ) as writer:
+        futures = {}
+        for rows, cols in split_into_tiles(len(ys), len(xs), resolution, tile_size):
+            tile_extent = [
+                xs[cols.start] - overlap,
+                ys[rows.start] - overlap,
+                extent[2],
+                xs[cols.stop - 1] + resolution + overlap,
+                ys[rows.stop - 1] + resolution + overlap,
+                extent[5],
+            ]
+            # GFTIN seeds its TIN with the points up to two cells around the tile
+            indices = index.query_bbox(
+                [
+                    tile_extent[0] - cell_size * 2,
+                    tile_extent[1] - cell_size * 2,
+                    tile_extent[3] + cell_size * 2,
+                    tile_extent[4] + cell_size * 2,
+                ]
+            )
+            tile_xs, tile_ys = np.meshgrid(xs[cols], ys[rows])
+            future = executor.submit(
+                create_dtm_tile,
+                handle,
+                indices,
+                tile_extent,
+                np.column_stack((tile_xs.ravel(), tile_ys.ravel())),
+            )
+            futures[future] = (rows, cols)
+
+        for future in as_completed(futures):
+            rows, cols = futures[future]
+            values, report = future.result()
+            instrument.merge(report)
+            writer.write(
+                values.reshape(rows.stop - rows.start, -1), rows.start, cols.start
+            )
+            instrument.log(
+                f"tile rows {rows.start}-{rows.stop} cols {cols.start}-{cols.stop} done"
+            )
+
+
+def buffered_extent(extent, buffer):
+    """
+    Grows an extent by a buffer in x and y.
+
+    Args:
+        extent (list): The extent [minx, miny, minz, maxx, maxy, maxz].
+        buffer (float): The buffer in meters.
+
+    Returns:
+        list: The buffered extent.
+    """
+    return [
+        extent[0] - buffer,
+        extent[1] - buffer,
         extent[2],
-        extent[3] + cell_size * 2,
-        extent[4] + cell_size * 2,
+        extent[3] + buffer,
+        extent[4] + buffer,
         extent[5],
     ]
 
-    las = read_laz(input_file)
-    las_info(las)
-    clip_pc(las, buffered_extent)
+
+def add_ground_dim(las):
+    """
+    Adds the is_ground dimension used by GFTIN to a LAS, with every point set to not ground.
+
+    Args:
+        las (laspy.LasData): The LAS.
+    """
     las.add_extra_dim(
         laspy.ExtraBytesParams(
             name="is_ground",
@@ -34,16 +259,59 @@ def create_dtm(
     )
     las.is_ground = np.zeros(len(las.points), dtype=np.uint8)
 
-    gftin = GFTIN(las, cfg.GFTIN_CELL_SIZE, extent)
-    ground_points = gftin.ground_filtering()
 
-    # # write ground points to a file
-    tin = TIN(ground_points)
-    raster_bbox = [extent[0], extent[1], extent[3], extent[4]]
-    tin.write_dtm(output_file, raster_bbox, 0.5)
+def split_into_tiles(nrows, ncols, resolution, tile_size):
+    """
+    Splits a raster into tiles of about tile_size meters.
+
+    Args:
+        nrows (int): The number of rows of the raster.
+        ncols (int): The number of columns of the raster.
+        resolution (float): The size of the pixels in meters.
+        tile_size (float): The size of the tiles in meters.
+
+    Returns:
+        list: The row and column slices of every tile [(rows, cols), ...].
+    """
+    step = max(int(round(tile_size / resolution)), 1)
+    return [
+        (slice(row, min(row + step, nrows)), slice(col, min(col + step, ncols)))
+        for row in range(0, nrows, step)
+        for col in range(0, ncols, step)
+    ]
+
+
+def create_dtm_tile(handle, indices, tile_extent, locations):
+    """
+    Runs ground filtering and interpolation for one tile. This runs in a worker process.
+
+    Args:
+        handle (dict): The handle of the shared point store, see point_store.PointStore.share.
+        indices (numpy.ndarray): The indices of the points of the tile and its buffer in the store.
+        tile_extent (list): The buffered extent of the tile [minx, miny, minz, maxx, maxy, maxz].
+        locations (numpy.ndarray): The locations of the pixels of the tile, shape (N, 2).
+
+    Returns:
+        tuple: The interpolated values of the pixels (numpy.ndarray) and the instrumentation of the tile (see
+        instrument.report).
+    """
+    instrument.reset()
+    store = PointStore.attach(handle)
+    las = store.las(indices=indices)
+    store.close()
+    gftin = GFTIN(las, cfg.GFTIN_CELL_SIZE, tile_extent)
+    ground_points = gftin.ground_filtering(mode=cfg.GFTIN_DENSIFICATION)
+    values = TIN(ground_points).interpolate(locations, cfg.DTM_INTERPOLATION)
+    return values, instrument.report()
 
 
 if __name__ == "__main__":
     processed_file = preprocess(cfg.INPUT_LAS)
     output_filename = cfg.STEP3_OUTPUT
-    create_dtm(processed_file, output_filename)
+    create_dtm(
+        processed_file,
+        output_filename,
+        cfg.DTM_TILE_SIZE,
+        cfg.DTM_TILE_OVERLAP,
+        cfg.DTM_WORKERS,
+    )
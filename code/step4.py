@@ -1,40 +1,93 @@
-import tempfile
-
 import config as cfg
+import laspy
+import numpy as np
+from dbscan import dbscan
 from lasinfo import las_info
 from pipeline import Pipeline
-from preprocess import clip_pc, preprocess
-from ptio import read_laz
+from preprocess import preprocess
+from ptio import las_to_pdal_array, pdal_array_to_las, read_laz
 from vegetation_ext import VegetationExtractor
 
+DBSCAN_ENGINES = ("native", "pdal")
+
+
+def extract_vegetation(
+    input_path,
+    output_path,
+    engine="native",
+    tile_size=None,
+    workers=None,
+    store=None,
+):
+    """
+    Extracts the vegetation of cfg.EXTENT from a processed LAS file and rasterizes it.
+
+    Args:
+        input_path (str): The path of the processed LAS file.
+        output_path (str): The path of the vegetation raster.
+        engine (str, optional): The DBSCAN implementation, "native" (dbscan.py) or "pdal" (filters.dbscan).
+            Defaults to "native".
+        tile_size (float, optional): The size of the tiles clustered in parallel by the native engine, in meters.
+            The points are clustered as one piece when None. Defaults to None.
+        workers (int, optional): The number of worker processes of the native engine. Defaults to the number
+            of CPUs.
+        store (point_store.PointStore, optional): The loaded points to take the points from, instead of reading
+            input_path. Defaults to None.
+    """
+    if store is None:
+        las = read_laz(input_path, bbox=cfg.EXTENT)
+    else:
+        las = store.las(bbox=cfg.EXTENT)
+    las = cluster_vegetation(las, engine, tile_size, workers)
+    las_info(las)
+    veg_extractor = VegetationExtractor(las)
+    veg_extractor.find_first_return_of_trees(3)
+    raster_bbox = [cfg.EXTENT[0], cfg.EXTENT[1], cfg.EXTENT[3], cfg.EXTENT[4]]
+    veg_extractor.rasterize(output_path, raster_bbox, cell_size=0.5, cog=cfg.RASTER_COG)
+
+
+def cluster_vegetation(las, engine="native", tile_size=None, workers=None):
+    """
+    Clusters the unclassified points of a LAS with DBSCAN and drops the noise.
+
+    Args:
+        las (laspy.LasData): The points.
+        engine (str, optional): The DBSCAN implementation, "native" (dbscan.py) or "pdal" (filters.dbscan).
+            Defaults to "native".
+        tile_size (float, optional): The size of the tiles clustered in parallel by the native engine, in meters.
+            Defaults to None.
+        workers (int, optional): The number of worker processes of the native engine. Defaults to the number
+            of CPUs.
+
+    Returns:
+        laspy.LasData: The clustered points, with their cluster in the ClusterID dimension.
+    """
+    if engine not in DBSCAN_ENGINES:
+        raise ValueError(f"engine must be one of {DBSCAN_ENGINES}, got {engine!r}")
 
-def extract_vegetation(input_path, output_path):
-    with tempfile.NamedTemporaryFile(
-        suffix=".las", delete=True, mode="w+t"
-    ) as clip_tmp:
-        las = read_laz(input_path)
-        clip_pc(las, cfg.EXTENT)
-        las.write(clip_tmp.name)
-        with tempfile.NamedTemporaryFile(
-            suffix=".las", delete=True, mode="w+t"
-        ) as dbscan_tmp:
-            tmp_path = dbscan_tmp.name
-            pipeline = Pipeline(
-                clip_tmp.name,
-                tmp_path,
-                ["ClusterID=uint16"],
-            )
-            pipeline.range().dbscan(6, 4).execute()
-            las = read_laz(tmp_path)
-            las_info(las)
-            veg_extractor = VegetationExtractor(las)
-            veg_extractor.find_first_return_of_trees(3)
-            raster_bbox = [cfg.EXTENT[0], cfg.EXTENT[1], cfg.EXTENT[3], cfg.EXTENT[4]]
-            veg_extractor.rasterize(output_path, raster_bbox, cell_size=0.5)
+    if engine == "pdal":
+        # the clipped points are handed to PDAL and back as numpy arrays, without temporary files
+        pipeline = Pipeline(las_to_pdal_array(las))
+        arrays = pipeline.range().dbscan(6, 4).execute().arrays
+        las = pdal_array_to_las(arrays[0], las.header, ["ClusterID"])
+    else:
+        # same as the range filter of the pipeline: unclassified points only
+        las.points = las.points[np.asarray(las.classification) == 1]
+        cluster_ids = dbscan(las.xyz, 4, 6, tile_size, workers)
+        las.points = las.points[cluster_ids != -1]
+        las.add_extra_dim(laspy.ExtraBytesParams(name="ClusterID", type=np.int64))
+        las.ClusterID = cluster_ids[cluster_ids != -1]
+    return las
 
 
 if __name__ == "__main__":
     processed_file = preprocess(cfg.INPUT_LAS)
     output_filename = cfg.STEP4_OUTPUT
 
-    extract_vegetation(processed_file, output_filename)
+    extract_vegetation(
+        processed_file,
+        output_filename,
+        cfg.DBSCAN_ENGINE,
+        cfg.DBSCAN_TILE_SIZE,
+        cfg.DBSCAN_WORKERS,
+    )
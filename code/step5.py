@@ -1,4 +1,6 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import config as cfg
 import numpy as np
@@ -6,65 +8,116 @@ import rasterio
 import step3
 import step4
 from preprocess import preprocess
+from ptio import RasterWriter
+from rasterio.windows import Window
 
 
-def create_chm(dtm_filepath, vegetation_filepath, output_filepath, cell_size=0.5):
-    # it expects dtm and vegetation file has same crs and resolution
-    with rasterio.open(dtm_filepath) as dtm:
-        dtm_data = dtm.read(1)
-        dtm_nodata = dtm.nodata
-        dtm_transform = dtm.transform
-        dtm_bbox = dtm.bounds
-        dtm_crs = dtm.crs
-    with rasterio.open(vegetation_filepath) as veg:
-        vegetation_data = veg.read(1)
-        vegetation_nodata = veg.nodata
-        vegetation_transform = veg.transform
-        vegetation_bbox = veg.bounds
-        vegetation_crs = veg.crs
-
-    chm_data = np.zeros(dtm_data.shape)
-    for i in range(dtm_data.shape[0]):
-        if vegetation_data.shape[0] <= i:
-            break
-        for j in range(dtm_data.shape[1]):
-            if vegetation_data.shape[1] <= j:
-                break
-            if (
-                dtm_data[i][j] != dtm_nodata
-                and vegetation_data[i][j] != vegetation_nodata
-            ):
-                chm = vegetation_data[i][j] - dtm_data[i][j]
-                if chm < 0:  # there is no minus since vegetation is higher than ground
-                    chm = 0
-                chm_data[i][j] = chm
+def create_chm(
+    dtm_filepath,
+    vegetation_filepath,
+    output_filepath,
+    cell_size=0.5,
+    block_size=512,
+    workers=None,
+    cog=False,
+):
+    """
+    Creates the CHM (vegetation height above the DTM) block by block.
+
+    The output is on the grid of the DTM. For every block of rows, the matching window of the vegetation raster
+    is found through the geotransforms of both rasters, so they do not need to have the same extent. Pixels
+    where either raster has no data get a height of 0, and negative heights are clamped to 0.
+
+    Args:
+        dtm_filepath (str): The path of the DTM raster.
+        vegetation_filepath (str): The path of the vegetation raster.
+        output_filepath (str): The path of the CHM raster.
+        cell_size (float, optional): The expected pixel size of both rasters. Defaults to 0.5.
+        block_size (int, optional): The number of rows processed per block. Defaults to 512.
+        workers (int, optional): The number of threads computing blocks. Blocks are processed in the calling
+            thread when None. Defaults to None.
+        cog (bool, optional): Whether to write a Cloud-Optimized GeoTIFF. Defaults to False.
+
+    Raises:
+        ValueError: If the rasters do not have the pixel size cell_size or do not share the same crs.
+    """
+    with rasterio.open(dtm_filepath) as dtm, rasterio.open(vegetation_filepath) as veg:
+        for src in (dtm, veg):
+            if not np.allclose(np.abs(src.res), cell_size):
+                raise ValueError(f"{src.name} must have a resolution of {cell_size}")
+        if dtm.crs != veg.crs:
+            raise ValueError("the dtm and vegetation rasters must have the same crs")
+        if np.sign(dtm.transform.e) != np.sign(veg.transform.e):
+            raise ValueError(
+                "the dtm and vegetation rasters must have the same orientation"
+            )
+
+        # offset of the vegetation pixels relative to the dtm pixels
+        veg_col, veg_row = ~veg.transform * (dtm.transform.c, dtm.transform.f)
+        col_shift, row_shift = int(round(veg_col)), int(round(veg_row))
+
+        profile = {
+            "driver": "GTiff",
+            "dtype": "float32",
+            "nodata": dtm.nodata,
+            "width": dtm.width,
+            "height": dtm.height,
+            "count": 1,
+            "crs": dtm.crs,
+            "transform": dtm.transform,
+        }
+        windows = [
+            Window(0, row, dtm.width, min(block_size, dtm.height - row))
+            for row in range(0, dtm.height, block_size)
+        ]
+        read_lock = threading.Lock()
+        write_lock = threading.Lock()
+
+        with RasterWriter(output_filepath, profile, cog=cog) as writer:
+
+            def process(window):
+                veg_window = Window(
+                    window.col_off + col_shift,
+                    window.row_off + row_shift,
+                    window.width,
+                    window.height,
+                )
+                with read_lock:
+                    dtm_data = dtm.read(1, window=window)
+                    vegetation_data = veg.read(
+                        1, window=veg_window, boundless=True, fill_value=veg.nodata
+                    )
+                chm_data = compute_chm(
+                    dtm_data, vegetation_data, dtm.nodata, veg.nodata
+                )
+                with write_lock:
+                    writer.write(chm_data, window.row_off, window.col_off)
+
+            if workers is None:
+                for window in windows:
+                    process(window)
             else:
-                chm_data[i][j] = 0
-
-    dtm_minx, dtm_miny, dtm_maxx, dtm_maxy = dtm_bbox
-    (
-        vegetation_minx,
-        vegetation_miny,
-        vegetation_maxx,
-        vegetation_maxy,
-    ) = vegetation_bbox
-
-    minx = min(dtm_minx, vegetation_minx)
-    maxy = max(dtm_maxy, vegetation_maxy)
-
-    profile = {
-        "driver": "GTiff",
-        "dtype": chm_data.dtype,
-        "nodata": dtm_nodata,
-        "width": chm_data.shape[1],
-        "height": chm_data.shape[0],
-        "count": 1,
-        "crs": dtm_crs,
-        "transform": rasterio.transform.from_origin(minx, maxy, cell_size, -cell_size),
-    }
-
-    with rasterio.open(output_filepath, "w", **profile) as dst:
-        dst.write(chm_data, 1)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(process, windows))
+
+
+def compute_chm(dtm_data, vegetation_data, dtm_nodata, vegetation_nodata):
+    """
+    Computes the CHM of one block.
+
+    Args:
+        dtm_data (numpy.ndarray): The DTM values.
+        vegetation_data (numpy.ndarray): The vegetation values, on the same pixels as dtm_data.
+        dtm_nodata (float): The nodata value of the DTM.
+        vegetation_nodata (float): The nodata value of the vegetation raster.
+
+    Returns:
+        numpy.ndarray: The CHM as float32, 0 where either input has no data.
+    """
+    valid = (dtm_data != dtm_nodata) & (vegetation_data != vegetation_nodata)
+    # there is no minus since vegetation is higher than ground
+    chm = np.maximum(vegetation_data - dtm_data, 0)
+    return np.where(valid, chm, 0).astype(np.float32)
 
 
 if __name__ == "__main__":
@@ -78,4 +131,5 @@ if __name__ == "__main__":
         cfg.STEP3_OUTPUT,
         cfg.STEP4_OUTPUT,
         cfg.STEP5_OUTPUT,
+        cog=cfg.RASTER_COG,
     )
@@ -0,0 +1,64 @@
+import laspy
+import numpy as np
+import pytest
+from gftin import DENSIFICATION_MODES, GFTIN
+from step3 import add_ground_dim
+
+BBOX = [0, 0, 0, 100, 100, 100]
+
+
+def _synthetic_las(n=3000, n_objects=150, seed=0):
+    """
+    Returns a LAS of a gently sloped, slightly noisy surface with points 10 m above it, e.g. vegetation, and the
+    indices of those points.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, 100, n)
+    y = rng.uniform(0, 100, n)
+    z = 10 + 0.1 * x + np.sin(y / 10) + rng.normal(0, 0.02, n)
+    objects = rng.choice(n, n_objects, replace=False)
+    z[objects] += 10
+
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.offsets = np.array([0, 0, 0])
+    las = laspy.LasData(header)
+    las.x = x
+    las.y = y
+    las.z = z
+    add_ground_dim(las)
+    return las, objects
+
+
+def _ground_filtering(mode):
+    las, objects = _synthetic_las()
+    gftin = GFTIN(las, 10, BBOX)
+    # the modes insert in a different order, so a point close to a threshold may be tested against different
+    # triangles; the angle is loose enough for no point of the surface to be close to it
+    ground_points = gftin.ground_filtering(dist_threshold=1, max_angle=45, mode=mode)
+    return np.asarray(gftin.las.points.is_ground), ground_points, objects
+
+
+def test_modes_agree_on_synthetic_surface():
+    is_ground, ground_points, _ = _ground_filtering("sequential")
+    batched_is_ground, batched_ground_points, _ = _ground_filtering("batched")
+
+    np.testing.assert_array_equal(batched_is_ground, is_ground)
+    np.testing.assert_array_equal(
+        np.unique(batched_ground_points, axis=0), np.unique(ground_points, axis=0)
+    )
+
+
+@pytest.mark.parametrize("mode", DENSIFICATION_MODES)
+def test_objects_are_not_ground(mode):
+    is_ground, _, objects = _ground_filtering(mode)
+
+    assert not np.any(is_ground[objects])
+    # the seeds and the points outside of the initial TIN are not flagged either
+    assert np.count_nonzero(is_ground) > 0.8 * (len(is_ground) - len(objects))
+
+
+def test_unknown_mode():
+    las, _ = _synthetic_las(n=100, n_objects=0)
+    with pytest.raises(ValueError):
+        GFTIN(las, 10, BBOX).ground_filtering(mode="parallel")
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from spatial_index import TriangleIndex
+from startinpy import DT
+
+
+@pytest.fixture(scope="module")
+def triangulation():
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(0, 100, (500, 2)), rng.uniform(0, 5, 500)))
+    dt = DT()
+    dt.insert(points)
+    # vertex 0 of startinpy is the infinite vertex, which no finite triangle uses
+    return dt, dt.points, dt.triangles, TriangleIndex(dt.points, dt.triangles)
+
+
+def _dt_locate(dt, x, y):
+    """
+    Returns the vertices of the triangle startinpy locates a point in, or None outside of the triangulation.
+    """
+    try:
+        triangle = dt.locate(x, y)
+    except Exception:
+        return None
+    return set(triangle) if len(triangle) else None
+
+
+def _check_weights(vertices, triangles, xy, located, weights):
+    assert np.all(located >= 0)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert np.all(weights >= -1e-9)
+    corners = vertices[triangles[located]][:, :, :2]
+    np.testing.assert_allclose(np.einsum("ij,ijk->ik", weights, corners), xy)
+
+
+def test_locate_matches_dt(triangulation):
+    dt, vertices, triangles, index = triangulation
+    xy = np.random.default_rng(1).uniform(0, 100, (2000, 2))
+    located, weights = index.locate(xy)
+
+    for (x, y), triangle in zip(xy, located):
+        expected = _dt_locate(dt, x, y)
+        if expected is None:
+            assert triangle == -1
+        else:
+            assert set(triangles[triangle]) == expected
+    inside = located >= 0
+    assert np.count_nonzero(inside) > 0.9 * len(xy)
+    _check_weights(vertices, triangles, xy[inside], located[inside], weights[inside])
+
+
+def test_locate_vertices(triangulation):
+    _, vertices, triangles, index = triangulation
+    xy = vertices[1:, :2]
+    located, weights = index.locate(xy)
+
+    _check_weights(vertices, triangles, xy, located, weights)
+    # any triangle of the vertex, with all the weight on it
+    ids = np.arange(1, len(vertices))
+    assert np.all(np.any(triangles[located] == ids[:, None], axis=1))
+    np.testing.assert_allclose(weights.max(axis=1), 1)
+
+
+def test_locate_edges(triangulation):
+    dt, vertices, triangles, index = triangulation
+    edges = triangles[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2)
+    xy = vertices[edges, :2].mean(axis=1)
+    located, weights = index.locate(xy)
+
+    _check_weights(vertices, triangles, xy, located, weights)
+    # either triangle of the edge, like startinpy
+    for edge, triangle, (x, y) in zip(edges, located, xy):
+        assert set(edge) <= set(triangles[triangle])
+        expected = _dt_locate(dt, x, y)
+        assert expected is None or set(edge) <= expected
+
+
+def test_locate_outside(triangulation):
+    dt, _, _, index = triangulation
+    xy = np.array([[-10, 50], [110, 50], [50, -10], [50, 110], [-1e6, -1e6]])
+    located, weights = index.locate(xy)
+
+    np.testing.assert_array_equal(located, -1)
+    assert np.all(np.isnan(weights))
+    assert all(_dt_locate(dt, x, y) is None for x, y in xy)
+
+
+def test_locate_empty():
+    located, weights = TriangleIndex(np.zeros((0, 3)), np.zeros((0, 3))).locate(
+        np.array([[0.0, 0.0]])
+    )
+
+    np.testing.assert_array_equal(located, -1)
+    assert np.all(np.isnan(weights))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from tin import INTERPOLATION_METHODS, TIN
+
+
+@pytest.fixture(scope="module")
+def points():
+    rng = np.random.default_rng(0)
+    return np.column_stack((rng.uniform(0, 100, (1000, 2)), rng.uniform(0, 5, 1000)))
+
+
+@pytest.fixture(scope="module")
+def locations():
+    # some of them outside of the TIN
+    return np.random.default_rng(1).uniform(-5, 105, (2000, 2))
+
+
+@pytest.mark.parametrize("triangles", [True, False])
+def test_save_load(tmp_path, points, locations, triangles):
+    tin = TIN(points)
+    tin.metadata = {"cell_size": 10}
+    # saved under the given name, without the .npz numpy adds to paths
+    file_path = tmp_path / "ground_tin.tin"
+    tin.save(str(file_path), {"extent": [0, 0, 0, 100, 100, 10]}, triangles=triangles)
+    loaded = TIN.load(str(file_path))
+
+    assert file_path.exists()
+    assert loaded.metadata == {"cell_size": 10, "extent": [0, 0, 0, 100, 100, 10]}
+    np.testing.assert_array_equal(loaded.points, points)
+    for method in INTERPOLATION_METHODS:
+        np.testing.assert_array_equal(
+            loaded.interpolate(locations, method), tin.interpolate(locations, method)
+        )
+
+
+def test_load_without_triangulating(tmp_path, points, locations):
+    tin = TIN(points)
+    tin.save(str(tmp_path / "ground_tin.npz"))
+    loaded = TIN.load(str(tmp_path / "ground_tin.npz"))
+
+    values = loaded.interpolate(locations, "linear")
+
+    assert loaded._dt is None
+    np.testing.assert_array_equal(values, tin.interpolate(locations, "linear"))
+
+
+def test_save_without_triangles_does_not_triangulate(tmp_path, points):
+    tin = TIN(points)
+    tin.save(str(tmp_path / "ground_tin.npz"), triangles=False)
+
+    assert tin._dt is None
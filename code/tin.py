@@ -1,164 +1,307 @@
-import math
+import json
 
+import instrument
 import numpy as np
 import rasterio
-from geojson import write_geojson
-from ptio import write_ras
+from binning import grid_shape
+from geojson import write_geojson, write_triangles_geojson
+from ptio import RasterWriter, write_ras
+from spatial_index import TriangleIndex
 from startinpy import DT
 
+INTERPOLATION_METHODS = ("laplace", "linear", "nearest")
+
+
+def grid_coordinates(bbox, cell_size):
+    """
+    Returns the coordinates of the lower left corners of the grid cells covering a bounding box.
+
+    Args:
+        bbox (list): The bounding box [minx, miny, maxx, maxy].
+        cell_size (float): The size of each grid cell in meters.
+
+    Returns:
+        tuple: The x coordinates of the columns and the y coordinates of the rows (numpy.ndarray).
+    """
+    nrows, ncols = grid_shape(bbox, cell_size)
+    xs = bbox[0] + np.arange(ncols) * cell_size
+    ys = bbox[1] + np.arange(nrows) * cell_size
+    return xs, ys
+
+
+def write_gridded_points(file_path, grid_points, cell_size, nodata=-9999, cog=False):
+    """
+    Writes gridded points as a raster file.
+
+    Args:
+        file_path (str): The file path to save the raster file.
+        grid_points (numpy.ndarray): The gridded points, shape (rows, cols, 3) of [x, y, z] values.
+        cell_size (float): The size of each grid cell in meters.
+        nodata (float): The nodata value for the raster (default: -9999).
+        cog (bool): Whether to write a Cloud-Optimized GeoTIFF (default: False).
+    """
+    raster_points = grid_points[:, :, 2]
+    profile = raster_profile(
+        grid_points[0][0][0],
+        grid_points[0][0][1],
+        raster_points.shape,
+        cell_size,
+        nodata,
+    )
+    write_ras(file_path, profile, raster_points, cog)
+
+
+def raster_profile(x, y, shape, cell_size, nodata=-9999):
+    """
+    Returns the rasterio profile of the float32 rasters of gridded points.
+
+    Args:
+        x (float): The x coordinate of the origin, the center of the first cell.
+        y (float): The y coordinate of the origin, the center of the first cell.
+        shape (tuple): The number of rows and columns.
+        cell_size (float): The size of each grid cell in meters.
+        nodata (float): The nodata value for the raster (default: -9999).
+
+    Returns:
+        dict: The profile.
+    """
+    return {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "nodata": nodata,
+        "height": shape[0],
+        "width": shape[1],
+        "count": 1,
+        "crs": "EPSG:28992",
+        "transform": rasterio.transform.from_origin(
+            x,
+            y,
+            cell_size,
+            -cell_size,  # Negative because the raster's origin is top-left
+        ),
+    }
+
 
 class TIN:
+    """
+    A TIN of ground points, interpolated into rasters.
+
+    The startinpy triangulation is built on first use. A TIN can be saved with its vertices, triangles and
+    metadata and loaded again without triangulating: linear interpolation runs on the stored triangles, and
+    only Laplace and nearest interpolation rebuild the startinpy triangulation from the stored vertices. A TIN
+    saved without its triangles is triangulated again on first use.
+
+    Args:
+        points (numpy.ndarray): The points, shape (N, 3).
+        debug (bool, optional): Flag indicating whether to enable debug mode. Defaults to False.
+
+    Attributes:
+        points (numpy.ndarray): The points.
+        dt (DT): The Delaunay Triangulation object.
+        metadata (dict): The metadata saved with the TIN, e.g. the extent and parameters it was made with.
+
+    Methods:
+        load(file_path): Loads a TIN saved with save.
+        save(file_path, metadata=None, triangles=True): Saves the vertices, triangles and metadata of the TIN.
+        save_geojson(file_path, triangles=False): Writes the points or triangles of the TIN to a GeoJSON file.
+        interpolate(locations, method="laplace"): Interpolates at many locations at once.
+        to_gridded_points(bbox, cell_size, method="laplace"): Converts the TIN to gridded points.
+        write_dtm(file_path, bbox, cell_size, nodata=-9999, cog=False, method="laplace"): Writes the TIN as a
+            raster file.
+
+    """
+
     def __init__(self, points, debug=False):
         self.points = points
-        self.dt = DT()
-        self.dt.insert(points)
         self.debug = debug
+        self.metadata = {}
+        self._dt = None
+        self._vertices = None
+        self._triangles = None
+        self._triangle_index = None
+        self._triangle_z = None
 
-    def save_geojson(self, file_path):
-        write_geojson(file_path, self.points, "epsg:28992", "epsg:4326")
+    @property
+    def dt(self):
+        if self._dt is None:
+            self._dt = DT()
+            self._dt.insert(self.points)
+        return self._dt
 
-    def _laplace_interpolate(self, p):
+    @classmethod
+    def load(cls, file_path):
         """
-        Performs Laplace interpolation at a given point.
+        Loads a TIN saved with save, without triangulating it.
 
         Args:
-            p (list): The coordinates of the point [x, y].
+            file_path (str): The path of the file.
 
         Returns:
-            float: The interpolated value at the given point.
+            TIN: The TIN, with its metadata.
         """
-        p = [p[0], p[1], 0.0]
-        p_index = self.dt.insert_one_pt(p[0], p[1], p[2])
-        if self.dt.is_vertex_convex_hull(p_index):  # impossible to interpolate
-            self.dt.remove(p_index)
-            return np.nan
-        triangles = self.dt.incident_triangles_to_vertex(p_index)
-
-        weight_z_pairs = []
-        for i, tri in enumerate(triangles):
-            p0_i, p1_i, p2_i = tri
-            p0, p1, p2 = (
-                tuple(self.dt.points[p0_i]),
-                tuple(self.dt.points[p1_i]),
-                tuple(self.dt.points[p2_i]),
-            )
-            next_tri = triangles[(i + 1) % len(triangles)]
-            p3_i, p4_i, p5_i = next_tri
-            p3, p4, p5 = (
-                tuple(self.dt.points[p3_i]),
-                tuple(self.dt.points[p4_i]),
-                tuple(self.dt.points[p5_i]),
-            )
+        with np.load(file_path) as data:
+            tin = cls(data["vertices"])
+            if "triangles" in data.files:
+                tin._vertices = tin.points
+                tin._triangles = data["triangles"].astype(np.int64)
+            tin.metadata = json.loads(str(data["metadata"]))
+        return tin
 
-            common_points_indices = list(
-                set([p0_i, p1_i, p2_i]).intersection(set([p3_i, p4_i, p5_i]))
-            )
-            cc1 = self._circimcircle_center(p0, p1, p2)
-            cc2 = self._circimcircle_center(p3, p4, p5)
-            if cc1 is None or cc2 is None:
-                continue
-            voronoi_edge_length = math.dist(cc1, cc2)
-            edge = math.dist(
-                self.dt.points[common_points_indices[0]],
-                self.dt.points[common_points_indices[1]],
+    def save(self, file_path, metadata=None, triangles=True):
+        """
+        Saves the vertices, triangles and metadata of the TIN to a numpy .npz file.
+
+        Args:
+            file_path (str): The path of the file.
+            metadata (dict, optional): Metadata to save with the TIN, in addition to the metadata attribute. It
+                must be JSON serializable. Defaults to None.
+            triangles (bool, optional): Whether to save the triangles. Getting them triangulates the TIN if it is
+                not triangulated yet, which is wasted when the loaded TIN is only interpolated with Laplace or
+                nearest, as those triangulate it again. Defaults to True.
+        """
+        arrays = {
+            "metadata": np.array(json.dumps({**self.metadata, **(metadata or {})}))
+        }
+        if triangles:
+            vertices, tris = self._triangulation()
+            index_dtype = np.int32 if len(vertices) < 2**31 else np.int64
+            arrays.update(vertices=vertices, triangles=tris.astype(index_dtype))
+        else:
+            arrays["vertices"] = self.points
+        # a file object, so numpy does not add .npz to the path
+        with open(file_path, "wb") as f:
+            np.savez(f, **arrays)
+
+    def _triangulation(self):
+        """
+        Returns the vertices and the triangles of the TIN, without the infinite vertex of startinpy.
+
+        Returns:
+            tuple: The vertices (numpy.ndarray (N, 3)) and the vertex indices of the triangles
+            (numpy.ndarray (M, 3)).
+        """
+        if self._vertices is None:
+            # vertex 0 of startinpy is the infinite vertex
+            self._vertices = self.dt.points[1:]
+            self._triangles = self.dt.triangles.astype(np.int64) - 1
+        return self._vertices, self._triangles
+
+    def save_geojson(self, file_path, triangles=False):
+        if triangles:
+            vertices, tris = self._triangulation()
+            write_triangles_geojson(
+                file_path, vertices, tris, "epsg:28992", "epsg:4326"
             )
-            weight = voronoi_edge_length / edge
-            common_points_indices.remove(p_index)
-            z = self.dt.points[common_points_indices[0]][2]
-            weight_z_pairs.append([weight, z])
-        interpolated_value = sum([w * z for w, z in weight_z_pairs]) / sum(
-            [w for w, _ in weight_z_pairs]
-        )
+        else:
+            write_geojson(file_path, self.points, "epsg:28992", "epsg:4326")
+
+    def interpolate(self, locations, method="laplace"):
+        """
+        Interpolates at many locations at once.
+
+        "laplace" runs inside startinpy for the whole array, so the triangulation is left unchanged and no
+        Python code runs per location. "linear" interpolates within the containing triangle: the triangles of
+        all locations are located in one batch with a TriangleIndex and weighted with their barycentric
+        weights. "nearest" takes the value of the nearest vertex. "linear" and "nearest" are much faster than
+        "laplace", at the cost of a faceted or stepped surface.
+
+        Args:
+            locations (numpy.ndarray): The coordinates of the locations, shape (N, 2).
+            method (str, optional): One of INTERPOLATION_METHODS. Defaults to "laplace".
 
-        self.dt.remove(p_index)
-        return interpolated_value
+        Raises:
+            ValueError: If method is not one of INTERPOLATION_METHODS.
 
-    def _circimcircle_center(self, p0, p1, p2):
+        Returns:
+            numpy.ndarray: The interpolated values as float32, NaN outside of the convex hull.
+        """
+        if method not in INTERPOLATION_METHODS:
+            raise ValueError(f"method must be one of {INTERPOLATION_METHODS}")
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        if len(locations) == 0:
+            return np.empty(0, dtype=np.float32)
+        if method == "linear":
+            return self._interpolate_linear(locations)
+        startin_method = "Laplace" if method == "laplace" else "NN"
+        values = self.dt.interpolate(
+            {"method": startin_method}, locations, strict=False
+        )
+        return np.asarray(values, dtype=np.float32)
+
+    def _interpolate_linear(self, locations):
         """
-        Calculates the circumcircle center of three points.
+        Interpolates linearly within the triangles containing the locations.
 
         Args:
-            p0 (tuple): The coordinates of the first point (x0, y0).
-            p1 (tuple): The coordinates of the second point (x1, y1).
-            p2 (tuple): The coordinates of the third point (x2, y2).
+            locations (numpy.ndarray): The coordinates of the locations, shape (N, 2).
 
         Returns:
-            list: The coordinates of the circumcircle center [x, y].
+            numpy.ndarray: The interpolated values as float32, NaN outside of the convex hull.
         """
-        ax, ay = p0[0], p0[1]
-        bx, by = p1[0], p1[1]
-        cx, cy = p2[0], p2[1]
-        d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
-        if d == 0:
-            return None
-        ux = (
-            (ax**2 + ay**2) * (by - cy)
-            + (bx**2 + by**2) * (cy - ay)
-            + (cx**2 + cy**2) * (ay - by)
-        ) / d
-        uy = (
-            (ax**2 + ay**2) * (cx - bx)
-            + (bx**2 + by**2) * (ax - cx)
-            + (cx**2 + cy**2) * (bx - ax)
-        ) / d
-        return [ux, uy]
-
-    def to_gridded_points(self, bbox, cell_size):
+        if self._triangle_index is None:
+            vertices, triangles = self._triangulation()
+            self._triangle_index = TriangleIndex(vertices, triangles)
+            self._triangle_z = vertices[triangles, 2]
+        triangles, weights = self._triangle_index.locate(locations)
+        values = np.full(len(locations), np.nan, dtype=np.float32)
+        inside = triangles >= 0
+        values[inside] = np.einsum(
+            "ij,ij->i", weights[inside], self._triangle_z[triangles[inside]]
+        )
+        return values
+
+    def to_gridded_points(self, bbox, cell_size, method="laplace"):
         """
         Converts the TIN to gridded points within a bounding box.
 
         Args:
             bbox (list): The bounding box [minx, miny, maxx, maxy].
             cell_size (float): The size of each grid cell in meters.
+            method (str, optional): The interpolation method, one of INTERPOLATION_METHODS. Defaults to "laplace".
 
         Returns:
-            list: The gridded points as a nested list of [x, y, z] values.
+            numpy.ndarray: The gridded points, shape (rows, cols, 3) of [x, y, z] values.
         """
-        print("dt bbox", self.dt.get_bbox())
-        print("bbox", bbox)
-        rows = []
-        y = bbox[1]
-        while y < bbox[3]:
-            cols = []
-            x = bbox[0]
-            while x < bbox[2]:
-                z = self._laplace_interpolate([x, y])
-                cols.append([x + (cell_size / 2), y + (cell_size / 2), z])
-                x += cell_size
-            rows.append(cols)
-            y += cell_size
-        return rows
-
-    def write_dtm(self, file_path, bbox, cell_size, nodata=-9999):
+        instrument.log("dt bbox", self.dt.get_bbox(), level=2)
+        instrument.log("bbox", bbox, level=2)
+        xs, ys = grid_coordinates(bbox, cell_size)
+        xx, yy = np.meshgrid(xs, ys)
+        z = self.interpolate(np.column_stack((xx.ravel(), yy.ravel())), method)
+        return np.dstack(
+            (xx + (cell_size / 2), yy + (cell_size / 2), z.reshape(xx.shape))
+        )
+
+    def write_dtm(
+        self, file_path, bbox, cell_size, nodata=-9999, cog=False, method="laplace"
+    ):
         """
         Writes the TIN as a raster file.
 
+        The raster is interpolated and written one band of tiles at a time, so the whole grid is never held in
+        memory.
+
         Args:
             file_path (str): The file path to save the raster file.
             bbox (list): The bounding box [minx, miny, maxx, maxy].
             cell_size (float): The size of each grid cell in meters.
             nodata (float): The nodata value for the raster (default: -9999).
+            cog (bool): Whether to write a Cloud-Optimized GeoTIFF (default: False).
+            method (str): The interpolation method, one of INTERPOLATION_METHODS (default: "laplace").
         """
-        grid_points = np.array(self.to_gridded_points(bbox, cell_size))
-        raster_points = grid_points[:, :, 2]
-
         if self.debug:
-            reshaped = grid_points.reshape(-1, 3)
+            reshaped = self.to_gridded_points(bbox, cell_size, method).reshape(-1, 3)
             write_geojson("./py/data/out/debug/grid_points.geojson", reshaped)
 
-        profile = {
-            "driver": "GTiff",
-            "dtype": "float32",
-            "nodata": nodata,
-            "height": raster_points.shape[0],
-            "width": raster_points.shape[1],
-            "count": 1,
-            "crs": "EPSG:28992",
-            "transform": rasterio.transform.from_origin(
-                grid_points[0][0][0],
-                grid_points[0][0][1],
-                cell_size,
-                -cell_size,  # Negative because the raster's origin is top-left
-            ),
-        }
-        write_ras(file_path, profile, raster_points)
+        xs, ys = grid_coordinates(bbox, cell_size)
+        profile = raster_profile(
+            xs[0] + (cell_size / 2),
+            ys[0] + (cell_size / 2),
+            (len(ys), len(xs)),
+            cell_size,
+            nodata,
+        )
+        with RasterWriter(file_path, profile, cog=cog) as writer:
+            for row in range(0, len(ys), writer.block_size):
+                xx, yy = np.meshgrid(xs, ys[row : row + writer.block_size])
+                z = self.interpolate(np.column_stack((xx.ravel(), yy.ravel())), method)
+                writer.write(z.reshape(xx.shape), row)
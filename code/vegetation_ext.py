@@ -1,5 +1,6 @@
 import numpy as np
 import rasterio
+from binning import cell_keys, grid_shape, max_per_cell
 from ptio import write_ras
 from startinpy import DT
 
@@ -17,15 +18,17 @@ class VegetationExtractor:
         cluster_name (str): The name of the cluster attribute.
         veg_first_returns (ndarray): Array of first return points of vegetation.
         veg_dt (DT): A Delaunay Triangulation object.
+        veg_xyz (ndarray): The coordinates of the first return points of vegetation, shape (N, 3).
+        cluster_stats (ndarray): The statistics of every cluster, see cluster_statistics.
 
     Methods:
+        cluster_statistics: Compute the aggregates of every cluster in a single pass.
         _find_trees: Find the clusters that represent trees.
         _extract_first_returns: Extract the first return points from the LAS data
         find_first_return_of_trees: Find the first return points of trees.
         rasterize: Rasterize the vegetation points into a GeoTIFF file.
         _interpolate: Interpolate the elevation at a given point.
-        _highest_veg_point_in_a_cell: Find the highest vegetation point in a cell.
-        _to_gridded_points: Convert the bounding box into gridded points.
+        _to_grid: Rasterize the highest vegetation point of every cell.
 
     """
 
@@ -34,6 +37,63 @@ class VegetationExtractor:
         self.cluster_name = cluster_name
         self.veg_first_returns = None
         self.veg_dt = DT()
+        self.veg_xyz = None
+        self.cluster_stats = None
+
+    def cluster_statistics(self, las):
+        """
+        Compute the aggregates of every cluster in a single pass.
+
+        The cluster IDs are sorted once by np.unique, and every aggregate is a scatter or bincount over the
+        inverse indices, instead of a boolean mask over all points per cluster.
+
+        Args:
+            las (laspy.LASData): The laspy.LASData instance.
+
+        Returns:
+            tuple: The statistics table (ndarray with the fields cluster_id, point_count, max_number_of_returns,
+                z_min, z_max, z_range and first_return_count, one row per cluster) and the row of every point
+                in that table (ndarray).
+
+        """
+        cluster_ids, inverse, counts = np.unique(
+            np.asarray(las[self.cluster_name]), return_inverse=True, return_counts=True
+        )
+        inverse = inverse.ravel()
+        stats = np.zeros(
+            len(cluster_ids),
+            dtype=[
+                ("cluster_id", cluster_ids.dtype),
+                ("point_count", np.int64),
+                ("max_number_of_returns", np.int64),
+                ("z_min", np.float64),
+                ("z_max", np.float64),
+                ("z_range", np.float64),
+                ("first_return_count", np.int64),
+            ],
+        )
+        stats["cluster_id"] = cluster_ids
+        stats["point_count"] = counts
+
+        max_number_of_returns = np.zeros(len(cluster_ids), dtype=np.int64)
+        np.maximum.at(max_number_of_returns, inverse, np.asarray(las.number_of_returns))
+        stats["max_number_of_returns"] = max_number_of_returns
+
+        z = np.asarray(las.z)
+        z_min = np.full(len(cluster_ids), np.inf)
+        z_max = np.full(len(cluster_ids), -np.inf)
+        np.minimum.at(z_min, inverse, z)
+        np.maximum.at(z_max, inverse, z)
+        stats["z_min"] = z_min
+        stats["z_max"] = z_max
+        stats["z_range"] = z_max - z_min
+
+        stats["first_return_count"] = np.bincount(
+            inverse,
+            weights=np.asarray(las.return_number) == 1,
+            minlength=len(cluster_ids),
+        )
+        return stats, inverse
 
     def _find_trees(self, las, number_of_returns=3):
         """
@@ -44,17 +104,12 @@ class VegetationExtractor:
             number_of_returns (int, optional): The minimum number of returns for a point to be considered a tree. Defaults to 3.
 
         Returns:
-            list: List of cluster IDs representing trees.
+            tuple: The mask of the tree clusters in the cluster statistics table (ndarray), and the row of every point in that table (ndarray).
 
         """
-        trees = []
-        clusters = np.unique(las.ClusterID)
-        for cluster in clusters:
-            cluster_points = las.points[las[self.cluster_name] == cluster]
-            num_returns = np.unique(cluster_points["number_of_returns"])
-            if np.any(num_returns > number_of_returns - 1):
-                trees.append(cluster)
-        return trees
+        stats, inverse = self.cluster_statistics(las)
+        self.cluster_stats = stats
+        return stats["max_number_of_returns"] >= number_of_returns, inverse
 
     def _extract_first_returns(self, las):
         """
@@ -69,6 +124,9 @@ class VegetationExtractor:
         """
         first_returns = las.points[las.return_number == 1]
         self.veg_first_returns = first_returns
+        self.veg_xyz = np.column_stack(
+            (first_returns.x, first_returns.y, first_returns.z)
+        )
         return first_returns
 
     def find_first_return_of_trees(self, number_of_returns=3):
@@ -82,14 +140,15 @@ class VegetationExtractor:
             ndarray: Array of first return points of trees.
 
         """
-        trees = self._find_trees(self.las, number_of_returns)
+        is_tree, inverse = self._find_trees(self.las, number_of_returns)
         first_returns = self._extract_first_returns(self.las)
+        # look up the tree flag of every point through its row in the cluster statistics table
         first_returns_of_trees = first_returns[
-            np.isin(first_returns[self.cluster_name], trees)
+            is_tree[inverse[self.las.return_number == 1]]
         ]
         return first_returns_of_trees
 
-    def rasterize(self, file_path, bbox, cell_size=0.5, nodata=-9999):
+    def rasterize(self, file_path, bbox, cell_size=0.5, nodata=-9999, cog=False):
         """
         Rasterize the vegetation points into a GeoTIFF file.
 
@@ -98,26 +157,26 @@ class VegetationExtractor:
             bbox (list): The bounding box of the area of interest [xmin, ymin, xmax, ymax].
             cell_size (float, optional): The size of each cell in the raster grid. Defaults to 0.5.
             nodata (int, optional): The nodata value for the raster. Defaults to -9999.
+            cog (bool, optional): Whether to write a Cloud-Optimized GeoTIFF. Defaults to False.
 
         """
-        grid_points = np.array(self._to_gridded_points(bbox, cell_size))
-        raster_points = grid_points[:, :, 2]
+        grid = self._to_grid(bbox, cell_size, nodata)
         profile = {
             "driver": "GTiff",
             "dtype": "float32",
             "nodata": nodata,
-            "height": raster_points.shape[0],
-            "width": raster_points.shape[1],
+            "height": grid.shape[0],
+            "width": grid.shape[1],
             "count": 1,
             "crs": "EPSG:28992",
             "transform": rasterio.transform.from_origin(
-                grid_points[0][0][0],
-                grid_points[0][0][1],
+                bbox[0] + (cell_size / 2),
+                bbox[1] + (cell_size / 2),
                 cell_size,
                 -cell_size,
             ),
         }
-        write_ras(file_path, profile, raster_points)
+        write_ras(file_path, profile, grid, cog)
 
     def _interpolate(self, p):
         """
@@ -140,38 +199,12 @@ class VegetationExtractor:
         self.veg_dt.insert(xyz_array)
         return self.veg_dt.interpolate({"method": "Laplace"}, [[p[0], p[1]]])
 
-    def _highest_veg_point_in_a_cell(self, cell_bbox):
+    def _to_grid(self, bbox, cell_size, nodata=-9999):
         """
-        Find the highest vegetation point in a cell.
+        Rasterize the highest vegetation point of every cell of the bounding box.
 
-        Args:
-            cell_bbox (list): The bounding box [xmin, ymin, xmax, ymax] of the cell.
-
-        Returns:
-            float: The elevation of the highest vegetation point in the cell.
-
-        """
-        xyz_array = np.column_stack(
-            (
-                self.veg_first_returns.x,
-                self.veg_first_returns.y,
-                self.veg_first_returns.z,
-            )
-        )
-        x_valid = (cell_bbox[0] <= xyz_array[:, 0]) & (cell_bbox[2] >= xyz_array[:, 0])
-        y_valid = (cell_bbox[1] <= xyz_array[:, 1]) & (cell_bbox[3] >= xyz_array[:, 1])
-
-        valid_indices = np.where(x_valid & y_valid)[0]
-        points_in_cell = xyz_array[valid_indices]
-        if len(points_in_cell) == 0:
-            return None
-        sorted_array = points_in_cell[points_in_cell[:, 2].argsort()]
-        z_max_points = sorted_array[-1]
-        return z_max_points[2]
-
-    def _to_gridded_points(self, bbox, cell_size, nodata=-9999):
-        """
-        Convert the bounding box into gridded points.
+        The points are binned to their cells once and reduced to the maximum z per cell in a single scatter.
+        A point on the edge between cells counts for every cell touching it.
 
         Args:
             bbox (list): The bounding box [xmin, ymin, xmax, ymax].
@@ -179,22 +212,11 @@ class VegetationExtractor:
             nodata (int, optional): The nodata value for the grid. Defaults to -9999.
 
         Returns:
-            list: List of gridded points [[x, y, z], ...].
+            ndarray: The grid of the highest z values as float32, with the rows starting at ymin.
 
         """
-        rows = []
-        y = bbox[1]
-        while y < bbox[3]:
-            cols = []
-            x = bbox[0]
-            while x < bbox[2]:
-                z = self._highest_veg_point_in_a_cell(
-                    [x, y, x + cell_size, y + cell_size]
-                )
-                cols.append(
-                    [x + (cell_size / 2), y + (cell_size / 2), z if z else nodata]
-                )
-                x += cell_size
-            rows.append(cols)
-            y += cell_size
-        return rows
+        shape = grid_shape(bbox, cell_size)
+        xyz_array = self.veg_xyz
+        indices, keys = cell_keys(xyz_array, bbox[:2], cell_size, shape, closed=True)
+        grid = max_per_cell(xyz_array[indices, 2], keys, shape[0] * shape[1], nodata)
+        return grid.reshape(shape)